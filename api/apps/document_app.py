@@ -34,7 +34,7 @@ from api.db.services.dialog_service import DialogService, ConversationService
 from api.db.services.file2document_service import File2DocumentService
 from api.db.services.file_service import FileService
 from api.db.services.llm_service import LLMBundle
-from api.db.services.task_service import TaskService, queue_tasks
+from api.db.services.task_service import TaskService, queue_tasks, cancel_all_task_of, incremental_pending
 from api.db.services.user_service import TenantService, UserTenantService
 from graphrag.mind_map_extractor import MindMapExtractor
 from rag.app import naive
@@ -337,18 +337,28 @@ def run():
     req = request.json
     try:
         for id in req["doc_ids"]:
+            # Incremental re-parse keeps the indexed chunks and their counters, and only
+            # embeds and indexes what changed.
+            incremental = bool(req.get("incremental")) and str(req["run"]) == TaskStatus.RUNNING.value
+            # The stale chunks of an earlier run which did not complete are only
+            # known as not stamped by it; a full re-parse is the way to drop them.
+            if incremental and incremental_pending(id):
+                incremental = False
             info = {"run": str(req["run"]), "progress": 0}
             if str(req["run"]) == TaskStatus.RUNNING.value:
                 info["progress_msg"] = ""
-                info["chunk_num"] = 0
-                info["token_num"] = 0
+                if not incremental:
+                    info["chunk_num"] = 0
+                    info["token_num"] = 0
             DocumentService.update_by_id(id, info)
-            # if str(req["run"]) == TaskStatus.CANCEL.value:
+            if str(req["run"]) == TaskStatus.CANCEL.value:
+                cancel_all_task_of(id)
             tenant_id = DocumentService.get_tenant_id(id)
             if not tenant_id:
                 return get_data_error_result(retmsg="Tenant not found!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+            if not incremental:
+                ELASTICSEARCH.deleteByQuery(
+                    Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
 
             if str(req["run"]) == TaskStatus.RUNNING.value:
                 TaskService.filter_delete([Task.doc_id == id])
@@ -356,7 +366,7 @@ def run():
                 doc = doc.to_dict()
                 doc["tenant_id"] = tenant_id
                 bucket, name = File2DocumentService.get_storage_address(doc_id=doc["id"])
-                queue_tasks(doc, bucket, name)
+                queue_tasks(doc, bucket, name, incremental)
 
         return get_json_result(data=True)
     except Exception as e:
@@ -29,7 +29,7 @@ from api.utils.api_utils import get_result, token_required, get_error_data_resul
 
 from api.db.db_models import Task, File
 
-from api.db.services.task_service import TaskService, queue_tasks
+from api.db.services.task_service import TaskService, queue_tasks, cancel_all_task_of
 from api.db.services.user_service import TenantService, UserTenantService
 
 from api.utils.api_utils import server_error_response, get_error_data_result, validate_request
@@ -288,7 +288,7 @@ def stop_parsing(tenant_id,dataset_id):
             return get_error_data_result(retmsg=f"You don't own the document {id}.")
         info = {"run": "2", "progress": 0}
         DocumentService.update_by_id(id, info)
-        # if str(req["run"]) == TaskStatus.CANCEL.value:
+        cancel_all_task_of(id)
         tenant_id = DocumentService.get_tenant_id(id)
         ELASTICSEARCH.deleteByQuery(
             Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
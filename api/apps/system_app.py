@@ -21,12 +21,12 @@ from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.settings import DATABASE_TYPE
 from api.utils.api_utils import get_json_result
 from api.versions import get_rag_version
-from rag.settings import SVR_QUEUE_NAME
 from rag.utils.es_conn import ELASTICSEARCH
 from rag.utils.storage_factory import STORAGE_IMPL, STORAGE_IMPL_TYPE
 from timeit import default_timer as timer
 
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_queue import TASK_QUEUE
 
 
 @manager.route('/version', methods=['GET'])
@@ -87,4 +87,7 @@ def status():
     except Exception as e:
         res["task_executor"] = {"status": "red", "error": str(e)}
 
+    info = TASK_QUEUE.info()
+    res["task_queue"] = info if info else {"status": "red", "error": "Can't get the task queue info."}
+
     return get_json_result(data=res)
@@ -32,7 +32,6 @@ from api.settings import stat_logger
 from api.utils import current_timestamp, get_format_time, get_uuid
 from api.utils.file_utils import get_project_base_directory
 from graphrag.mind_map_extractor import MindMapExtractor
-from rag.settings import SVR_QUEUE_NAME
 from rag.utils.es_conn import ELASTICSEARCH
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.nlp import search, rag_tokenizer
@@ -43,7 +42,7 @@ from api.db.db_models import Document
 from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db import StatusEnum
-from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_queue import TASK_QUEUE
 
 
 class DocumentService(CommonService):
@@ -175,14 +174,17 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_unfinished_docs(cls):
-        fields = [cls.model.id, cls.model.process_begin_at, cls.model.parser_config, cls.model.progress_msg, cls.model.run]
+    def get_unfinished_docs(cls, doc_ids=None):
+        fields = [cls.model.id, cls.model.process_begin_at, cls.model.parser_config, cls.model.progress_msg, cls.model.run,
+                  cls.model.progress]
         docs = cls.model.select(*fields) \
             .where(
                 cls.model.status == StatusEnum.VALID.value,
                 ~(cls.model.type == FileType.VIRTUAL.value),
                 cls.model.progress < 1,
                 cls.model.progress > 0)
+        if doc_ids is not None:
+            docs = docs.where(cls.model.id.in_(doc_ids))
         return list(docs.dicts())
 
     @classmethod
@@ -334,53 +336,75 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def update_progress(cls):
-        docs = cls.get_unfinished_docs()
+    def update_progress(cls, doc_ids=None):
+        """
+        Aggregates the progress of the tasks into their documents, all of the
+        unfinished ones or just `doc_ids`. Only documents whose progress or
+        status changed are written, but for the duration of running documents,
+        which is refreshed when progress events name them (`doc_ids`).
+        """
+        docs = cls.get_unfinished_docs(doc_ids)
+        if not docs:
+            return
+        tsks = {}
+        for t in Task.select().where(Task.doc_id.in_([d["id"] for d in docs])).order_by(Task.create_time):
+            tsks.setdefault(t.doc_id, []).append(t)
         for d in docs:
             try:
-                tsks = Task.query(doc_id=d["id"], order_by=Task.create_time)
-                if not tsks:
-                    continue
-                msg = []
-                prg = 0
-                finished = True
-                bad = 0
-                e, doc = DocumentService.get_by_id(d["id"])
-                status = doc.run#TaskStatus.RUNNING.value
-                for t in tsks:
-                    if 0 <= t.progress < 1:
-                        finished = False
-                    prg += t.progress if t.progress >= 0 else 0
-                    if t.progress_msg not in msg:
-                        msg.append(t.progress_msg)
-                    if t.progress == -1:
-                        bad += 1
-                prg /= len(tsks)
-                if finished and bad:
-                    prg = -1
-                    status = TaskStatus.FAIL.value
-                elif finished:
-                    if d["parser_config"].get("raptor", {}).get("use_raptor") and d["progress_msg"].lower().find(" raptor")<0:
-                        queue_raptor_tasks(d)
-                        prg *= 0.98
-                        msg.append("------ RAPTOR -------")
-                    else:
-                        status = TaskStatus.DONE.value
-
-                msg = "\n".join(msg)
-                info = {
-                    "process_duation": datetime.timestamp(
-                        datetime.now()) -
-                                       d["process_begin_at"].timestamp(),
-                    "run": status}
-                if prg != 0:
-                    info["progress"] = prg
-                if msg:
-                    info["progress_msg"] = msg
-                cls.update_by_id(d["id"], info)
+                info = cls._aggregate_progress(d, tsks.get(d["id"]), doc_ids is not None)
+                if info:
+                    cls.update_by_id(d["id"], info)
             except Exception as e:
                 stat_logger.error("fetch task exception:" + str(e))
 
+    @classmethod
+    @DB.connection_context()
+    def update_progress_by_tasks(cls, task_ids):
+        doc_ids = [t.doc_id for t in Task.select(Task.doc_id).where(Task.id.in_(task_ids)).distinct()]
+        if doc_ids:
+            cls.update_progress(doc_ids)
+
+    @classmethod
+    def _aggregate_progress(cls, d, tsks, refresh_duration=False):
+        if not tsks:
+            return
+        msg = []
+        prg = 0
+        finished = True
+        bad = 0
+        status = d["run"]
+        for t in tsks:
+            if 0 <= t.progress < 1:
+                finished = False
+            prg += t.progress if t.progress >= 0 else 0
+            if t.progress_msg not in msg:
+                msg.append(t.progress_msg)
+            if t.progress == -1:
+                bad += 1
+        prg /= len(tsks)
+        if finished and bad:
+            prg = -1
+            status = TaskStatus.FAIL.value
+        elif finished:
+            if d["parser_config"].get("raptor", {}).get("use_raptor") and d["progress_msg"].lower().find(" raptor")<0:
+                queue_raptor_tasks(d)
+                prg *= 0.98
+                msg.append("------ RAPTOR -------")
+            else:
+                status = TaskStatus.DONE.value
+
+        msg = "\n".join(msg)
+        info = {"run": status}
+        if prg != 0:
+            info["progress"] = prg
+        if msg:
+            info["progress_msg"] = msg
+        if all(d[k] == v for k, v in info.items()) and \
+                not (refresh_duration and status == TaskStatus.RUNNING.value):
+            return
+        info["process_duation"] = datetime.timestamp(datetime.now()) - d["process_begin_at"].timestamp()
+        return info
+
     @classmethod
     @DB.connection_context()
     def get_kb_doc_count(cls, kb_id):
@@ -413,7 +437,7 @@ def queue_raptor_tasks(doc):
     task = new_task()
     bulk_insert_into_db(Task, [task], True)
     task["type"] = "raptor"
-    assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=task), "Can't access Redis. Please check the Redis' status."
+    assert TASK_QUEUE.product(DocumentService.get_tenant_id(doc["id"]), [task]), "Can't access Redis. Please check the Redis' status."
 
 
 def doc_upload_and_parse(conversation_id, file_objs, user_id):
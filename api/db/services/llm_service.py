@@ -20,6 +20,7 @@ from api.db import LLMType
 from api.db.db_models import DB
 from api.db.db_models import LLMFactories, LLM, TenantLLM
 from api.db.services.common_service import CommonService
+from rag.utils.embedding_cache import EMBEDDING_CACHE
 
 
 class LLMFactoriesService(CommonService):
@@ -203,12 +204,18 @@ class LLMBundle(object):
             break
     
     def encode(self, texts: list, batch_size=32):
-        emd, used_tokens = self.mdl.encode(texts, batch_size)
+        cached_tokens = 0
+        if self.llm_name and EMBEDDING_CACHE.enabled():
+            emd, used_tokens, cached_tokens = EMBEDDING_CACHE.encode(
+                "{}:{}".format(self.tenant_id, self.llm_name), texts, lambda txts: self.mdl.encode(txts, batch_size))
+        else:
+            emd, used_tokens = self.mdl.encode(texts, batch_size)
+        # Texts served from the cache count in the document's tokens, not in the usage billed.
         if not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
                 "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
-        return emd, used_tokens
+        return emd, used_tokens + cached_tokens
 
     def encode_queries(self, query: str):
         emd, used_tokens = self.mdl.encode_queries(query)
@@ -13,7 +13,6 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
-import os
 import random
 
 from api.db.db_utils import bulk_insert_into_db
@@ -26,9 +25,11 @@ from api.db.services.common_service import CommonService
 from api.db.services.document_service import DocumentService
 from api.utils import current_timestamp, get_uuid
 from deepdoc.parser.excel_parser import RAGFlowExcelParser
-from rag.settings import SVR_QUEUE_NAME
+from rag.settings import SVR_QUEUE_PRIORITY_DOC_SIZE, INCREMENTAL_RUN_KEY, INCREMENTAL_RUN_EXP, INCREMENTAL_DOC_KEY, \
+    TASK_CANCEL_KEY, TASK_CANCEL_EXP, TASK_PROGRESS_EVENTS, TASK_PROGRESS_EVENTS_EXP
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_queue import TASK_QUEUE
 
 
 class TaskService(CommonService):
@@ -77,7 +78,10 @@ class TaskService(CommonService):
                          ).where(
             cls.model.id == docs[0]["id"]).execute()
 
-        if docs[0]["retry_count"] >= 3: return []
+        if docs[0]["retry_count"] >= 3:
+            # Failed here rather than by an executor, so the document is told here too.
+            REDIS_CONN.sadd(TASK_PROGRESS_EVENTS, [docs[0]["id"]], TASK_PROGRESS_EVENTS_EXP)
+            return []
 
         return docs
 
@@ -115,25 +119,34 @@ class TaskService(CommonService):
     @classmethod
     @DB.connection_context()
     def update_progress(cls, id, info):
-        if os.environ.get("MACOS"):
-            if info["progress_msg"]:
-                cls.model.update(progress_msg=cls.model.progress_msg + "\n" + info["progress_msg"]).where(
-                    cls.model.id == id).execute()
-            if "progress" in info:
-                cls.model.update(progress=info["progress"]).where(
-                    cls.model.id == id).execute()
-            return
-
-        with DB.lock("update_progress", -1):
-            if info["progress_msg"]:
-                cls.model.update(progress_msg=cls.model.progress_msg + "\n" + info["progress_msg"]).where(
-                    cls.model.id == id).execute()
-            if "progress" in info:
-                cls.model.update(progress=info["progress"]).where(
-                    cls.model.id == id).execute()
-
-
-def queue_tasks(doc: dict, bucket: str, name: str):
+        # A single-row update by primary key, no global lock is needed.
+        fields = {}
+        if info["progress_msg"]:
+            fields["progress_msg"] = cls.model.progress_msg + "\n" + info["progress_msg"]
+        if "progress" in info:
+            fields["progress"] = info["progress"]
+        if fields:
+            cls.model.update(**fields).where(cls.model.id == id).execute()
+            # Tells the server which document has to be re-aggregated.
+            REDIS_CONN.sadd(TASK_PROGRESS_EVENTS, [id], TASK_PROGRESS_EVENTS_EXP)
+
+
+def cancel_all_task_of(doc_id):
+    """Pushes the cancel signal to the executors running the tasks of the document."""
+    for t in TaskService.query(doc_id=doc_id):
+        REDIS_CONN.set(TASK_CANCEL_KEY.format(t.id), "x", TASK_CANCEL_EXP)
+
+
+def has_canceled(task_id):
+    return bool(REDIS_CONN.exist(TASK_CANCEL_KEY.format(task_id)))
+
+
+def incremental_pending(doc_id):
+    """Whether an incremental run of the document has not removed its stale chunks yet."""
+    return bool(REDIS_CONN.get(INCREMENTAL_DOC_KEY.format(doc_id)))
+
+
+def queue_tasks(doc: dict, bucket: str, name: str, incremental=False):
     def new_task():
         return {
             "id": get_uuid(),
@@ -175,5 +188,19 @@ def queue_tasks(doc: dict, bucket: str, name: str):
     bulk_insert_into_db(Task, tsks, True)
     DocumentService.begin2parse(doc["id"])
 
-    for t in tsks:
-        assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=t), "Can't access Redis. Please check the Redis' status."
+    if incremental:
+        # Tasks only index the chunks missing from the index; the last one to finish
+        # removes the chunks none of them produced.
+        run_id = get_uuid()
+        REDIS_CONN.set(INCREMENTAL_RUN_KEY.format(run_id, "tasks"), len(tsks), INCREMENTAL_RUN_EXP)
+        REDIS_CONN.set(INCREMENTAL_DOC_KEY.format(doc["id"]), run_id, INCREMENTAL_RUN_EXP)
+        for t in tsks:
+            t["incremental"] = run_id
+    else:
+        # A full re-parse replaces every chunk, so an earlier run must not clean up after it.
+        REDIS_CONN.delete(INCREMENTAL_DOC_KEY.format(doc["id"]))
+
+    # Small single-task documents take the priority lane of their tenant.
+    priority = len(tsks) == 1 and doc["size"] <= SVR_QUEUE_PRIORITY_DOC_SIZE
+    assert TASK_QUEUE.product(DocumentService.get_tenant_id(doc["id"]), tsks, priority), \
+        "Can't access Redis. Please check the Redis' status."
@@ -34,13 +34,26 @@ from api import utils
 from api.db.db_models import init_database_tables as init_web_db
 from api.db.init_data import init_web_data
 from api.versions import get_versions
+from rag.settings import TASK_PROGRESS_EVENTS, DOC_PROGRESS_RECONCILE_INTERVAL
+from rag.utils.redis_conn import REDIS_CONN
 
 
 def update_progress():
+    # Documents are re-aggregated when the executors report progress of their
+    # tasks. The periodic full scan only catches events which got lost.
+    last_scan = 0
     while True:
         time.sleep(1)
         try:
-            DocumentService.update_progress()
+            if not REDIS_CONN.is_alive() or time.time() - last_scan > DOC_PROGRESS_RECONCILE_INTERVAL:
+                last_scan = time.time()
+                DocumentService.update_progress()
+                continue
+            while True:
+                task_ids = REDIS_CONN.spop(TASK_PROGRESS_EVENTS, 1024)
+                if not task_ids:
+                    break
+                DocumentService.update_progress_by_tasks(list(task_ids))
         except Exception as e:
             stat_logger.error("update_progress exception:" + str(e))
 
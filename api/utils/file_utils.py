@@ -19,13 +19,13 @@ import os
 import re
 from io import BytesIO
 
-import pdfplumber
 from PIL import Image
 from cachetools import LRUCache, cached
 from ruamel.yaml import YAML
 
 from api.db import FileType
 from api.contants import IMG_BASE64_PREFIX
+from rag.utils.pdf_render import PdfRenderer
 
 PROJECT_BASE = os.getenv("RAG_PROJECT_BASE") or os.getenv("RAG_DEPLOY_BASE")
 RAG_BASE = os.getenv("RAG_BASE")
@@ -172,9 +172,11 @@ def filename_type(filename):
 def thumbnail_img(filename, blob):
     filename = filename.lower()
     if re.match(r".*\.pdf$", filename):
-        pdf = pdfplumber.open(BytesIO(blob))
+        renderer = PdfRenderer(blob)
         buffered = BytesIO()
-        pdf.pages[0].to_image(resolution=32).annotated.save(buffered, format="png")
+        # Oversized pages (posters, drawings) are kept to a thumbnail's worth of pixels.
+        renderer.image(0, resolution=32, max_pixels=256 * 256).save(buffered, format="png")
+        renderer.close()
         return buffered.getvalue()
 
     if re.match(r".*\.(jpg|jpeg|png|tif|gif|icon|ico|webp)$", filename):
@@ -19,77 +19,105 @@ from rag.nlp import find_codec
 
 
 class RAGFlowExcelParser:
-    def html(self, fnm, chunk_rows=256):
-        if isinstance(fnm, str):
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(fnm))
+    @staticmethod
+    def _load_workbook(fnm):
+        """
+        Opens `fnm`, a path or the file's bytes, read-only: rows are parsed from
+        the archive as they are iterated instead of all being loaded up front.
+        """
+        return load_workbook(fnm if isinstance(fnm, str) else BytesIO(fnm), read_only=True)
 
-        tb_chunks = []
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows: continue
+    @staticmethod
+    def _sheet(wb, sheetname):
+        """
+        The sheet of a read-only workbook. Its rows are bounded by the sheet's
+        <dimension>, which some writers leave at "A1" or narrower than the rows
+        whatever the content. Such a dimension is dropped, so that all the rows
+        are read and counted; one that holds the first row is trusted.
+        """
+        ws = wb[sheetname]
+        if ws.max_row is None:
+            return ws
+        if ws.max_row == 1 and ws.max_column == 1:
+            ws.reset_dimensions()
+            return ws
+        max_column = ws.max_column
+        ws.reset_dimensions()
+        first = next(ws.iter_rows(max_row=1, values_only=True), ())
+        if len(first) <= max_column:
+            # Read back from the sheet, only its first row was parsed.
+            ws._get_size()
+        return ws
 
-            tb_rows_0 = "<tr>"
-            for t in list(rows[0]):
-                tb_rows_0 += f"<th>{t.value}</th>"
-            tb_rows_0 += "</tr>"
+    @staticmethod
+    def _sheet_row_count(ws):
+        # The <dimension> of the sheet when it has one, so no cell is parsed.
+        if ws.max_row is not None:
+            return ws.max_row
+        return sum(1 for _ in ws.iter_rows(values_only=True))
 
-            for chunk_i in range((len(rows) - 1) // chunk_rows + 1):
-                tb = ""
-                tb += f"<table><caption>{sheetname}</caption>"
-                tb += tb_rows_0
-                for r in list(rows[1 + chunk_i * chunk_rows:1 + (chunk_i + 1) * chunk_rows]):
-                    tb += "<tr>"
-                    for i, c in enumerate(r):
-                        if c.value is None:
-                            tb += "<td></td>"
-                        else:
-                            tb += f"<td>{c.value}</td>"
-                    tb += "</tr>"
-                tb += "</table>\n"
-                tb_chunks.append(tb)
+    def html(self, fnm, chunk_rows=256):
+        wb = self._load_workbook(fnm)
+        tb_chunks = []
+        try:
+            for sheetname in wb.sheetnames:
+                rows = self._sheet(wb, sheetname).iter_rows(values_only=True)
+                header = next(rows, None)
+                if header is None: continue
+
+                tb_rows_0 = "<tr>" + "".join([f"<th>{v}</th>" for v in header]) + "</tr>"
+                tb, n = [], 0
+                for r in rows:
+                    tb.append("<tr>" + "".join(["<td></td>" if v is None else f"<td>{v}</td>" for v in r]) + "</tr>")
+                    if len(tb) == chunk_rows:
+                        tb_chunks.append(f"<table><caption>{sheetname}</caption>" + tb_rows_0 + "".join(tb) + "</table>\n")
+                        tb, n = [], n + 1
+                # A sheet with only the header still gets its table.
+                if tb or not n:
+                    tb_chunks.append(f"<table><caption>{sheetname}</caption>" + tb_rows_0 + "".join(tb) + "</table>\n")
+        finally:
+            wb.close()
 
         return tb_chunks
 
     def __call__(self, fnm):
-        if isinstance(fnm, str):
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(fnm))
+        wb = self._load_workbook(fnm)
         res = []
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:continue
-            ti = list(rows[0])
-            for r in list(rows[1:]):
-                l = []
-                for i, c in enumerate(r):
-                    if not c.value:
-                        continue
-                    t = str(ti[i].value) if i < len(ti) else ""
-                    t += ("：" if t else "") + str(c.value)
-                    l.append(t)
-                l = "; ".join(l)
-                if sheetname.lower().find("sheet") < 0:
-                    l += " ——" + sheetname
-                res.append(l)
+        try:
+            for sheetname in wb.sheetnames:
+                rows = self._sheet(wb, sheetname).iter_rows(values_only=True)
+                ti = next(rows, None)
+                if ti is None:continue
+                for r in rows:
+                    l = []
+                    for i, v in enumerate(r):
+                        if not v:
+                            continue
+                        t = str(ti[i]) if i < len(ti) else ""
+                        t += ("：" if t else "") + str(v)
+                        l.append(t)
+                    l = "; ".join(l)
+                    if sheetname.lower().find("sheet") < 0:
+                        l += " ——" + sheetname
+                    res.append(l)
+        finally:
+            wb.close()
         return res
 
     @staticmethod
     def row_number(fnm, binary):
         if fnm.split(".")[-1].lower().find("xls") >= 0:
-            wb = load_workbook(BytesIO(binary))
-            total = 0
-            for sheetname in wb.sheetnames:
-                ws = wb[sheetname]
-                total += len(list(ws.rows))
-                return total
+            wb = RAGFlowExcelParser._load_workbook(binary)
+            try:
+                return sum([RAGFlowExcelParser._sheet_row_count(RAGFlowExcelParser._sheet(wb, sheetname)) for sheetname in wb.sheetnames])
+            finally:
+                wb.close()
 
         if fnm.split(".")[-1].lower() in ["csv", "txt"]:
             encoding = find_codec(binary)
+            if "\n".encode(encoding) == b"\n":
+                # A newline is a lone 0x0a byte in ASCII compatible encodings, so no need to decode.
+                return binary.count(b"\n") + 1
             txt = binary.decode(encoding, errors="ignore")
             return len(txt.split("\n"))
 
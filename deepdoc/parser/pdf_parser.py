@@ -11,8 +11,12 @@
 #  limitations under the License.
 #
 
+import math
 import os
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import xgboost as xgb
 from io import BytesIO
@@ -26,15 +30,125 @@ from pypdf import PdfReader as pdf2_read
 
 from api.settings import LIGHTEN
 from api.utils.file_utils import get_project_base_directory
-from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
+from deepdoc.vision import OCR, Recognizer, BoxIndex, LayoutRecognizer, TableStructureRecognizer
 from rag.nlp import rag_tokenizer
+from rag.utils.deepdoc_cache import DEEPDOC_CACHE
+from rag.utils.pdf_render import PdfRenderer
 from copy import deepcopy
 from huggingface_hub import snapshot_download
 
 logging.getLogger("pdfminer").setLevel(logging.WARNING)
 
+UPDOWN_CNT_MDL = None
+
+
+def load_updown_concat_model():
+    """
+    The up/down concatenation booster is read-only once loaded, so it is shared by
+    every parser of the process (and by forked task executors, copy-on-write).
+    """
+    global UPDOWN_CNT_MDL
+    if UPDOWN_CNT_MDL is not None:
+        return UPDOWN_CNT_MDL
+
+    mdl = xgb.Booster()
+    if not LIGHTEN:
+        try:
+            import torch
+            if torch.cuda.is_available():
+                mdl.set_param({"device": "cuda"})
+        except Exception as e:
+            logging.error(str(e))
+    try:
+        model_dir = os.path.join(
+            get_project_base_directory(),
+            "rag/res/deepdoc")
+        mdl.load_model(os.path.join(
+            model_dir, "updown_concat_xgb.model"))
+    except Exception as e:
+        model_dir = snapshot_download(
+            repo_id="InfiniFlow/text_concat_xgb_v1.0",
+            local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
+            local_dir_use_symlinks=False)
+        mdl.load_model(os.path.join(
+            model_dir, "updown_concat_xgb.model"))
+    UPDOWN_CNT_MDL = mdl
+    return UPDOWN_CNT_MDL
+
+
+class PdfPageImages(object):
+    """
+    `count` page images, made on demand by `render(i)`.
+
+    Only the `window` most recently used pages are kept, so memory does not grow
+    with the number of pages; anything else is rendered again when it is
+    cropped. Items behave like the images they stand for.
+    """
+
+    def __init__(self, render, count, window, sizes=None):
+        self.render = render
+        self.count = count
+        self.window = max(1, window)
+        self.cache = OrderedDict()
+        self.sizes = dict(enumerate(sizes or []))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return _LazyPageImage(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def image(self, i):
+        with self.lock:
+            if i in self.cache:
+                self.cache.move_to_end(i)
+                return self.cache[i]
+            img = self.render(i)
+            self.sizes[i] = img.size
+            self.cache[i] = img
+            while len(self.cache) > self.window:
+                self.cache.popitem(last=False)
+            return img
+
+    def size(self, i):
+        if i not in self.sizes:
+            self.image(i)
+        return self.sizes[i]
+
+
+class _LazyPageImage(object):
+    def __init__(self, pages, i):
+        self.pages = pages
+        self.i = i
+
+    @property
+    def size(self):
+        return self.pages.size(self.i)
+
+    def crop(self, box):
+        return self.pages.image(self.i).crop(box)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.pages.image(self.i), dtype=dtype)
+
+    def __getattr__(self, name):
+        return getattr(self.pages.image(self.i), name)
+
 
 class RAGFlowPdfParser:
+    CHAR_FIELDS = ["text", "x0", "x1", "top", "bottom", "width", "height", "fontname", "size"]
+
     def __init__(self):
         self.ocr = OCR()
         if hasattr(self, "model_speciess"):
@@ -43,27 +157,7 @@ class RAGFlowPdfParser:
             self.layouter = LayoutRecognizer("layout")
         self.tbl_det = TableStructureRecognizer()
 
-        self.updown_cnt_mdl = xgb.Booster()
-        if not LIGHTEN:
-            try:
-                import torch
-                if torch.cuda.is_available():
-                    self.updown_cnt_mdl.set_param({"device": "cuda"})
-            except Exception as e:
-                logging.error(str(e))
-        try:
-            model_dir = os.path.join(
-                get_project_base_directory(),
-                "rag/res/deepdoc")
-            self.updown_cnt_mdl.load_model(os.path.join(
-                model_dir, "updown_concat_xgb.model"))
-        except Exception as e:
-            model_dir = snapshot_download(
-                repo_id="InfiniFlow/text_concat_xgb_v1.0",
-                local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
-                local_dir_use_symlinks=False)
-            self.updown_cnt_mdl.load_model(os.path.join(
-                model_dir, "updown_concat_xgb.model"))
+        self.updown_cnt_mdl = load_updown_concat_model()
 
         self.page_from = 0
         """
@@ -106,18 +200,19 @@ class RAGFlowPdfParser:
         ]
         return any([re.match(p, b["text"]) for p in proj_patt])
 
-    def _updown_concat_features(self, up, down):
+    def _updown_concat_features(self, up, down, tokenize=None):
+        tokenize = tokenize or rag_tokenizer.tokenize
         w = max(self.__char_width(up), self.__char_width(down))
         h = max(self.__height(up), self.__height(down))
         y_dis = self._y_dis(up, down)
         LEN = 6
-        tks_down = rag_tokenizer.tokenize(down["text"][:LEN]).split(" ")
-        tks_up = rag_tokenizer.tokenize(up["text"][-LEN:]).split(" ")
+        tks_down = tokenize(down["text"][:LEN]).split(" ")
+        tks_up = tokenize(up["text"][-LEN:]).split(" ")
         tks_all = up["text"][-LEN:].strip() \
                   + (" " if re.match(r"[a-zA-Z0-9]+",
                                      up["text"][-1] + down["text"][0]) else "") \
                   + down["text"][:LEN].strip()
-        tks_all = rag_tokenizer.tokenize(tks_all).split(" ")
+        tks_all = tokenize(tks_all).split(" ")
         fea = [
             up.get("R", -1) == down.get("R", -1),
             y_dis / h,
@@ -186,7 +281,21 @@ class RAGFlowPdfParser:
                     return False
         return True
 
+    @staticmethod
+    def _crop_array(img, box):
+        """The pixels of `box` in a page image, without copying them when the page is an array."""
+        if hasattr(img, "view"):
+            return img.view(box)
+        return np.asarray(img.crop(box))
+
     def _table_transformer_job(self, ZM):
+        ZM = self._zm(ZM)
+        if self._load_stage("table", ["boxes", "tb_cpns"], ZM):
+            return
+        self.__table_transformer_job(ZM)
+        self._save_stage(["boxes", "tb_cpns"])
+
+    def __table_transformer_job(self, ZM):
         logging.info("Table processing...")
         imgs, pos = [], []
         tbcnt = [0]
@@ -206,7 +315,7 @@ class RAGFlowPdfParser:
                 right *= ZM
                 bott *= ZM
                 pos.append((left, top))
-                imgs.append(self.page_images[p].crop((left, top, right, bott)))
+                imgs.append(self._crop_array(self.page_images[p], (left, top, right, bott)))
 
         assert len(self.page_images) == len(tbcnt) - 1
         if not imgs:
@@ -232,10 +341,12 @@ class RAGFlowPdfParser:
                     pg.append(it)
             self.tb_cpns.extend(pg)
 
+        boxes_index = BoxIndex(self.boxes)
+
         def gather(kwd, fzy=10, ption=0.6):
             eles = Recognizer.sort_Y_firstly(
                 [r for r in self.tb_cpns if re.match(kwd, r["label"])], fzy)
-            eles = Recognizer.layouts_cleanup(self.boxes, eles, 5, ption)
+            eles = Recognizer.layouts_cleanup(self.boxes, eles, 5, ption, boxes_index)
             return Recognizer.sort_Y_firstly(eles, 0)
 
         # add R,H,C,SP tag to boxes within table layout
@@ -244,18 +355,20 @@ class RAGFlowPdfParser:
         spans = gather(r".*spanning")
         clmns = sorted([r for r in self.tb_cpns if re.match(
             r"table column$", r["label"])], key=lambda x: (x["pn"], x["layoutno"], x["x0"]))
-        clmns = Recognizer.layouts_cleanup(self.boxes, clmns, 5, 0.5)
+        clmns = Recognizer.layouts_cleanup(self.boxes, clmns, 5, 0.5, boxes_index)
+        headers_index, rows_index, spans_index, clmns_index = \
+            BoxIndex(headers), BoxIndex(rows), BoxIndex(spans), BoxIndex(clmns)
         for b in self.boxes:
             if b.get("layout_type", "") != "table":
                 continue
-            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3)
+            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3, index=rows_index)
             if ii is not None:
                 b["R"] = ii
                 b["R_top"] = rows[ii]["top"]
                 b["R_bott"] = rows[ii]["bottom"]
 
             ii = Recognizer.find_overlapped_with_threashold(
-                b, headers, thr=0.3)
+                b, headers, thr=0.3, index=headers_index)
             if ii is not None:
                 b["H_top"] = headers[ii]["top"]
                 b["H_bott"] = headers[ii]["bottom"]
@@ -263,13 +376,13 @@ class RAGFlowPdfParser:
                 b["H_right"] = headers[ii]["x1"]
                 b["H"] = ii
 
-            ii = Recognizer.find_horizontally_tightest_fit(b, clmns)
+            ii = Recognizer.find_horizontally_tightest_fit(b, clmns, index=clmns_index)
             if ii is not None:
                 b["C"] = ii
                 b["C_left"] = clmns[ii]["x0"]
                 b["C_right"] = clmns[ii]["x1"]
 
-            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3)
+            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3, index=spans_index)
             if ii is not None:
                 b["H_top"] = spans[ii]["top"]
                 b["H_bott"] = spans[ii]["bottom"]
@@ -278,30 +391,34 @@ class RAGFlowPdfParser:
                 b["SP"] = ii
 
     def __ocr(self, pagenum, img, chars, ZM=3):
-        bxs = self.ocr.detect(np.array(img))
+        # Pages are independent here, so this may run for several pages at once:
+        # the chars left out of the boxes are returned rather than kept on self.
+        img = np.asarray(img)
+        bxs = self.ocr.detect(img)
         if not bxs:
-            self.boxes.append([])
-            return
+            return [], []
         bxs = [(line[0], line[1][0]) for line in bxs]
         bxs = Recognizer.sort_Y_firstly(
             [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
               "top": b[0][1] / ZM, "text": "", "txt": t,
               "bottom": b[-1][1] / ZM,
               "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
-            self.mean_height[-1] / 3
+            self.mean_height[pagenum - 1] / 3
         )
-        
+
         # merge chars in the same rect
+        index = BoxIndex(bxs)
+        lefted_chars = []
         for c in Recognizer.sort_Y_firstly(
                 chars, self.mean_height[pagenum - 1] // 4):
-            ii = Recognizer.find_overlapped(c, bxs)
+            ii = Recognizer.find_overlapped(c, bxs, index=index)
             if ii is None:
-                self.lefted_chars.append(c)
+                lefted_chars.append(c)
                 continue
             ch = c["bottom"] - c["top"]
             bh = bxs[ii]["bottom"] - bxs[ii]["top"]
             if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
-                self.lefted_chars.append(c)
+                lefted_chars.append(c)
                 continue
             if c["text"] == " " and bxs[ii]["text"]:
                 if re.match(r"[0-9a-zA-Zа-яА-Я,.?;:!%%]", bxs[ii]["text"][-1]):
@@ -309,30 +426,113 @@ class RAGFlowPdfParser:
             else:
                 bxs[ii]["text"] += c["text"]
 
+        # Boxes without embedded chars are recognized in one batched call.
+        empty = [b for b in bxs if not b["text"]]
+        boxes = []
+        for b in empty:
+            left, right, top, bott = b["x0"] * ZM, b["x1"] * \
+                                     ZM, b["top"] * ZM, b["bottom"] * ZM
+            boxes.append(np.array([[left, top], [right, top], [right, bott], [left, bott]],
+                                  dtype=np.float32))
+        for b, txt in zip(empty, self.ocr.recognize_batch(img, boxes)):
+            b["text"] = txt
         for b in bxs:
-            if not b["text"]:
-                left, right, top, bott = b["x0"] * ZM, b["x1"] * \
-                                         ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["text"] = self.ocr.recognize(np.array(img),
-                                               np.array([[left, top], [right, top], [right, bott], [left, bott]],
-                                                        dtype=np.float32))
             del b["txt"]
         bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[-1] == 0:
-            self.mean_height[-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
-        self.boxes.append(bxs)
+        if self.mean_height[pagenum - 1] == 0:
+            self.mean_height[pagenum - 1] = np.median([b["bottom"] - b["top"]
+                                                       for b in bxs])
+        return bxs, lefted_chars
+
+    @staticmethod
+    def _space_chars(chars):
+        j = 0
+        while j + 1 < len(chars):
+            if chars[j]["text"] and chars[j + 1]["text"] \
+                    and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
+                    and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
+                                                                   chars[j]["width"]) / 2:
+                chars[j]["text"] += " "
+            j += 1
+
+    @staticmethod
+    def _has_text_layer(chars):
+        # Enough chars, and hardly any which did not map to unicode.
+        if len(chars) < 32:
+            return False
+        bad = len([c for c in chars if c["text"].startswith("(cid:") or c["text"] == "\ufffd"])
+        return bad < len(chars) * 0.05
+
+    def __text_layer(self, pagenum, img, chars, ZM=3):
+        """
+        Line boxes made of the chars of a born-digital page. Only the images
+        embedded in the page go through OCR.
+        """
+        mh = self.mean_height[pagenum - 1] or np.median([c["bottom"] - c["top"] for c in chars])
+        bxs = []
+        for c in Recognizer.sort_Y_firstly(chars, mh / 4):
+            h = max(c["bottom"] - c["top"], 1)
+            b = bxs[-1] if bxs else None
+            if b and min(b["bottom"], c["bottom"]) - max(b["top"], c["top"]) >= min(h, b["bottom"] - b["top"]) / 2 \
+                    and -h / 2 <= c["x0"] - b["x1"] <= h:
+                b["text"] += c["text"]
+                b["x1"] = max(b["x1"], c["x1"])
+                b["top"] = min(b["top"], c["top"])
+                b["bottom"] = max(b["bottom"], c["bottom"])
+                continue
+            if not c["text"].strip():
+                continue
+            bxs.append({"x0": c["x0"], "x1": c["x1"], "top": c["top"], "bottom": c["bottom"],
+                        "text": c["text"], "page_number": pagenum})
+        for b in bxs:
+            b["text"] = b["text"].strip()
+
+        arr = None
+        for r in self.page_figures[pagenum - 1]:
+            if (r["x1"] - r["x0"]) * (r["bottom"] - r["top"]) < 32 * 32:
+                continue
+            if arr is None:
+                arr = np.asarray(img)
+            left, top = max(0, int(r["x0"] * ZM)), max(0, int(r["top"] * ZM))
+            crop = arr[top:int(r["bottom"] * ZM), left:int(r["x1"] * ZM)]
+            if not crop.size:
+                continue
+            res = self.ocr(crop)
+            for box, (txt, _) in (res if isinstance(res, list) else []):
+                if not txt:
+                    continue
+                bxs.append({"x0": (left + box[0][0]) / ZM, "x1": (left + box[1][0]) / ZM,
+                            "top": (top + box[0][1]) / ZM, "bottom": (top + box[-1][1]) / ZM,
+                            "text": txt, "page_number": pagenum})
+
+        bxs = Recognizer.sort_Y_firstly([b for b in bxs if b["text"]], mh / 3)
+        if self.mean_height[pagenum - 1] == 0:
+            self.mean_height[pagenum - 1] = mh
+        return bxs, []
+
+    @staticmethod
+    def page_workers():
+        """Pages OCR'd and layout-analyzed concurrently, DEEPDOC_PAGE_WORKERS (1 by default)."""
+        return max(1, int(os.environ.get("DEEPDOC_PAGE_WORKERS", 1)))
 
     def _layouts_rec(self, ZM, drop=True):
+        ZM = self._zm(ZM)
+        if self._load_stage("layout", ["boxes", "page_layout"], ZM, drop, getattr(self, "model_speciess", "")):
+            return
         assert len(self.page_images) == len(self.boxes)
+        batch_size = self.page_images.window if isinstance(self.page_images, PdfPageImages) else 16
+        workers = self.page_workers()
+        if workers > 1:
+            batch_size = min(batch_size, max(1, math.ceil(len(self.page_images) / workers)))
         self.boxes, self.page_layout = self.layouter(
-            self.page_images, self.boxes, ZM, drop=drop)
+            self.page_images, self.boxes, ZM, batch_size=batch_size, drop=drop, workers=workers)
         # cumlative Y
         for i in range(len(self.boxes)):
             self.boxes[i]["top"] += \
                 self.page_cum_height[self.boxes[i]["page_number"] - 1]
             self.boxes[i]["bottom"] += \
                 self.page_cum_height[self.boxes[i]["page_number"] - 1]
+        self._save_stage(["boxes", "page_layout"])
 
     def _text_merge(self):
         # merge adjusted boxes
@@ -460,6 +660,76 @@ class RAGFlowPdfParser:
 
         # concat between rows
         boxes = deepcopy(self.boxes)
+
+        def candidate(up, down):
+            # None: neither `down` nor any box after it joins `up`; False: `down` does not.
+            ydis = self._y_dis(up, down)
+            smpg = up["page_number"] == down["page_number"]
+            mh = self.mean_height[up["page_number"] - 1]
+            mw = self.mean_width[up["page_number"] - 1]
+            if smpg and ydis > mh * 4:
+                return
+            if not smpg and ydis > mh * 16:
+                return
+            if not concat_between_pages and down["page_number"] > up["page_number"]:
+                return
+
+            if up.get("R", "") != down.get(
+                    "R", "") and up["text"][-1] != "，":
+                return False
+
+            if re.match(r"[0-9]{2,3}/[0-9]{3}$", up["text"]) \
+                    or re.match(r"[0-9]{2,3}/[0-9]{3}$", down["text"]) \
+                    or not down["text"].strip():
+                return False
+
+            if not down["text"].strip() or not up["text"].strip():
+                return False
+
+            if up["x1"] < down["x0"] - 10 * \
+                    mw or up["x0"] > down["x1"] + 10 * mw:
+                return False
+            return True
+
+        # Pairs the DFS may ask the model about are scored up front with one
+        # prediction; boxes are not modified until the blocks are merged.
+        tks_cache = {}
+
+        def tokenize(txt):
+            if txt not in tks_cache:
+                tks_cache[txt] = rag_tokenizer.tokenize(txt)
+            return tks_cache[txt]
+
+        scores, pairs = {}, []
+        for a, up in enumerate(boxes):
+            # Text boxes join the next 5 boxes on their layout alone.
+            st = 5 if up.get("layout_type") == "text" else 0
+            for down in boxes[a + 1 + st: a + 25]:
+                c = candidate(up, down)
+                if c is None:
+                    break
+                if c:
+                    pairs.append((up, down))
+        feas = []
+        for up, down in pairs:
+            try:
+                feas.append(self._updown_concat_features(up, down, tokenize))
+            except Exception:
+                # Left to score(), in case the DFS really gets to this pair.
+                feas.append(None)
+        pairs = [p for p, f in zip(pairs, feas) if f is not None]
+        feas = [f for f in feas if f is not None]
+        if feas:
+            for (up, down), s in zip(pairs, self.updown_cnt_mdl.predict(xgb.DMatrix(feas))):
+                scores[(id(up), id(down))] = s
+
+        def score(up, down):
+            k = (id(up), id(down))
+            if k not in scores:
+                fea = self._updown_concat_features(up, down, tokenize)
+                scores[k] = self.updown_cnt_mdl.predict(xgb.DMatrix([fea]))[0]
+            return scores[k]
+
         blocks = []
         while boxes:
             chunks = []
@@ -468,35 +738,11 @@ class RAGFlowPdfParser:
                 chunks.append(up)
                 i = dp
                 while i < min(dp + 12, len(boxes)):
-                    ydis = self._y_dis(up, boxes[i])
-                    smpg = up["page_number"] == boxes[i]["page_number"]
-                    mh = self.mean_height[up["page_number"] - 1]
-                    mw = self.mean_width[up["page_number"] - 1]
-                    if smpg and ydis > mh * 4:
-                        break
-                    if not smpg and ydis > mh * 16:
-                        break
                     down = boxes[i]
-                    if not concat_between_pages and down["page_number"] > up["page_number"]:
+                    c = candidate(up, down)
+                    if c is None:
                         break
-
-                    if up.get("R", "") != down.get(
-                            "R", "") and up["text"][-1] != "，":
-                        i += 1
-                        continue
-
-                    if re.match(r"[0-9]{2,3}/[0-9]{3}$", up["text"]) \
-                            or re.match(r"[0-9]{2,3}/[0-9]{3}$", down["text"]) \
-                            or not down["text"].strip():
-                        i += 1
-                        continue
-
-                    if not down["text"].strip() or not up["text"].strip():
-                        i += 1
-                        continue
-
-                    if up["x1"] < down["x0"] - 10 * \
-                            mw or up["x0"] > down["x1"] + 10 * mw:
+                    if not c:
                         i += 1
                         continue
 
@@ -509,9 +755,7 @@ class RAGFlowPdfParser:
                         i += 1
                         continue
 
-                    fea = self._updown_concat_features(up, down)
-                    if self.updown_cnt_mdl.predict(
-                            xgb.DMatrix([fea]))[0] <= 0.5:
+                    if score(up, down) <= 0.5:
                         i += 1
                         continue
                     dfs(down, i + 1)
@@ -627,6 +871,7 @@ class RAGFlowPdfParser:
 
     def _extract_table_figure(self, need_image, ZM,
                               return_html, need_position):
+        ZM = self._zm(ZM)
         tables = {}
         figures = {}
         # extract figure and table boxes
@@ -844,6 +1089,7 @@ class RAGFlowPdfParser:
         return
 
     def _line_tag(self, bx, ZM):
+        ZM = self._zm(ZM)
         pn = [bx["page_number"]]
         top = bx["top"] - self.page_cum_height[pn[0] - 1]
         bott = bx["bottom"] - self.page_cum_height[pn[0] - 1]
@@ -860,6 +1106,7 @@ class RAGFlowPdfParser:
                     bx["x0"], bx["x1"], top, bott)
 
     def __filterout_scraps(self, boxes, ZM):
+        ZM = self._zm(ZM)
 
         def width(b):
             return b["x1"] - b["x0"]
@@ -941,8 +1188,75 @@ class RAGFlowPdfParser:
         except Exception as e:
             logging.error(str(e))
 
+    def _page_renderer(self, fnm, zoomin, page_sizes=()):
+        """
+        (render, zoomin): render(i) is the image of page i, rendered at `zoomin`
+        pixels per point, lowered if needed so the largest of `page_sizes` has
+        about DEEPDOC_RENDER_MAX_PIXELS pixels at most (4096x4096 by default, 0
+        for no cap). The zoom is one for the whole document, as boxes go between pixels
+        and points with it.
+
+        Pages are rendered by pdfium into arrays, gray with
+        DEEPDOC_RENDER_GRAYSCALE=1; DEEPDOC_RENDERER=pdfplumber goes back to
+        pdfplumber's PIL images.
+        """
+        max_pixels = int(os.environ.get("DEEPDOC_RENDER_MAX_PIXELS", 4096 * 4096))
+        area = max([w * h for w, h in page_sizes] + [0])
+        if max_pixels > 0 and area * zoomin * zoomin > max_pixels:
+            zoomin = math.sqrt(max_pixels / area)
+            logging.info("Pages rendered at {:.2f} pixels per point to stay within {} pixels.".format(zoomin, max_pixels))
+        resolution = 72 * zoomin
+        if os.environ.get("DEEPDOC_RENDERER", "pdfium").lower() == "pdfplumber":
+            pdf = pdfplumber.open(fnm) if isinstance(fnm, str) else pdfplumber.open(BytesIO(fnm))
+            return lambda i: pdf.pages[i].to_image(resolution=resolution).annotated, zoomin
+        renderer = PdfRenderer(fnm)
+        grayscale = os.environ.get("DEEPDOC_RENDER_GRAYSCALE", "0").lower() in ["1", "true"]
+        return lambda i: renderer.image(i, resolution, grayscale=grayscale), zoomin
+
+    def _zm(self, ZM):
+        """The zoom pages were rendered at, which may be below the `ZM` asked for."""
+        return getattr(self, "render_zoomin", None) or ZM
+
+    def _load_stage(self, stage, attrs, *args):
+        """
+        Moves the deepdoc cache key on to `stage`, run with `args`, and restores
+        `attrs` from its entry if there is one.
+        """
+        if not getattr(self, "cache_key", None):
+            return False
+        self.cache_key = DEEPDOC_CACHE.chain(self.cache_key, stage, *args)
+        state = DEEPDOC_CACHE.get(self.cache_key)
+        if not state:
+            return False
+        for k in attrs:
+            setattr(self, k, state[k])
+        logging.info("Deepdoc {} results loaded from cache.".format(stage))
+        return True
+
+    def _save_stage(self, attrs):
+        if getattr(self, "cache_key", None):
+            DEEPDOC_CACHE.put(self.cache_key, {k: getattr(self, k) for k in attrs})
+
+    def __cached_images(self, fnm, page_from, state):
+        for k in ["boxes", "mean_height", "mean_width", "is_english", "total_page", "outlines"]:
+            setattr(self, k, state[k])
+        self.page_cum_height = np.array(state["page_cum_height"])
+        self.render_zoomin = state["zoomin"]
+        self.page_chars = [[] for _ in self.boxes]
+        self.page_figures = [[] for _ in self.boxes]
+        # Pages are only rendered again for the crops of tables, figures and chunks.
+        render, _ = self._page_renderer(fnm, state["zoomin"])
+        window = int(os.environ.get("DEEPDOC_PAGE_WINDOW", 0)) or 16
+        self.page_images = PdfPageImages(lambda i: render(page_from + i), len(state["page_sizes"]), window,
+                                         [tuple(s) for s in state["page_sizes"]])
+
     def __images__(self, fnm, zoomin=3, page_from=0,
                    page_to=299, callback=None):
+        # With DEEPDOC_CACHE_BUCKET, the results of a former run on the same file are reused.
+        self.cache_key = DEEPDOC_CACHE.doc_key(fnm, "images", page_from, page_to, zoomin) \
+            if DEEPDOC_CACHE.enabled() else None
+        cache_key = self.cache_key
+        state = DEEPDOC_CACHE.get(cache_key) if cache_key else None
         self.lefted_chars = []
         self.mean_height = []
         self.mean_width = []
@@ -951,14 +1265,36 @@ class RAGFlowPdfParser:
         self.page_cum_height = [0]
         self.page_layout = []
         self.page_from = page_from
+        self.render_zoomin = zoomin
+        if state:
+            self.__cached_images(fnm, page_from, state)
+            logging.info("Deepdoc OCR results loaded from cache.")
+            return
         st = timer()
         try:
             self.pdf = pdfplumber.open(fnm) if isinstance(
                 fnm, str) else pdfplumber.open(BytesIO(fnm))
-            self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                enumerate(self.pdf.pages[page_from:page_to])]
-            self.page_chars = [[{**c, 'top': c['top'], 'bottom': c['bottom']} for c in page.dedupe_chars().chars if self._has_color(c)] for page in
-                               self.pdf.pages[page_from:page_to]]
+            render, self.render_zoomin = self._page_renderer(
+                fnm, zoomin, [(p.width, p.height) for p in self.pdf.pages[page_from:page_to]])
+            pages = range(len(self.pdf.pages))[page_from:page_to]
+            # With DEEPDOC_PAGE_WINDOW pages, render lazily and keep only that many images.
+            window = int(os.environ.get("DEEPDOC_PAGE_WINDOW", 0))
+            if window > 0:
+                self.page_images = PdfPageImages(lambda i: render(pages[i]), len(pages), window)
+                self.page_chars = []
+                self.page_figures = []
+                for page in self.pdf.pages[page_from:page_to]:
+                    self.page_chars.append([{k: c[k] for k in self.CHAR_FIELDS} for c in page.dedupe_chars().chars if self._has_color(c)])
+                    self.page_figures.append([{k: im[k] for k in ["x0", "x1", "top", "bottom"]} for im in page.images])
+                    # pdfplumber caches the parsed page objects otherwise.
+                    if hasattr(page, "flush_cache"):
+                        page.flush_cache()
+            else:
+                self.page_images = [render(i) for i in pages]
+                self.page_chars = [[{**c, 'top': c['top'], 'bottom': c['bottom']} for c in page.dedupe_chars().chars if self._has_color(c)] for page in
+                                   self.pdf.pages[page_from:page_to]]
+                self.page_figures = [[{k: im[k] for k in ["x0", "x1", "top", "bottom"]} for im in page.images] for page in
+                                     self.pdf.pages[page_from:page_to]]
             self.total_page = len(self.pdf.pages)
         except Exception as e:
             logging.error(str(e))
@@ -992,7 +1328,7 @@ class RAGFlowPdfParser:
             self.is_english = False
 
         st = timer()
-        for i, img in enumerate(self.page_images):
+        for i in range(len(self.page_images)):
             chars = self.page_chars[i] if not self.is_english else []
             self.mean_height.append(
                 np.median(sorted([c["height"] for c in chars])) if chars else 0
@@ -1000,19 +1336,35 @@ class RAGFlowPdfParser:
             self.mean_width.append(
                 np.median(sorted([c["width"] for c in chars])) if chars else 8
             )
-            self.page_cum_height.append(img.size[1] / zoomin)
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
+            self._space_chars(chars)
 
-            self.__ocr(i + 1, img, chars, zoomin)
-            if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+        # DEEPDOC_TEXT_LAYER=1 takes born-digital pages from their chars instead of OCR.
+        text_layer = os.environ.get("DEEPDOC_TEXT_LAYER", "0").lower() in ["1", "true"]
+
+        ZM = self.render_zoomin
+
+        def ocr(i):
+            if text_layer and self._has_text_layer(self.page_chars[i]):
+                if self.is_english:
+                    self._space_chars(self.page_chars[i])
+                return self.__text_layer(i + 1, self.page_images[i], self.page_chars[i], ZM)
+            return self.__ocr(i + 1, self.page_images[i], self.page_chars[i] if not self.is_english else [], ZM)
+
+        # Results are taken in page order whatever the number of workers.
+        exe = ThreadPoolExecutor(max_workers=self.page_workers())
+        try:
+            futs = [exe.submit(ocr, i) for i in range(len(self.page_images))]
+            for i, fut in enumerate(futs):
+                bxs, lefted_chars = fut.result()
+                self.boxes.append(bxs)
+                self.lefted_chars.extend(lefted_chars)
+                if callback and i % 6 == 5:
+                    callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+        finally:
+            # After a failed page, the pages not started yet are dropped.
+            exe.shutdown(cancel_futures=True)
+        for img in self.page_images:
+            self.page_cum_height.append(img.size[1] / ZM)
         # print("OCR:", timer()-st)
 
         if not self.is_english and not any(
@@ -1025,8 +1377,16 @@ class RAGFlowPdfParser:
 
         self.page_cum_height = np.cumsum(self.page_cum_height)
         assert len(self.page_cum_height) == len(self.page_images) + 1
-        if len(self.boxes) == 0 and zoomin < 9: self.__images__(fnm, zoomin * 3, page_from,
-                                                                page_to, callback)
+        # A zoom lowered by the pixel cap would only be lowered again.
+        if len(self.boxes) == 0 and zoomin < 9 and ZM == zoomin: self.__images__(fnm, zoomin * 3, page_from,
+                                                                                 page_to, callback)
+        if cache_key and self.boxes:
+            self.cache_key = cache_key
+            DEEPDOC_CACHE.put(cache_key, {
+                "boxes": self.boxes, "mean_height": self.mean_height, "mean_width": self.mean_width,
+                "is_english": bool(self.is_english), "total_page": self.total_page, "outlines": self.outlines,
+                "page_cum_height": self.page_cum_height, "zoomin": self.render_zoomin,
+                "page_sizes": [img.size for img in self.page_images]})
 
     def __call__(self, fnm, need_image=True, zoomin=3, return_html=False):
         self.__images__(fnm, zoomin)
@@ -1043,6 +1403,7 @@ class RAGFlowPdfParser:
         return re.sub(r"@@[\t0-9.-]+?##", "", txt)
 
     def crop(self, text, ZM=3, need_position=False):
+        ZM = self._zm(ZM)
         imgs = []
         poss = []
         for tag in re.findall(r"@@[0-9-]+\t[0-9.\t]+##", text):
@@ -1124,6 +1485,7 @@ class RAGFlowPdfParser:
         return pic
 
     def get_position(self, bx, ZM):
+        ZM = self._zm(ZM)
         poss = []
         pn = bx["page_number"]
         top = bx["top"] - self.page_cum_height[pn - 1]
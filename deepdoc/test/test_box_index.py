@@ -0,0 +1,80 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import copy
+import random
+
+import pytest
+
+from deepdoc.vision.recognizer import BoxIndex, Recognizer
+
+
+def random_boxes(rng, n, layouts=1, types=("text",)):
+    # Coordinates on a coarse grid, so that boxes touch and overlaps tie.
+    boxes = []
+    for _ in range(n):
+        x0, top = rng.randint(0, 60) * 5, rng.randint(0, 120) * 5
+        boxes.append({"x0": x0, "x1": x0 + rng.randint(1, 30) * 5,
+                      "top": top, "bottom": top + rng.randint(1, 8) * 5,
+                      "layoutno": str(rng.randrange(layouts)), "type": rng.choice(types)})
+    return boxes
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_find_overlapped(seed):
+    rng = random.Random(seed)
+    bxs = Recognizer.sort_Y_firstly(random_boxes(rng, 200), 0)
+    index = BoxIndex(bxs)
+    for c in random_boxes(rng, 300):
+        assert Recognizer.find_overlapped(c, bxs, index=index) == Recognizer.find_overlapped(c, bxs)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("thr", [0, 0.3, 0.6])
+def test_find_overlapped_with_threashold(seed, thr):
+    rng = random.Random(seed)
+    lts = random_boxes(rng, 80)
+    index = BoxIndex(lts)
+    for b in random_boxes(rng, 300):
+        assert Recognizer.find_overlapped_with_threashold(b, lts, thr=thr, index=index) == \
+               Recognizer.find_overlapped_with_threashold(b, lts, thr=thr)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_find_horizontally_tightest_fit(seed):
+    rng = random.Random(seed)
+    clmns = random_boxes(rng, 40, layouts=3)
+    index = BoxIndex(clmns)
+    for b in random_boxes(rng, 300, layouts=4):
+        assert Recognizer.find_horizontally_tightest_fit(b, clmns, index=index) == \
+               Recognizer.find_horizontally_tightest_fit(b, clmns)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("far", [2, 5])
+def test_layouts_cleanup(seed, far):
+    rng = random.Random(seed)
+    bxs = random_boxes(rng, 300)
+    lts = Recognizer.sort_Y_firstly(random_boxes(rng, 60, types=("text", "table")), 0)
+    expected = Recognizer.layouts_cleanup(bxs, copy.deepcopy(lts), far, 0.3)
+    assert Recognizer.layouts_cleanup(bxs, copy.deepcopy(lts), far, 0.3, index=BoxIndex(bxs)) == expected
+
+
+def test_query_is_ascending_and_complete():
+    rng = random.Random(0)
+    bxs = random_boxes(rng, 200)
+    index = BoxIndex(bxs, cell=17)
+    for b in random_boxes(rng, 200):
+        found = index.query(b)
+        assert found == sorted(found)
+        overlapping = [i for i, o in enumerate(bxs) if Recognizer.overlapped_area(o, b, False) > 0]
+        assert set(overlapping) <= set(found)
@@ -0,0 +1,86 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+
+from deepdoc.vision.ocr import TextRecognizer
+from deepdoc.vision.postprocess import DBPostProcess
+
+
+def random_contours(seed, n=40, h=240, w=320):
+    # A probability map with rotated text-line-like blobs, and its binarization.
+    rng = np.random.default_rng(seed)
+    pred = rng.random((h, w)).astype(np.float32) * 0.2
+    for _ in range(n):
+        rect = ((rng.uniform(0, w), rng.uniform(0, h)), (rng.uniform(2, 80), rng.uniform(2, 20)),
+                rng.uniform(-90, 90))
+        cv2.fillPoly(pred, [cv2.boxPoints(rect).astype(np.int32)], float(rng.uniform(0.4, 1)))
+    contours, _ = cv2.findContours(((pred > 0.3) * 255).astype(np.uint8), cv2.RETR_LIST,
+                                   cv2.CHAIN_APPROX_SIMPLE)
+    return pred, contours
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_mini_boxes(seed):
+    post = DBPostProcess()
+    _, contours = random_contours(seed)
+    boxes, ssides = post.mini_boxes([cv2.minAreaRect(c) for c in contours])
+    for c, box, sside in zip(contours, boxes, ssides):
+        expected, expected_sside = post.get_mini_boxes(c)
+        np.testing.assert_array_equal(box, np.array(expected))
+        assert sside == expected_sside
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_box_scores_fast(seed):
+    post = DBPostProcess()
+    pred, contours = random_contours(seed)
+    boxes, _ = post.mini_boxes([cv2.minAreaRect(c) for c in contours])
+    expected = [post.box_score_fast(pred, box) for box in boxes]
+    assert post.box_scores_fast(pred, boxes) == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_unclip_distances(seed):
+    post = DBPostProcess()
+    _, contours = random_contours(seed)
+    boxes, ssides = post.mini_boxes([cv2.minAreaRect(c) for c in contours])
+    boxes = boxes[ssides > 0]
+    expected = [Polygon(b).area * post.unclip_ratio / Polygon(b).length for b in boxes]
+    np.testing.assert_allclose(post.unclip_distances(boxes, post.unclip_ratio), expected, rtol=1e-9)
+    for b, d in zip(boxes, post.unclip_distances(boxes, post.unclip_ratio)):
+        np.testing.assert_array_equal(post.unclip(b, post.unclip_ratio, d), post.unclip(b, post.unclip_ratio))
+
+
+def recognizer(input_width):
+    # Only the input shape of the model is read by the resizing.
+    rec = object.__new__(TextRecognizer)
+    rec.rec_image_shape = [3, 48, 320]
+    rec.input_tensor = SimpleNamespace(shape=["N", 3, 48, input_width])
+    return rec
+
+
+@pytest.mark.parametrize("input_width", ["W", 320])
+def test_resize_norm_batch(input_width):
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 256, (int(rng.integers(8, 64)), int(rng.integers(4, 600)), 3), dtype=np.uint8)
+            for _ in range(16)]
+    rec = recognizer(input_width)
+    max_wh_ratio = max([320 / 48] + [img.shape[1] / img.shape[0] for img in imgs])
+    batch = rec.resize_norm_batch(imgs, max_wh_ratio)
+    expected = np.stack([rec.resize_norm_img(img, max_wh_ratio) for img in imgs])
+    np.testing.assert_array_equal(batch, expected)
@@ -0,0 +1,28 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import json
+import os
+
+import pytest
+
+from deepdoc.vision.t_tsr import outputs
+
+# Tagged boxes with what construct_table returned for them before its rewrite (t_tsr.py --mode synth).
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tsr_corpus")
+
+
+@pytest.mark.parametrize("name", sorted([n for n in os.listdir(CORPUS) if n.endswith(".json")]))
+def test_construct_table_output_unchanged(name):
+    with open(os.path.join(CORPUS, name)) as f:
+        case = json.load(f)
+    assert outputs(case["boxes"]) == case["outputs"]
@@ -18,7 +18,7 @@ import numpy as np
 from huggingface_hub import snapshot_download
 
 from api.utils.file_utils import get_project_base_directory
-from deepdoc.vision import Recognizer
+from deepdoc.vision import Recognizer, BoxIndex
 
 
 class LayoutRecognizer(Recognizer):
@@ -51,7 +51,7 @@ class LayoutRecognizer(Recognizer):
         self.garbage_layouts = ["footer", "header", "reference"]
 
     def __call__(self, image_list, ocr_res, scale_factor=3,
-                 thr=0.2, batch_size=16, drop=True):
+                 thr=0.2, batch_size=16, drop=True, workers=1):
         def __is_garbage(b):
             patt = [r"^•+$", r"(版权归©|免责条款|地址[:：])", r"\.{3,}", "^[0-9]{1,2} / ?[0-9]{1,2}$",
                     r"^[0-9]{1,2} of [0-9]{1,2}$", "^http://[^ ]{12,}",
@@ -60,7 +60,7 @@ class LayoutRecognizer(Recognizer):
                     ]
             return any([re.search(p, b["text"]) for p in patt])
 
-        layouts = super().__call__(image_list, thr, batch_size)
+        layouts = super().__call__(image_list, thr, batch_size, workers)
         # save_results(image_list, layouts, self.labels, output_dir='output/', threshold=0.7)
         assert len(image_list) == len(ocr_res)
         # Tag layout type
@@ -78,13 +78,14 @@ class LayoutRecognizer(Recognizer):
                     } for b in lts if float(b["score"]) >= 0.8 or b["type"] not in self.garbage_layouts]
             lts = self.sort_Y_firstly(lts, np.mean(
                 [l["bottom"] - l["top"] for l in lts]) / 2)
-            lts = self.layouts_cleanup(bxs, lts)
+            lts = self.layouts_cleanup(bxs, lts, index=BoxIndex(bxs))
             page_layout.append(lts)
 
             # Tag layout type, layouts are ready
             def findLayout(ty):
                 nonlocal bxs, lts, self
                 lts_ = [lt for lt in lts if lt["type"] == ty]
+                lts_index = BoxIndex(lts_)
                 i = 0
                 while i < len(bxs):
                     if bxs[i].get("layout_type"):
@@ -95,7 +96,7 @@ class LayoutRecognizer(Recognizer):
                         continue
 
                     ii = self.find_overlapped_with_threashold(bxs[i], lts_,
-                                                              thr=0.4)
+                                                              thr=0.4, index=lts_index)
                     if ii is None:  # belong to nothing
                         bxs[i]["layout_type"] = ""
                         i += 1
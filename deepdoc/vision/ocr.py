@@ -20,8 +20,8 @@ from huggingface_hub import snapshot_download
 from api.utils.file_utils import get_project_base_directory
 from .operators import *
 import numpy as np
-import onnxruntime as ort
 
+from .ort_session import get_session, model_file
 from .postprocess import build_post_process
 
 
@@ -59,26 +59,9 @@ def create_operators(op_param_list, global_config=None):
 
 
 def load_model(model_dir, nm):
-    model_file_path = os.path.join(model_dir, nm + ".onnx")
-    if not os.path.exists(model_file_path):
-        raise ValueError("not find model file path {}".format(
-            model_file_path))
-
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
-    if False and ort.get_device() == "GPU":
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CUDAExecutionProvider'])
-    else:
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CPUExecutionProvider'])
+    model_file_path = model_file(model_dir, nm)
+    # Forked task executors each get a share of the cores, see task_executor_supervisor.py
+    sess = get_session(model_file_path, threads=2, mem_arena=False)
     return sess, sess.get_inputs()[0]
 
 
@@ -120,6 +103,33 @@ class TextRecognizer(object):
         padding_im[:, :, 0:resized_w] = resized_image
         return padding_im
 
+    def resize_norm_batch(self, img_list, max_wh_ratio):
+        """
+        resize_norm_img of a whole batch, resized into one preallocated tensor
+        and normalized at once. The padding starts at 127.5, which normalizes to 0.
+        """
+        imgC, imgH, imgW = self.rec_image_shape
+        imgW = int((imgH * max_wh_ratio))
+        w = self.input_tensor.shape[3:][0]
+        if isinstance(w, str):
+            pass
+        elif w is not None and w > 0:
+            imgW = w
+        batch = np.full((len(img_list), imgC, imgH, imgW), 127.5, dtype=np.float32)
+        for i, img in enumerate(img_list):
+            assert imgC == img.shape[2]
+            h, w = img.shape[:2]
+            ratio = w / float(h)
+            if math.ceil(imgH * ratio) > imgW:
+                resized_w = imgW
+            else:
+                resized_w = int(math.ceil(imgH * ratio))
+            batch[i, :, :, 0:resized_w] = cv2.resize(img, (resized_w, imgH)).transpose((2, 0, 1))
+        batch /= 255
+        batch -= 0.5
+        batch /= 0.5
+        return batch
+
     def resize_norm_img_vl(self, img, image_shape):
 
         imgC, imgH, imgW = image_shape
@@ -318,7 +328,6 @@ class TextRecognizer(object):
 
         for beg_img_no in range(0, img_num, batch_num):
             end_img_no = min(img_num, beg_img_no + batch_num)
-            norm_img_batch = []
             imgC, imgH, imgW = self.rec_image_shape[:3]
             max_wh_ratio = imgW / imgH
             # max_wh_ratio = 0
@@ -326,13 +335,8 @@ class TextRecognizer(object):
                 h, w = img_list[indices[ino]].shape[0:2]
                 wh_ratio = w * 1.0 / h
                 max_wh_ratio = max(max_wh_ratio, wh_ratio)
-            for ino in range(beg_img_no, end_img_no):
-                norm_img = self.resize_norm_img(img_list[indices[ino]],
-                                                max_wh_ratio)
-                norm_img = norm_img[np.newaxis, :]
-                norm_img_batch.append(norm_img)
-            norm_img_batch = np.concatenate(norm_img_batch)
-            norm_img_batch = norm_img_batch.copy()
+            norm_img_batch = self.resize_norm_batch(
+                [img_list[indices[ino]] for ino in range(beg_img_no, end_img_no)], max_wh_ratio)
 
             input_dict = {}
             input_dict[self.input_tensor.name] = norm_img_batch
@@ -435,7 +439,8 @@ class TextDetector(object):
         return dt_boxes
 
     def __call__(self, img):
-        ori_im = img.copy()
+        # The page buffer is only read here, never copied.
+        ori_shape = img.shape
         data = {'image': img}
 
         st = time.time()
@@ -445,7 +450,7 @@ class TextDetector(object):
             return None, 0
         img = np.expand_dims(img, axis=0)
         shape_list = np.expand_dims(shape_list, axis=0)
-        img = img.copy()
+        img = np.ascontiguousarray(img)
         input_dict = {}
         input_dict[self.input_tensor.name] = img
         for i in range(100000):
@@ -459,7 +464,7 @@ class TextDetector(object):
 
         post_result = self.postprocess_op({"maps": outputs[0]}, shape_list)
         dt_boxes = post_result[0]['points']
-        dt_boxes = self.filter_tag_det_res(dt_boxes, ori_im.shape)
+        dt_boxes = self.filter_tag_det_res(dt_boxes, ori_shape)
 
         return dt_boxes, time.time() - st
 
@@ -578,6 +583,14 @@ class OCR(object):
             return ""
         return text
 
+    def recognize_batch(self, ori_im, boxes):
+        """Recognizes the text of many boxes of one image at once; TextRecognizer batches them."""
+        if not boxes:
+            return []
+        img_crop_list = [self.get_rotate_crop_image(ori_im, box) for box in boxes]
+        rec_res, elapse = self.text_recognizer(img_crop_list)
+        return [text if score >= self.drop_score else "" for text, score in rec_res]
+
     def __call__(self, img, cls=True):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
 
@@ -585,7 +598,7 @@ class OCR(object):
             return None, None, time_dict
 
         start = time.time()
-        ori_im = img.copy()
+        ori_im = img
         dt_boxes, elapse = self.text_detector(img)
         time_dict['det'] = elapse
 
@@ -123,8 +123,12 @@ class NormalizeImage(object):
             img = np.array(img)
         assert isinstance(img,
                           np.ndarray), "invalid input 'img' in NormalizeImage"
-        data['image'] = (
-            img.astype('float32') * self.scale - self.mean) / self.std
+        # In place on the one float copy, which is as large as the resized page.
+        img = img.astype('float32')
+        img *= self.scale
+        img -= self.mean
+        img /= self.std
+        data['image'] = img
         return data
 
 
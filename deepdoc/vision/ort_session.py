@@ -0,0 +1,98 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+One onnxruntime session per model file and process, shared by every OCR and
+recognizer instance and by all threads (InferenceSession.run is thread-safe).
+
+Sessions are configured from the environment:
+  DEEPDOC_ORT_THREADS        intra-op threads
+  DEEPDOC_ORT_INTER_THREADS  inter-op threads, the intra-op count by default
+  DEEPDOC_ORT_MEM_ARENA      1/0, enables the CPU memory arena
+  DEEPDOC_ORT_OPT_LEVEL      disable, basic, extended or all (the default)
+  DEEPDOC_INT8_MODELS        comma separated models (det, rec, layout, tsr, or all)
+                             to run dynamically quantized to INT8
+Settings which are not given keep the defaults of the model's loader.
+"""
+
+import logging
+import os
+import threading
+
+import onnxruntime as ort
+
+OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_SESSIONS = {}
+_LOCK = threading.Lock()
+
+
+def model_file(model_dir, nm):
+    """
+    The ONNX file of model `nm`. If DEEPDOC_INT8_MODELS selects it, this is
+    `<nm>.int8.onnx` instead, quantized from the FP32 file the first time.
+    """
+    path = os.path.join(model_dir, nm + ".onnx")
+    selected = [m.strip() for m in os.environ.get("DEEPDOC_INT8_MODELS", "").split(",") if m.strip()]
+    if not any(m == "all" or nm == m or nm.startswith(m + ".") for m in selected):
+        return path
+
+    int8 = os.path.join(model_dir, nm + ".int8.onnx")
+    with _LOCK:
+        if not os.path.exists(int8) and os.path.exists(path):
+            try:
+                quantize(path, int8)
+            except Exception as e:
+                logging.warning("Quantize {}: {}".format(path, str(e)))
+    return int8 if os.path.exists(int8) else path
+
+
+def quantize(src, dst):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    tmp = "{}.{}.tmp.onnx".format(dst[:-len(".onnx")], os.getpid())
+    quantize_dynamic(src, tmp, weight_type=QuantType.QInt8)
+    os.replace(tmp, dst)
+
+
+def session_options(threads=None, mem_arena=True):
+    options = ort.SessionOptions()
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    threads = int(os.environ.get("DEEPDOC_ORT_THREADS", threads or 0))
+    if threads > 0:
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = int(os.environ.get("DEEPDOC_ORT_INTER_THREADS", threads))
+    if os.environ.get("DEEPDOC_ORT_MEM_ARENA"):
+        mem_arena = os.environ["DEEPDOC_ORT_MEM_ARENA"].lower() in ["1", "true"]
+    options.enable_cpu_mem_arena = mem_arena
+    options.graph_optimization_level = OPT_LEVELS[os.environ.get("DEEPDOC_ORT_OPT_LEVEL", "all").lower()]
+    return options
+
+
+def get_session(model_file_path, threads=None, mem_arena=True):
+    """Returns the session of the model, creating it on first use."""
+    sess = _SESSIONS.get(model_file_path)
+    if sess is not None:
+        return sess
+    with _LOCK:
+        if model_file_path not in _SESSIONS:
+            if not os.path.exists(model_file_path):
+                raise ValueError("not find model file path {}".format(model_file_path))
+            _SESSIONS[model_file_path] = ort.InferenceSession(
+                model_file_path,
+                sess_options=session_options(threads, mem_arena),
+                providers=['CPUExecutionProvider'])
+        return _SESSIONS[model_file_path]
@@ -125,40 +125,43 @@ class DBPostProcess(object):
         elif len(outs) == 2:
             contours, _ = outs[0], outs[1]
 
-        num_contours = min(len(contours), self.max_candidates)
-
-        boxes = []
-        scores = []
-        for index in range(num_contours):
-            contour = contours[index]
-            points, sside = self.get_mini_boxes(contour)
-            if sside < self.min_size:
-                continue
-            points = np.array(points)
-            if self.score_mode == "fast":
-                score = self.box_score_fast(pred, points.reshape(-1, 2))
-            else:
-                score = self.box_score_slow(pred, contour)
-            if self.box_thresh > score:
-                continue
-
-            box = self.unclip(points, self.unclip_ratio).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
-            if sside < self.min_size + 2:
-                continue
-            box = np.array(box)
-
-            box[:, 0] = np.clip(
-                np.round(box[:, 0] / width * dest_width), 0, dest_width)
-            box[:, 1] = np.clip(
-                np.round(box[:, 1] / height * dest_height), 0, dest_height)
-            boxes.append(box.astype("int32"))
-            scores.append(score)
-        return np.array(boxes, dtype="int32"), scores
-
-    def unclip(self, box, unclip_ratio):
-        poly = Polygon(box)
-        distance = poly.area * unclip_ratio / poly.length
+        contours = contours[:self.max_candidates]
+        if not len(contours):
+            return np.array([], dtype="int32"), []
+
+        # Corner ordering, scoring bounds, unclip distances and scaling are done
+        # for all the candidates at once; only the OpenCV and clipper calls are per box.
+        points, ssides = self.mini_boxes([cv2.minAreaRect(c) for c in contours])
+        keep = np.flatnonzero(ssides >= self.min_size)
+        if self.score_mode == "fast":
+            scores = self.box_scores_fast(pred, points[keep])
+        else:
+            scores = [self.box_score_slow(pred, contours[i]) for i in keep]
+        passed = [j for j, score in enumerate(scores) if self.box_thresh <= score]
+        if not passed:
+            return np.array([], dtype="int32"), []
+        points = points[keep[passed]]
+        scores = [scores[j] for j in passed]
+
+        distances = self.unclip_distances(points, self.unclip_ratio)
+        boxes, ssides = self.mini_boxes(
+            [cv2.minAreaRect(self.unclip(p, self.unclip_ratio, d).reshape(-1, 1, 2)) for p, d in zip(points, distances)])
+        keep = np.flatnonzero(ssides >= self.min_size + 2)
+        if not len(keep):
+            return np.array([], dtype="int32"), []
+        boxes = boxes[keep]
+        scores = [scores[j] for j in keep]
+
+        boxes[:, :, 0] = np.clip(
+            np.round(boxes[:, :, 0] / width * dest_width), 0, dest_width)
+        boxes[:, :, 1] = np.clip(
+            np.round(boxes[:, :, 1] / height * dest_height), 0, dest_height)
+        return boxes.astype("int32"), scores
+
+    def unclip(self, box, unclip_ratio, distance=None):
+        if distance is None:
+            poly = Polygon(box)
+            distance = poly.area * unclip_ratio / poly.length
         offset = pyclipper.PyclipperOffset()
         offset.AddPath(box, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
         expanded = np.array(offset.Execute(distance))
@@ -187,6 +190,47 @@ class DBPostProcess(object):
         ]
         return box, min(bounding_box[1])
 
+    @staticmethod
+    def unclip_distances(boxes, unclip_ratio):
+        """unclip's offset distance of (N, 4, 2) boxes: area * unclip_ratio / perimeter."""
+        x = boxes[:, :, 0].astype(np.float64)
+        y = boxes[:, :, 1].astype(np.float64)
+        area = np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1)) / 2
+        length = np.sum(np.hypot(np.roll(x, -1, axis=1) - x, np.roll(y, -1, axis=1) - y), axis=1)
+        return area * unclip_ratio / length
+
+    @staticmethod
+    def mini_boxes(rects):
+        """get_mini_boxes of many cv2.minAreaRect results: (N, 4, 2) corners and the short sides."""
+        pts = np.array([cv2.boxPoints(r) for r in rects], dtype=np.float32).reshape(-1, 4, 2)
+        pts = np.take_along_axis(pts, np.argsort(pts[:, :, 0], axis=1, kind="stable")[:, :, None], axis=1)
+        i1 = np.where(pts[:, 1, 1] > pts[:, 0, 1], 0, 1)
+        i2 = np.where(pts[:, 3, 1] > pts[:, 2, 1], 2, 3)
+        order = np.stack([i1, i2, 5 - i2, 1 - i1], axis=1)
+        return np.take_along_axis(pts, order[:, :, None], axis=1), np.array([min(r[1]) for r in rects])
+
+    def box_scores_fast(self, bitmap, boxes):
+        """box_score_fast of (N, 4, 2) boxes, filling their masks into one shared buffer."""
+        h, w = bitmap.shape[:2]
+        xmin = np.clip(np.floor(boxes[:, :, 0].min(axis=1)).astype("int32"), 0, w - 1)
+        xmax = np.clip(np.ceil(boxes[:, :, 0].max(axis=1)).astype("int32"), 0, w - 1)
+        ymin = np.clip(np.floor(boxes[:, :, 1].min(axis=1)).astype("int32"), 0, h - 1)
+        ymax = np.clip(np.ceil(boxes[:, :, 1].max(axis=1)).astype("int32"), 0, h - 1)
+        local = boxes.copy()
+        local[:, :, 0] -= xmin[:, np.newaxis]
+        local[:, :, 1] -= ymin[:, np.newaxis]
+        local = local.astype("int32")
+
+        mask = np.zeros((h, w), dtype=np.uint8)
+        scores = []
+        for i in range(len(boxes)):
+            window = (slice(ymin[i], ymax[i] + 1), slice(xmin[i], xmax[i] + 1))
+            m = mask[window]
+            cv2.fillPoly(m, local[i:i + 1], 1)
+            scores.append(cv2.mean(bitmap[window], m)[0])
+            m[:] = 0
+        return scores
+
     def box_score_fast(self, bitmap, _box):
         '''
         box_score_fast: use bbox mean score as the mean score
@@ -12,13 +12,53 @@
 #
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
-import onnxruntime as ort
 from huggingface_hub import snapshot_download
 
 from api.utils.file_utils import get_project_base_directory
 from .operators import *
+from .ort_session import get_session, model_file
+
+
+class BoxIndex(object):
+    """
+    Uniform grid over boxes ({"x0", "x1", "top", "bottom"}) telling which of them
+    may overlap a given box. Candidates come back as ascending indices, so the
+    helpers below scan them with the same tie-breaking as a full scan.
+    """
+
+    def __init__(self, boxes, cell=None):
+        self.boxes = boxes
+        if not cell:
+            hs = [b["bottom"] - b["top"] for b in boxes if b["bottom"] > b["top"]]
+            cell = np.median(hs) * 2 if hs else 32
+        self.cell = max(float(cell), 1.)
+        self.grid = {}
+        self.layouts = None
+        for i, b in enumerate(boxes):
+            for k in self._cells(b):
+                self.grid.setdefault(k, []).append(i)
+
+    def _cells(self, b):
+        c = self.cell
+        for x in range(int(b["x0"] // c), int(b["x1"] // c) + 1):
+            for y in range(int(b["top"] // c), int(b["bottom"] // c) + 1):
+                yield x, y
+
+    def query(self, box):
+        res = set()
+        for k in self._cells(box):
+            res.update(self.grid.get(k, []))
+        return sorted(res)
+
+    def same_layout(self, layoutno):
+        if self.layouts is None:
+            self.layouts = {}
+            for i, b in enumerate(self.boxes):
+                self.layouts.setdefault(b.get("layoutno", "0"), []).append(i)
+        return self.layouts.get(layoutno, [])
 
 
 class Recognizer(object):
@@ -47,15 +87,7 @@ class Recognizer(object):
         else:
             model_file_path = os.path.join(model_dir, task_name + ".onnx")
 
-        if not os.path.exists(model_file_path):
-            raise ValueError("not find model file path {}".format(
-                model_file_path))
-        if False and ort.get_device() == "GPU":
-            options = ort.SessionOptions()
-            options.enable_cpu_mem_arena = False
-            self.ort_sess = ort.InferenceSession(model_file_path, options=options, providers=[('CUDAExecutionProvider')])
-        else:
-            self.ort_sess = ort.InferenceSession(model_file_path, providers=['CPUExecutionProvider'])
+        self.ort_sess = get_session(model_file(os.path.dirname(model_file_path), task_name))
         self.input_names = [node.name for node in self.ort_sess.get_inputs()]
         self.output_names = [node.name for node in self.ort_sess.get_outputs()]
         self.input_shape = self.ort_sess.get_inputs()[0].shape[2:4]
@@ -152,7 +184,7 @@ class Recognizer(object):
         return ov
 
     @staticmethod
-    def layouts_cleanup(boxes, layouts, far=2, thr=0.7):
+    def layouts_cleanup(boxes, layouts, far=2, thr=0.7, index=None):
         def notOverlapped(a, b):
             return any([a["x1"] < b["x0"],
                         a["x0"] > b["x1"],
@@ -182,11 +214,19 @@ class Recognizer(object):
                 continue
 
             area_i, area_i_1 = 0, 0
-            for b in boxes:
-                if not notOverlapped(b, layouts[i]):
-                    area_i += Recognizer.overlapped_area(b, layouts[i], False)
-                if not notOverlapped(b, layouts[j]):
-                    area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+            if index is None:
+                for b in boxes:
+                    if not notOverlapped(b, layouts[i]):
+                        area_i += Recognizer.overlapped_area(b, layouts[i], False)
+                    if not notOverlapped(b, layouts[j]):
+                        area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+            else:
+                for k in index.query(layouts[i]):
+                    if not notOverlapped(boxes[k], layouts[i]):
+                        area_i += Recognizer.overlapped_area(boxes[k], layouts[i], False)
+                for k in index.query(layouts[j]):
+                    if not notOverlapped(boxes[k], layouts[j]):
+                        area_i_1 += Recognizer.overlapped_area(boxes[k], layouts[j], False)
 
             if area_i > area_i_1:
                 layouts.pop(j)
@@ -236,7 +276,7 @@ class Recognizer(object):
         return inputs
 
     @staticmethod
-    def find_overlapped(box, boxes_sorted_by_y, naive=False):
+    def find_overlapped(box, boxes_sorted_by_y, naive=False, index=None):
         if not boxes_sorted_by_y:
             return
         bxs = boxes_sorted_by_y
@@ -261,7 +301,7 @@ class Recognizer(object):
             break
 
         max_overlaped_i, max_overlaped = None, 0
-        for i in range(s, e):
+        for i in (range(s, e) if index is None else [i for i in index.query(box) if s <= i < e]):
             ov = Recognizer.overlapped_area(bxs[i], box)
             if ov <= max_overlaped:
                 continue
@@ -271,11 +311,12 @@ class Recognizer(object):
         return max_overlaped_i
 
     @staticmethod
-    def find_horizontally_tightest_fit(box, boxes):
+    def find_horizontally_tightest_fit(box, boxes, index=None):
         if not boxes:
             return
         min_dis, min_i = 1000000, None
-        for i,b in enumerate(boxes):
+        for i in (range(len(boxes)) if index is None else index.same_layout(box.get("layoutno", "0"))):
+            b = boxes[i]
             if box.get("layoutno", "0") != b.get("layoutno", "0"): continue
             dis = min(abs(box["x0"] - b["x0"]), abs(box["x1"] - b["x1"]), abs(box["x0"]+box["x1"] - b["x1"] - b["x0"])/2)
             if dis < min_dis:
@@ -284,12 +325,13 @@ class Recognizer(object):
         return min_i
 
     @staticmethod
-    def find_overlapped_with_threashold(box, boxes, thr=0.3):
+    def find_overlapped_with_threashold(box, boxes, thr=0.3, index=None):
         if not boxes:
             return
         max_overlapped_i, max_overlapped, _max_overlapped = None, thr, 0
         s, e = 0, len(boxes)
-        for i in range(s, e):
+        # Boxes apart from `box` only qualify with a threshold of 0.
+        for i in (range(s, e) if index is None or thr <= 0 else index.query(box)):
             ov = Recognizer.overlapped_area(box, boxes[i])
             _ov = Recognizer.overlapped_area(boxes[i], box)
             if (ov, _ov) < (max_overlapped, _max_overlapped):
@@ -316,18 +358,18 @@ class Recognizer(object):
 
             for im_path in image_list:
                 im, im_info = preprocess(im_path, preprocess_ops)
-                inputs.append({"image": np.array((im,)).astype('float32'),
+                inputs.append({"image": np.ascontiguousarray(im[np.newaxis], dtype=np.float32),
                                "scale_factor": np.array((im_info["scale_factor"],)).astype('float32')})
         else:
             hh, ww = self.input_shape
             for img in image_list:
                 h, w = img.shape[:2]
                 img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                img = cv2.resize(np.array(img).astype('float32'), (ww, hh))
+                img = cv2.resize(img.astype(np.float32), (ww, hh))
                 # Scale input pixel values to 0 to 1
                 img /= 255.0
                 img = img.transpose(2, 0, 1)
-                img = img[np.newaxis, :, :, :].astype(np.float32)
+                img = np.ascontiguousarray(img[np.newaxis, :, :, :])
                 inputs.append({self.input_names[0]: img, "scale_factor": [w/ww, h/hh]})
         return inputs
 
@@ -425,24 +467,32 @@ class Recognizer(object):
             "score": float(scores[i])
         } for i in indices]
 
-    def __call__(self, image_list, thr=0.7, batch_size=16):
+    def __call__(self, image_list, thr=0.7, batch_size=16, workers=1):
         res = []
-        imgs = []
-        for i in range(len(image_list)):
-            if not isinstance(image_list[i], np.ndarray):
-                imgs.append(np.array(image_list[i]))
-            else: imgs.append(image_list[i])
-
-        batch_loop_cnt = math.ceil(float(len(imgs)) / batch_size)
-        for i in range(batch_loop_cnt):
+
+        def run_batch(i):
+            # Converted batch by batch, so lazily rendered pages are not all held at once.
             start_index = i * batch_size
-            end_index = min((i + 1) * batch_size, len(imgs))
-            batch_image_list = imgs[start_index:end_index]
+            end_index = min((i + 1) * batch_size, len(image_list))
+            batch_image_list = [np.asarray(img)
+                                for img in image_list[start_index:end_index]]
             inputs = self.preprocess(batch_image_list)
-            print("preprocess")
-            for ins in inputs:
-                bb = self.postprocess(self.ort_sess.run(None, {k:v for k,v in ins.items() if k in self.input_names})[0], ins, thr)
-                res.append(bb)
+            return [self.postprocess(self.ort_sess.run(None, {k:v for k,v in ins.items() if k in self.input_names})[0], ins, thr)
+                    for ins in inputs]
+
+        batch_loop_cnt = math.ceil(float(len(image_list)) / batch_size)
+        if workers > 1 and batch_loop_cnt > 1:
+            # onnxruntime releases the GIL while it runs.
+            exe = ThreadPoolExecutor(max_workers=workers)
+            try:
+                for fut in [exe.submit(run_batch, i) for i in range(batch_loop_cnt)]:
+                    res.extend(fut.result())
+            finally:
+                # After a failed batch, the batches not started yet are dropped.
+                exe.shutdown(cancel_futures=True)
+        else:
+            for i in range(batch_loop_cnt):
+                res.extend(run_batch(i))
 
         #seeit.save_results(image_list, res, self.label_list, threshold=thr)
 
@@ -0,0 +1,117 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Compares the INT8 deepdoc models with the FP32 ones on a fixed set of pages:
+pages/sec of OCR and layout recognition, and how far the INT8 outputs agree
+with the FP32 ones.
+
+    python deepdoc/vision/t_int8.py --inputs ./samples --models det,rec,layout
+"""
+
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+from difflib import SequenceMatcher
+from timeit import default_timer as timer
+
+import numpy as np
+
+from api.utils.file_utils import get_project_base_directory
+from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, init_in_out
+
+
+def run(images, threshold):
+    ocr = OCR()
+    layouter = Recognizer(LayoutRecognizer.labels, "layout",
+                          os.path.join(get_project_base_directory(), "rag/res/deepdoc/"))
+    # Warm up, so session creation is not timed.
+    ocr(np.array(images[0]))
+    layouter(images[:1], threshold)
+
+    st = timer()
+    texts = []
+    for img in images:
+        bxs = ocr(np.array(img))
+        texts.append("\n".join([t[0] for _, t in bxs]) if isinstance(bxs, list) else "")
+    ocr_elapsed = timer() - st
+
+    st = timer()
+    layouts = layouter(images, threshold)
+    layout_elapsed = timer() - st
+    return texts, layouts, ocr_elapsed, layout_elapsed
+
+
+def iou(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, x1 - x0) * max(0, y1 - y0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0
+
+
+def layout_agreement(ref, res):
+    """F1 of the INT8 layouts against the FP32 ones, same type and IoU >= 0.5."""
+    if not ref and not res:
+        return 1.
+    matched, used = 0, set()
+    for r in ref:
+        for j, b in enumerate(res):
+            if j not in used and b["type"] == r["type"] and iou(r["bbox"], b["bbox"]) >= 0.5:
+                used.add(j)
+                matched += 1
+                break
+    return 2. * matched / (len(ref) + len(res))
+
+
+def main(args):
+    images, _ = init_in_out(args)
+    if not images:
+        print("No page found in " + args.inputs)
+        return
+
+    os.environ["DEEPDOC_INT8_MODELS"] = ""
+    ref_texts, ref_layouts, ref_ocr, ref_layout = run(images, float(args.threshold))
+    os.environ["DEEPDOC_INT8_MODELS"] = args.models
+    texts, layouts, ocr_elapsed, layout_elapsed = run(images, float(args.threshold))
+
+    n = len(images)
+    print("pages: {}, INT8 models: {}".format(n, args.models))
+    print("{:<8}{:>14}{:>14}{:>10}".format("", "FP32 pages/s", "INT8 pages/s", "speedup"))
+    for nm, a, b in [("ocr", ref_ocr, ocr_elapsed), ("layout", ref_layout, layout_elapsed)]:
+        print("{:<8}{:>14.2f}{:>14.2f}{:>9.2f}x".format(nm, n / a, n / b, a / b))
+    print("text agreement:   {:.4f}".format(
+        np.mean([SequenceMatcher(None, a, b).ratio() for a, b in zip(ref_texts, texts)])))
+    print("layout agreement: {:.4f}".format(
+        np.mean([layout_agreement(a, b) for a, b in zip(ref_layouts, layouts)])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputs',
+                        help="Directory where to store images or PDFs, or a file path to a single image or PDF",
+                        required=True)
+    parser.add_argument('--output_dir', help="Directory init_in_out prepares for outputs. Default: './int8_outputs'",
+                        default="./int8_outputs")
+    parser.add_argument('--models', help="Models to quantize, as for DEEPDOC_INT8_MODELS. Default: 'all'",
+                        default="all")
+    parser.add_argument('--threshold', help="Layout detection threshold. Default: 0.5", default=0.5)
+    args = parser.parse_args()
+    main(args)
@@ -59,7 +59,8 @@ def main(args):
         print("save result to: " + outputs[i])
 
 
-def get_table_html(img, tb_cpns, ocr):
+def get_table_boxes(img, tb_cpns, ocr):
+    """The OCR boxes of a table crop, tagged with the rows, headers, columns and spans of `tb_cpns`."""
     boxes = ocr(np.array(img))
     boxes = Recognizer.sort_Y_firstly(
         [{"x0": b[0][0], "x1": b[1][0],
@@ -113,6 +114,11 @@ def get_table_html(img, tb_cpns, ocr):
             b["H_right"] = spans[ii]["x1"]
             b["SP"] = ii
 
+    return boxes
+
+
+def get_table_html(img, tb_cpns, ocr):
+    boxes = get_table_boxes(img, tb_cpns, ocr)
     html = """
     <html>
     <head>
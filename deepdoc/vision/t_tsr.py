@@ -0,0 +1,234 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Regression corpus of `TableStructureRecognizer.construct_table`.
+
+`save` runs OCR and table structure recognition on table crops, and stores per
+crop the tagged boxes construct_table is given together with what it returns
+(HTML, and the descriptions in Chinese and English). Run it with the version
+of table_structure_recognizer.py to compare against:
+
+    python deepdoc/vision/t_tsr.py --mode save --inputs ./table_crops --output_dir ./tsr_corpus
+
+`synth` needs no model: it lays out random tables (headers, spanning cells,
+missing row and column tags, multi-line cells, stray boxes, captions and
+cross-page tables) directly as tagged boxes, and stores them the same way.
+deepdoc/test/tsr_corpus was made with it from the construct_table of before
+its numpy rewrite:
+
+    python deepdoc/vision/t_tsr.py --mode synth --output_dir ./tsr_corpus
+
+`check` feeds the stored boxes to the current construct_table and reports the
+crops whose outputs differ; it exits with 1 if any does:
+
+    python deepdoc/vision/t_tsr.py --mode check --output_dir ./tsr_corpus
+"""
+
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import copy
+import json
+import random
+from difflib import unified_diff
+
+import numpy as np
+
+from deepdoc.vision import TableStructureRecognizer, OCR, init_in_out
+from deepdoc.vision.t_recognizer import get_table_boxes
+
+
+def jsonable(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    raise TypeError("{} is not serializable".format(type(o).__name__))
+
+
+def outputs(boxes):
+    return {
+        "html": TableStructureRecognizer.construct_table(copy.deepcopy(boxes), html=True),
+        "zh": TableStructureRecognizer.construct_table(copy.deepcopy(boxes), is_english=False),
+        "en": TableStructureRecognizer.construct_table(copy.deepcopy(boxes), is_english=True),
+    }
+
+
+def save(args):
+    images, names = init_in_out(args)
+    tsr = TableStructureRecognizer()
+    ocr = OCR()
+    for i, (img, cpns) in enumerate(zip(images, tsr(images, float(args.threshold)))):
+        # Outputs are computed from the boxes as they are read back, so check sees the same floats.
+        boxes = json.loads(json.dumps(get_table_boxes(img, cpns, ocr), default=jsonable))
+        path = names[i] + ".json"
+        with open(path, "w") as f:
+            json.dump({"boxes": boxes, "outputs": outputs(boxes)}, f, ensure_ascii=False, indent=1)
+        print("save crop to: " + path)
+
+
+# Texts typed by blockType's patterns alone, so the corpus does not depend on the tokenizer dictionary.
+NUMBERS = ["{:,.1f}", "{:.2f}", "{:.0f}%", "-{:.1f}", "{:.0f}"]
+LABELS = ["Revenue", "Net income", "Total assets", "Operating costs", "Cash flow", "Equity", "Tax",
+          "AB-12", "N/A", "CNY", "元", "—", "12kg", "3.5mm"]
+DATES = ["{}年", "{}-03-31", "{}年第一季度", "{}A"]
+
+
+def synth_case(rng, n_rows, n_cols):
+    def text(i, j):
+        if i < n_hdr:
+            return rng.choice(DATES).format(rng.randint(1990, 2029)) if j and rng.random() < 0.7 \
+                else rng.choice(LABELS)
+        if j == 0:
+            return rng.choice(LABELS)
+        return rng.choice(NUMBERS).format(rng.random() * 10 ** rng.randint(0, 7))
+
+    def jit(v, d=2.0):
+        return round(v + rng.uniform(-d, d), 1)
+
+    n_hdr = rng.choice([0, 1, 1, 2])
+    cross = rng.random() < 0.1
+    widths = [rng.uniform(40, 140) for _ in range(n_cols)]
+    lefts = [20 + sum(widths[:j]) + 6 * j for j in range(n_cols)]
+    heights = [rng.uniform(16, 30) for _ in range(n_rows)]
+    tops = [20 + sum(heights[:i]) + 4 * i for i in range(n_rows)]
+    tag_rows, tag_cols = rng.random() < 0.9, rng.random() < 0.85
+    boxes = []
+    if rng.random() < 0.2:
+        boxes.append({"x0": 20.0, "x1": 220.0, "top": 2.0, "bottom": 16.0, "text": "表 1 主要财务数据",
+                      "layout_type": "table", "page_number": 0})
+    span = None
+    if n_hdr and n_cols > 3 and rng.random() < 0.5:
+        j = rng.randint(1, n_cols - 3)
+        span = (j, j + rng.randint(1, 2))
+    vspan = None
+    if n_rows - n_hdr > 3 and rng.random() < 0.3:
+        i = rng.randint(n_hdr, n_rows - 2)
+        vspan = (i, min(i + rng.randint(1, 2), n_rows - 1))
+    for i in range(n_rows):
+        for j in range(n_cols):
+            if span and i == 0 and span[0] < j <= span[1]:
+                continue
+            if vspan and j == 0 and vspan[0] < i <= vspan[1]:
+                continue
+            if rng.random() > (0.95 if i < n_hdr or j == 0 else 0.8):
+                continue
+            x0, x1 = lefts[j], lefts[j] + widths[j]
+            if span and i == 0 and j == span[0]:
+                x1 = lefts[span[1]] + widths[span[1]]
+            for ln in range(2 if rng.random() < 0.08 else 1):
+                top = tops[i] + ln * heights[i] / 2
+                b = {"x0": jit(x0 + 2), "x1": jit(min(x1 - 2, x0 + rng.uniform(20, x1 - x0))),
+                     "top": jit(top + 1, 1), "bottom": jit(top + (heights[i] / 2 if ln else heights[i]) - 1, 1),
+                     "text": text(i, j), "layout_type": "table",
+                     "page_number": 1 if cross and i >= n_rows // 2 else 0}
+                if b["x1"] <= b["x0"]:
+                    b["x1"] = b["x0"] + 8
+                if b["bottom"] <= b["top"]:
+                    b["bottom"] = b["top"] + 6
+                if tag_rows and rng.random() < 0.95:
+                    b.update({"R": i, "R_top": jit(tops[i]), "R_bott": jit(tops[i] + heights[i])})
+                if i < n_hdr:
+                    b.update({"H": i, "H_top": jit(tops[i]), "H_bott": jit(tops[i] + heights[i]),
+                              "H_left": jit(lefts[0]), "H_right": jit(lefts[-1] + widths[-1])})
+                if tag_cols and rng.random() < 0.95:
+                    b.update({"C": j, "C_left": jit(lefts[j]), "C_right": jit(lefts[j] + widths[j])})
+                if span and i == 0 and j == span[0]:
+                    b.update({"SP": 0, "H_top": jit(tops[0]), "H_bott": jit(tops[0] + heights[0]),
+                              "H_left": jit(x0), "H_right": jit(x1)})
+                if vspan and j == 0 and i == vspan[0]:
+                    b.update({"SP": 1, "H_top": jit(tops[i]), "H_bott": jit(tops[vspan[1]] + heights[vspan[1]]),
+                              "H_left": jit(x0), "H_right": jit(x1)})
+                boxes.append(b)
+    if n_rows >= 4 and rng.random() < 0.15:
+        # A stray box in a column of its own.
+        i = rng.randint(n_hdr, n_rows - 1)
+        x0 = lefts[-1] + widths[-1] + 30
+        boxes.append({"x0": x0, "x1": x0 + 30, "top": jit(tops[i] + 1, 1), "bottom": jit(tops[i] + heights[i] - 1, 1),
+                      "text": "*", "layout_type": "table", "page_number": 0})
+    rng.shuffle(boxes)
+    return boxes
+
+
+def synth(args):
+    if not os.path.exists(args.output_dir):
+        os.mkdir(args.output_dir)
+    rng = random.Random(args.seed)
+    n, tries = 0, 0
+    while n < args.cases:
+        tries += 1
+        n_rows, n_cols = (rng.randint(30, 80), rng.randint(6, 12)) if n % 10 == 9 else \
+            (rng.randint(1, 16), rng.randint(1, 8))
+        boxes = synth_case(rng, n_rows, n_cols)
+        try:
+            res = outputs(boxes)
+        except Exception as e:
+            # Not a table construct_table takes, so nothing to compare.
+            print("skip case {}: {}".format(tries, repr(e)))
+            continue
+        path = os.path.join(args.output_dir, "synth_{:03d}_{}x{}.json".format(n, n_rows, n_cols))
+        with open(path, "w") as f:
+            json.dump({"boxes": boxes, "outputs": res}, f, ensure_ascii=False)
+        n += 1
+    print("{} cases saved to {}".format(n, args.output_dir))
+
+
+def check(args):
+    names = sorted([n for n in os.listdir(args.output_dir) if n.endswith(".json")])
+    failed = 0
+    for nm in names:
+        with open(os.path.join(args.output_dir, nm)) as f:
+            case = json.load(f)
+        res = json.loads(json.dumps(outputs(case["boxes"]), ensure_ascii=False))
+        for k, expected in case["outputs"].items():
+            if res[k] == expected:
+                continue
+            failed += 1
+            print("{} ({}) differs:".format(nm, k))
+            a = expected if isinstance(expected, list) else expected.split("\n")
+            b = res[k] if isinstance(res[k], list) else res[k].split("\n")
+            for line in unified_diff(a, b, "saved", "current", lineterm="", n=1):
+                print("    " + line)
+    print("{} crops, {} outputs differ.".format(len(names), failed))
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', help="save: build the corpus from crops; synth: from random tables; "
+                                       "check: compare with it",
+                        choices=["save", "synth", "check"], required=True)
+    parser.add_argument('--inputs',
+                        help="Directory where to store images or PDFs of table crops, or a file path to one")
+    parser.add_argument('--output_dir', help="Directory of the corpus. Default: './tsr_corpus'",
+                        default="./tsr_corpus")
+    parser.add_argument('--threshold', help="Table structure detection threshold. Default: 0.2", default=0.2)
+    parser.add_argument('--cases', help="Number of random tables to synth. Default: 60", type=int, default=60)
+    parser.add_argument('--seed', help="Random seed of synth. Default: 0", type=int, default=0)
+    args = parser.parse_args()
+    if args.mode == "save":
+        if not args.inputs:
+            parser.error("--inputs is required to save")
+        save(args)
+    elif args.mode == "synth":
+        synth(args)
+    elif check(args):
+        sys.exit(1)
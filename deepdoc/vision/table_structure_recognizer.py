@@ -129,6 +129,40 @@ class TableStructureRecognizer(Recognizer):
 
         return "Ot"
 
+    @staticmethod
+    def __sort_firstly(arr, first, second, threshold):
+        """
+        The order of Recognizer.sort_Y_firstly (first="top", second="x0") or
+        sort_X_firstly (first="x0", second="top"), without copying the boxes:
+        the same adjacent swaps are made on their keys.
+        """
+        arr = sorted(arr, key=lambda r: (r[first], r[second]))
+        f = [r[first] for r in arr]
+        s = [r[second] for r in arr]
+        order = list(range(len(arr)))
+        for i in range(len(arr) - 1):
+            for j in range(i, -1, -1):
+                a, b = order[j], order[j + 1]
+                if abs(f[b] - f[a]) < threshold and s[b] < s[a]:
+                    order[j], order[j + 1] = b, a
+        return [arr[k] for k in order]
+
+    @staticmethod
+    def __sort_by(arr, key, second):
+        """The second pass of Recognizer.sort_R_firstly (key="R") or sort_C_firstly (key="C"), on the keys."""
+        has = [key in r for r in arr]
+        k = [r.get(key) for r in arr]
+        s = [r[second] for r in arr]
+        order = list(range(len(arr)))
+        for i in range(len(arr) - 1):
+            for j in range(i, -1, -1):
+                a, b = order[j], order[j + 1]
+                if not has[a] or not has[b]:
+                    continue
+                if k[b] < k[a] or (k[b] == k[a] and s[b] < s[a]):
+                    order[j], order[j + 1] = b, a
+        return [arr[i] for i in order]
+
     @staticmethod
     def construct_table(boxes, is_english=False, html=False):
         cap = ""
@@ -144,15 +178,21 @@ class TableStructureRecognizer(Recognizer):
 
         if not boxes:
             return []
+        # Only the text decides the type, and numbers and labels repeat a lot in tables.
+        btypes = {}
         for b in boxes:
-            b["btype"] = TableStructureRecognizer.blockType(b)
+            if b["text"] not in btypes:
+                btypes[b["text"]] = TableStructureRecognizer.blockType(b)
+            b["btype"] = btypes[b["text"]]
         max_type = Counter([b["btype"] for b in boxes]).items()
         max_type = max(max_type, key=lambda x: x[1])[0] if max_type else ""
         logging.debug("MAXTYPE: " + max_type)
 
         rowh = [b["R_bott"] - b["R_top"] for b in boxes if "R" in b]
         rowh = np.min(rowh) if rowh else 0
-        boxes = Recognizer.sort_R_firstly(boxes, rowh / 2)
+        # Recognizer's sorts deep-copy every box they swap; these give the same orders in place.
+        boxes = TableStructureRecognizer.__sort_by(
+            TableStructureRecognizer.__sort_firstly(boxes, "top", "x0", rowh / 2), "R", "x0")
         #for b in boxes:print(b)
         boxes[0]["rn"] = 0
         rows = [[boxes[0]]]
@@ -173,10 +213,9 @@ class TableStructureRecognizer(Recognizer):
         colwm = [b["C_right"] - b["C_left"] for b in boxes if "C" in b]
         colwm = np.min(colwm) if colwm else 0
         crosspage = len(set([b["page_number"] for b in boxes])) > 1
-        if crosspage:
-            boxes = Recognizer.sort_X_firstly(boxes, colwm / 2, False)
-        else:
-            boxes = Recognizer.sort_C_firstly(boxes, colwm / 2)
+        boxes = TableStructureRecognizer.__sort_firstly(boxes, "x0", "top", colwm / 2)
+        if not crosspage:
+            boxes = TableStructureRecognizer.__sort_by(boxes, "C", "top")
         boxes[0]["cn"] = 0
         cols = [[boxes[0]]]
         right = boxes[0]["x1"]
@@ -367,7 +406,7 @@ class TableStructureRecognizer(Recognizer):
                     h = min(np.min([c["bottom"] - c["top"]
                             for c in arr]) / 2, 10)
                     txt = " ".join([c["text"]
-                                   for c in Recognizer.sort_Y_firstly(arr, h)])
+                                   for c in TableStructureRecognizer.__sort_firstly(arr, "top", "x0", h)])
                 txts.append(txt)
                 sp = ""
                 if arr[0].get("colspan"):
@@ -508,29 +547,17 @@ class TableStructureRecognizer(Recognizer):
                 for row in rows]
         rbtm = [np.mean([c.get("R_btm", c["bottom"])
                          for c in row]) for row in rows]
+        clft, crgt, rtop, rbtm = np.array(clft), np.array(crgt), np.array(rtop), np.array(rbtm)
+        # A spanning cell covers the columns and rows whose middles fall inside it.
+        cmid_l, cmid_r = clft + (crgt - clft) / 2, crgt - (crgt - clft) / 2
+        rmid_t, rmid_b = rtop + (rbtm - rtop) / 2, rbtm - (rbtm - rtop) / 2
         for b in boxes:
             if "SP" not in b:
                 continue
-            b["colspan"] = [b["cn"]]
-            b["rowspan"] = [b["rn"]]
-            # col span
-            for j in range(0, len(clft)):
-                if j == b["cn"]:
-                    continue
-                if clft[j] + (crgt[j] - clft[j]) / 2 < b["H_left"]:
-                    continue
-                if crgt[j] - (crgt[j] - clft[j]) / 2 > b["H_right"]:
-                    continue
-                b["colspan"].append(j)
-            # row span
-            for j in range(0, len(rtop)):
-                if j == b["rn"]:
-                    continue
-                if rtop[j] + (rbtm[j] - rtop[j]) / 2 < b["H_top"]:
-                    continue
-                if rbtm[j] - (rbtm[j] - rtop[j]) / 2 > b["H_bott"]:
-                    continue
-                b["rowspan"].append(j)
+            in_cols = np.flatnonzero((cmid_l >= b["H_left"]) & (cmid_r <= b["H_right"]))
+            in_rows = np.flatnonzero((rmid_t >= b["H_top"]) & (rmid_b <= b["H_bott"]))
+            b["colspan"] = [b["cn"]] + [int(j) for j in in_cols if j != b["cn"]]
+            b["rowspan"] = [b["rn"]] + [int(j) for j in in_rows if j != b["rn"]]
 
         def join(arr):
             if not arr:
@@ -51,9 +51,9 @@ class Pdf(PdfParser):
         callback(0.75, "Text merging finished.")
 
         # clean mess
-        if column_width < self.page_images[0].size[0] / zoomin / 2:
+        if column_width < self.page_images[0].size[0] / self._zm(zoomin) / 2:
             print("two_column...................", column_width,
-                  self.page_images[0].size[0] / zoomin / 2)
+                  self.page_images[0].size[0] / self._zm(zoomin) / 2)
             self.boxes = self.sort_X_by_page(self.boxes, column_width / 2)
         for b in self.boxes:
             b["text"] = re.sub(r"([\t 　]|\u3000){2,}", " ", b["text"].strip())
@@ -20,10 +20,13 @@ from api.db.services.llm_service import LLMBundle
 from rag.nlp import tokenize
 from deepdoc.vision import OCR
 
-ocr = OCR()
+ocr = None
 
 
 def chunk(filename, binary, tenant_id, lang, callback=None, **kwargs):
+    global ocr
+    if ocr is None:
+        ocr = OCR()
     img = Image.open(io.BytesIO(binary)).convert('RGB')
     doc = {
         "docnm_kwd": filename,
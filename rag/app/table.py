@@ -11,66 +11,111 @@
 #  limitations under the License.
 #
 import copy
+import csv
+import io
 import re
-from io import BytesIO
+import warnings
+from collections import deque
+from itertools import chain, islice
 from xpinyin import Pinyin
 import numpy as np
 import pandas as pd
-from openpyxl import load_workbook
 from dateutil.parser import parse as datetime_parse
 
 from api.db.services.knowledgebase_service import KnowledgebaseService
-from deepdoc.parser.utils import get_text
-from rag.nlp import rag_tokenizer, tokenize
+from rag.nlp import rag_tokenizer, tokenize, find_codec
 from deepdoc.parser import ExcelParser
 
 
 class Excel(ExcelParser):
     def __call__(self, fnm, binary=None, from_page=0,
                  to_page=10000000000, callback=None):
-        if not binary:
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(binary))
-        total = 0
-        for sheetname in wb.sheetnames:
-            total += len(list(wb[sheetname].rows))
-
+        # Rows are streamed, and only those in [from_page, to_page) are kept.
+        wb = self._load_workbook(binary if binary else fnm)
         res, fails, done = [], [], 0
         rn = 0
-        for sheetname in wb.sheetnames:
-            ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:continue
-            headers = [cell.value for cell in rows[0]]
-            missed = set([i for i, h in enumerate(headers) if h is None])
-            headers = [
-                cell.value for i,
-                cell in enumerate(
-                    rows[0]) if i not in missed]
-            if not headers:continue
-            data = []
-            for i, r in enumerate(rows[1:]):
-                rn += 1
-                if rn - 1 < from_page:
-                    continue
-                if rn - 1 >= to_page:
+        try:
+            for sheetname in wb.sheetnames:
+                if rn >= to_page:
                     break
-                row = [
-                    cell.value for ii,
-                    cell in enumerate(r) if ii not in missed]
-                if len(row) != len(headers):
-                    fails.append(str(i))
-                    continue
-                data.append(row)
-                done += 1
-            res.append(pd.DataFrame(np.array(data), columns=headers))
+                rows = self._sheet(wb, sheetname).iter_rows(values_only=True)
+                headers = next(rows, None)
+                if headers is None:continue
+                missed = set([i for i, h in enumerate(headers) if h is None])
+                headers = [h for i, h in enumerate(headers) if i not in missed]
+                if not headers:continue
+                data = []
+                for i, r in enumerate(rows):
+                    rn += 1
+                    if rn - 1 < from_page:
+                        continue
+                    if rn - 1 >= to_page:
+                        break
+                    row = [v for ii, v in enumerate(r) if ii not in missed]
+                    if len(row) != len(headers):
+                        fails.append(str(i))
+                        continue
+                    data.append(row)
+                    done += 1
+                # A sheet before the window has no rows in it.
+                if data:
+                    res.append(pd.DataFrame(np.array(data), columns=headers))
+        finally:
+            wb.close()
 
         callback(0.3, ("Extract records: {}~{}".format(from_page + 1, min(to_page, from_page + rn)) + (
             f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
         return res
 
 
+def read_csv(fnm, binary=None, delimiter="\t", from_page=0, to_page=10000000000, callback=None):
+    """
+    The rows [from_page, to_page) of a delimited text file as a DataFrame of
+    strings, the first line being the headers. Lines before the window are
+    skipped without being kept, and the window is parsed by pandas in one go,
+    so memory follows the window, not the file.
+
+    Fields are split on the delimiter with no quoting. A line with more fields
+    than the headers is reported as a failure, a shorter one is padded with
+    empty fields.
+    """
+    if binary:
+        encoding, stream = find_codec(binary), io.BytesIO(binary)
+    else:
+        with open(fnm, "rb") as f:
+            encoding = find_codec(f.read(1024 * 1024))
+        stream = open(fnm, "rb")
+
+    with io.TextIOWrapper(stream, encoding=encoding, errors="ignore", newline="\n") as f:
+        headers = f.readline().rstrip("\r\n").split(delimiter)
+        deque(islice(f, from_page), maxlen=0)
+        # Led by a line of as many fields as the headers: pandas takes the fields
+        # of a first line longer than that for an index instead of reporting it.
+        lead = delimiter * (len(headers) - 1) + "\n"
+        window = "".join(chain([lead], islice(f, max(0, to_page - from_page)))).replace("\r\n", "\n")
+
+    if len(delimiter) == 1:
+        opts = {"sep": delimiter, "engine": "c", "lineterminator": "\n"}
+    else:
+        opts = {"sep": re.escape(delimiter), "engine": "python"}
+    # Lines with too many fields are only reported through warnings.
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", pd.errors.ParserWarning)
+        # Positional names, as headers may repeat.
+        df = pd.read_csv(io.StringIO(window), header=None, names=list(range(len(headers))),
+                         dtype=str, na_filter=False, quoting=csv.QUOTE_NONE, skip_blank_lines=False,
+                         on_bad_lines="warn", **opts)
+    df = df.iloc[1:].reset_index(drop=True).fillna("")
+    df.columns = headers
+    fails = [str(from_page + int(n) - 2) for w in caught
+             for n in re.findall(r"Skipping line ([0-9]+)", str(w.message))]
+
+    n = window.count("\n") - 1 + (0 if window.endswith("\n") else 1)
+    callback(0.3, ("Extract records: {}~{}".format(from_page, from_page + n) + (
+        f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
+    return df
+
+
 def trans_datatime(s):
     try:
         return datetime_parse(s.strip()).strftime("%Y-%m-%d %H:%M:%S")
@@ -86,15 +131,47 @@ def trans_bool(s):
         return "no"
 
 
+# Values the type of a column is voted on by, evenly spread over the column.
+TYPE_SAMPLE_SIZE = 1024
+
+
+def trans_datatime_column(s):
+    """trans_datatime of a Series of strings: parsed by pandas, and value by value where it can't."""
+    s = s.str.strip()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        try:
+            res = pd.to_datetime(s, errors="coerce").dt.strftime("%Y-%m-%d %H:%M:%S")
+        except (ValueError, TypeError, AttributeError):
+            res = pd.Series(np.nan, index=s.index, dtype=object)
+    rest = res.isna()
+    if rest.any():
+        res = res.astype(object)
+        res[rest] = s[rest].map(trans_datatime)
+    return res
+
+
+def trans_bool_column(s):
+    s = s.str.strip()
+    return pd.Series(np.select([s.str.fullmatch(r"true|yes|是|\*|✓|✔|☑|✅|√", case=False),
+                                s.str.fullmatch(r"false|no|否|⍻|×", case=False)],
+                               ["yes", "no"], None), index=s.index)
+
+
 def column_data_type(arr):
-    arr = list(arr)
-    uni = len(set([a for a in arr if a is not None]))
+    """
+    Votes the type of the column `arr` on a sample of its values, then converts
+    the whole column to it. Returns the values, None where missing or not
+    convertible, and the type.
+    """
+    arr = pd.Series(arr, dtype=object).reset_index(drop=True)
+    res = pd.Series([None] * len(arr), dtype=object)
+    arr = arr[arr.notna()]
     counts = {"int": 0, "float": 0, "text": 0, "datetime": 0, "bool": 0}
-    trans = {t: f for f, t in
-             [(int, "int"), (float, "float"), (trans_datatime, "datetime"), (trans_bool, "bool"), (str, "text")]}
-    for a in arr:
-        if a is None:
-            continue
+    sample = arr
+    if len(sample) > TYPE_SAMPLE_SIZE:
+        sample = sample.iloc[::len(sample) // TYPE_SAMPLE_SIZE][:TYPE_SAMPLE_SIZE]
+    for a in sample:
         if re.match(r"[+-]?[0-9]+(\.0+)?$", str(a).replace("%%", "")):
             counts["int"] += 1
         elif re.match(r"[+-]?[0-9.]+$", str(a).replace("%%", "")):
@@ -107,17 +184,24 @@ def column_data_type(arr):
             counts["text"] += 1
     counts = sorted(counts.items(), key=lambda x: x[1] * -1)
     ty = counts[0][0]
-    for i in range(len(arr)):
-        if arr[i] is None:
-            continue
-        try:
-            arr[i] = trans[ty](str(arr[i]))
-        except Exception as e:
-            arr[i] = None
+
+    txt = arr.astype(str)
+    if ty in ["int", "float"]:
+        vals = pd.to_numeric(txt.str.strip(), errors="coerce", dtype_backend="numpy_nullable").dropna()
+        if ty == "int":
+            vals = vals[(vals % 1 == 0) & (vals.abs() < 2 ** 63)].astype(np.int64)
+    elif ty == "datetime":
+        vals = trans_datatime_column(txt)
+    elif ty == "bool":
+        vals = trans_bool_column(txt)
+    else:
+        vals = txt
+    vals = vals.dropna()
+    res[vals.index] = vals.astype(object)
     # if ty == "text":
     #    if len(arr) > 128 and uni / len(arr) < 0.1:
     #        ty = "keyword"
-    return arr, ty
+    return res.tolist(), ty
 
 
 def chunk(filename, binary=None, from_page=0, to_page=10000000000,
@@ -147,26 +231,8 @@ def chunk(filename, binary=None, from_page=0, to_page=10000000000,
             callback=callback)
     elif re.search(r"\.(txt|csv)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
-        txt = get_text(filename, binary)
-        lines = txt.split("\n")
-        fails = []
-        headers = lines[0].split(kwargs.get("delimiter", "\t"))
-        rows = []
-        for i, line in enumerate(lines[1:]):
-            if i < from_page:
-                continue
-            if i >= to_page:
-                break
-            row = [l for l in line.split(kwargs.get("delimiter", "\t"))]
-            if len(row) != len(headers):
-                fails.append(str(i))
-                continue
-            rows.append(row)
-
-        callback(0.3, ("Extract records: {}~{}".format(from_page, min(len(lines), to_page)) + (
-            f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
-
-        dfs = [pd.DataFrame(np.array(rows), columns=headers)]
+        dfs = [read_csv(filename, binary, kwargs.get("delimiter", "\t"),
+                        from_page=from_page, to_page=to_page, callback=callback)]
 
     else:
         raise NotImplementedError(
@@ -194,34 +260,34 @@ def chunk(filename, binary=None, from_page=0, to_page=10000000000,
                     "",
                     str(n)),
                 '_')[0] for n in clmns]
-        clmn_tys = []
+        clmn_tys, clns = [], []
         for j in range(len(clmns)):
-            cln, ty = column_data_type(df[clmns[j]])
+            cln, ty = column_data_type(df.iloc[:, j])
             clmn_tys.append(ty)
-            df[clmns[j]] = cln
+            clns.append(cln)
             if ty == "text":
                 txts.extend([str(c) for c in cln if c])
         clmns_map = [(py_clmns[i].lower() + fieds_map[clmn_tys[i]], str(clmns[i]).replace("_", " "))
                      for i in range(len(clmns))]
 
         eng = lang.lower() == "english"  # is_english(txts)
-        for ii, row in df.iterrows():
+        title_tks = rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", filename))
+        for row in zip(*clns):
             d = {
                 "docnm_kwd": filename,
-                "title_tks": rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", filename))
+                "title_tks": title_tks
             }
             row_txt = []
             for j in range(len(clmns)):
-                if row[clmns[j]] is None:
+                if row[j] is None:
                     continue
-                if not str(row[clmns[j]]):
+                if not str(row[j]):
                     continue
-                if pd.isna(row[clmns[j]]):
+                if pd.isna(row[j]):
                     continue
                 fld = clmns_map[j][0]
-                d[fld] = row[clmns[j]] if clmn_tys[j] != "text" else rag_tokenizer.tokenize(
-                    row[clmns[j]])
-                row_txt.append("{}:{}".format(clmns[j], row[clmns[j]]))
+                d[fld] = row[j] if clmn_tys[j] != "text" else rag_tokenizer.tokenize(row[j])
+                row_txt.append("{}:{}".format(clmns[j], row[j]))
             if not row_txt:
                 continue
             tokenize(d, "; ".join(row_txt), eng)
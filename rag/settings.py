@@ -35,6 +35,41 @@ except Exception as e:
     pass
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
 
+# Task executor pipeline: fetch -> chunk -> embed -> index stages joined by bounded queues
+TASK_PIPELINE = int(os.environ.get("TASK_PIPELINE", "0"))
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 4))
+PIPELINE_FETCH_WORKERS = int(os.environ.get("PIPELINE_FETCH_WORKERS", 2))
+PIPELINE_CHUNK_WORKERS = int(os.environ.get("PIPELINE_CHUNK_WORKERS", 2))
+PIPELINE_EMBED_WORKERS = int(os.environ.get("PIPELINE_EMBED_WORKERS", 2))
+PIPELINE_INDEX_WORKERS = int(os.environ.get("PIPELINE_INDEX_WORKERS", 2))
+
+# Task progress is buffered by the executor and written at most every PROGRESS_FLUSH_INTERVAL seconds
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL", 3))
+
+# Elasticsearch bulk indexing: payload bytes per request, requests in flight and
+# the chunk count from which refresh is switched off while loading
+ES_BULK_BYTES = int(os.environ.get("ES_BULK_BYTES", 8 * 1024 * 1024))
+ES_BULK_CONCURRENCY = int(os.environ.get("ES_BULK_CONCURRENCY", 4))
+ES_BULK_NO_REFRESH_CHUNKS = int(os.environ.get("ES_BULK_NO_REFRESH_CHUNKS", 1024))
+# Seconds a load's hold on the ingest settings of an index lasts unless renewed
+ES_INGEST_LEASE = int(os.environ.get("ES_INGEST_LEASE", 120))
+
+# Executor-local blob cache, 0 disables it
+BLOB_CACHE_DIR = os.environ.get("BLOB_CACHE_DIR", os.path.join(get_project_base_directory(), "temp", "blob_cache"))
+BLOB_CACHE_SIZE = int(os.environ.get("BLOB_CACHE_SIZE", 2 * 1024 * 1024 * 1024))
+
+# Embedding cache: in-process LRU entries and TTL of the copy shared through Redis, 0 disables either
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 24 * 3600))
+
+# Bucket keeping deepdoc's OCR, layout and table results of PDFs for re-chunking; empty disables it
+DEEPDOC_CACHE_BUCKET = os.environ.get("DEEPDOC_CACHE_BUCKET", "")
+
+# Task executor supervisor: forked consumers scaled on the task queue backlog
+TASK_EXECUTOR_MIN_WORKERS = int(os.environ.get("TASK_EXECUTOR_MIN_WORKERS", 1))
+TASK_EXECUTOR_MAX_WORKERS = int(os.environ.get("TASK_EXECUTOR_MAX_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
+TASK_EXECUTOR_SCALE_INTERVAL = int(os.environ.get("TASK_EXECUTOR_SCALE_INTERVAL", 30))
+
 # Logger
 LoggerFactory.set_directory(
     os.path.join(
@@ -63,3 +98,19 @@ SVR_QUEUE_RETENTION = 60*60
 SVR_QUEUE_MAX_LEN = 1024
 SVR_CONSUMER_NAME = "rag_flow_svr_consumer"
 SVR_CONSUMER_GROUP_NAME = "rag_flow_svr_consumer_group"
+SVR_TASK_BROKER_GROUP_NAME = "rag_flow_svr_task_broker"
+SVR_QUEUE_PREFETCH = int(os.environ.get("SVR_QUEUE_PREFETCH", 1))
+SVR_QUEUE_CLAIM_IDLE = int(os.environ.get("SVR_QUEUE_CLAIM_IDLE", 600))
+SVR_QUEUE_PRIORITY_DOC_SIZE = int(os.environ.get("SVR_QUEUE_PRIORITY_DOC_SIZE", 2 * 1024 * 1024))
+ES_INGEST_KEY = "es_ingest:{}"
+INCREMENTAL_RUN_KEY = "incremental:{}:{}"
+# The run of a document whose stale chunks are still to be removed
+INCREMENTAL_DOC_KEY = "incremental_doc:{}"
+INCREMENTAL_RUN_EXP = 7 * 24 * 3600
+TASK_CANCEL_KEY = "{}-cancel"
+TASK_CANCEL_EXP = 24 * 3600
+TASK_PROGRESS_EVENTS = "svr_task_progress_events"
+# TTL of the whole event set, renewed by every event: it only goes away when no
+# server has drained it for that long, and the reconcile scan covers what it held
+TASK_PROGRESS_EVENTS_EXP = int(os.environ.get("TASK_PROGRESS_EVENTS_EXP", 600))
+DOC_PROGRESS_RECONCILE_INTERVAL = int(os.environ.get("DOC_PROGRESS_RECONCILE_INTERVAL", 60))
@@ -19,8 +19,11 @@ import logging
 import os
 import hashlib
 import copy
+import queue
 import re
+import signal
 import sys
+import threading
 import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor
@@ -31,12 +34,12 @@ from timeit import default_timer as timer
 
 import numpy as np
 import pandas as pd
-from elasticsearch_dsl import Q
+from elasticsearch_dsl import Q, Search
 
 from api.db import LLMType, ParserType
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
-from api.db.services.task_service import TaskService
+from api.db.services.task_service import TaskService, has_canceled
 from api.db.services.file2document_service import File2DocumentService
 from api.settings import retrievaler
 from api.utils.file_utils import get_project_base_directory
@@ -44,12 +47,17 @@ from api.db.db_models import close_connection
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one, audio, knowledge_graph, email
 from rag.nlp import search, rag_tokenizer
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
-from rag.settings import database_logger, SVR_QUEUE_NAME
-from rag.settings import cron_logger, DOC_MAXIMUM_SIZE
+from rag.settings import database_logger, INCREMENTAL_RUN_KEY, INCREMENTAL_RUN_EXP, INCREMENTAL_DOC_KEY
+from rag.settings import cron_logger, DOC_MAXIMUM_SIZE, ES_BULK_NO_REFRESH_CHUNKS, PROGRESS_FLUSH_INTERVAL
+from rag.settings import TASK_PIPELINE, PIPELINE_QUEUE_SIZE, PIPELINE_FETCH_WORKERS, PIPELINE_CHUNK_WORKERS, \
+    PIPELINE_EMBED_WORKERS, PIPELINE_INDEX_WORKERS
 from rag.utils import rmSpace, num_tokens_from_string
+from rag.utils.blob_cache import BLOB_CACHE
+from rag.utils.embedding_cache import EMBEDDING_CACHE
 from rag.utils.es_conn import ELASTICSEARCH
 from rag.utils.redis_conn import REDIS_CONN, Payload
 from rag.utils.storage_factory import STORAGE_IMPL
+from rag.utils.task_queue import TASK_QUEUE
 
 BATCH_SIZE = 64
 
@@ -73,13 +81,77 @@ FACTORY = {
 
 CONSUMER_NAME = "task_consumer_" + ("0" if len(sys.argv) < 2 else sys.argv[1])
 PAYLOAD: Payload | None = None
+STOP = threading.Event()
+
+
+class TaskCanceledException(Exception):
+    pass
+
+
+class ProgressReporter:
+    """
+    Buffers task progress in memory and writes it to the DB at most every
+    `interval` seconds, one coalesced update per task. Final states are written
+    at once.
+
+    Each flush also checks the DB for the cancellation of the tasks it wrote,
+    which catches cancels that never reached Redis (see `set_progress`).
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}
+        self.canceled = set()
+
+    def report(self, task_id, prog=None, msg=""):
+        with self.lock:
+            d = self.pending.setdefault(task_id, {"progress_msg": []})
+            if msg:
+                d["progress_msg"].append(msg)
+            if prog is not None:
+                d["progress"] = prog
+
+    def flush(self, task_id=None):
+        # Writes must not overtake each other, or a stale progress could land last.
+        with self.flush_lock:
+            with self.lock:
+                if task_id is None:
+                    pending, self.pending = self.pending, {}
+                else:
+                    pending = {task_id: self.pending.pop(task_id)} if task_id in self.pending else {}
+            for tid, d in pending.items():
+                d["progress_msg"] = "\n".join(d["progress_msg"])
+                try:
+                    TaskService.update_progress(tid, d)
+                    if d.get("progress", 0) >= 0 and TaskService.do_cancel(tid):
+                        with self.lock:
+                            self.canceled.add(tid)
+                except Exception as e:
+                    cron_logger.error("set_progress:({}), {}".format(tid, str(e)))
+            if pending:
+                close_connection()
+
+    def is_canceled(self, task_id):
+        with self.lock:
+            return task_id in self.canceled
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+PROGRESS = ProgressReporter(PROGRESS_FLUSH_INTERVAL)
 
 
 def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing..."):
-    global PAYLOAD
     if prog is not None and prog < 0:
         msg = "[ERROR]" + msg
-    cancel = TaskService.do_cancel(task_id)
+    # Redis carries the cancels of cancel_all_task_of at once; the DB check of the
+    # flushes catches the others (cancelled documents, lost or evicted keys).
+    cancel = has_canceled(task_id) or PROGRESS.is_canceled(task_id)
     if cancel:
         msg += " [Canceled]"
         prog = -1
@@ -87,28 +159,24 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
     if to_page > 0:
         if msg:
             msg = f"Page({from_page + 1}~{to_page + 1}): " + msg
-    d = {"progress_msg": msg}
-    if prog is not None:
-        d["progress"] = prog
-    try:
-        TaskService.update_progress(task_id, d)
-    except Exception as e:
-        cron_logger.error("set_progress:({}), {}".format(task_id, str(e)))
+    PROGRESS.report(task_id, prog, msg)
+    if prog is not None and (prog >= 1 or prog < 0):
+        PROGRESS.flush(task_id)
 
-    close_connection()
     if cancel:
-        if PAYLOAD:
-            PAYLOAD.ack()
-            PAYLOAD = None
-        os._exit(0)
+        # Unwinds the task, so the context managers on the way (e.g. the index's
+        # ingest settings) are left cleanly; the message is acked by the caller.
+        raise TaskCanceledException(task_id)
 
 
-def collect():
+def collect(recover=True):
     global CONSUMER_NAME, PAYLOAD
     try:
-        PAYLOAD = REDIS_CONN.get_unacked_for(CONSUMER_NAME, SVR_QUEUE_NAME, "rag_flow_svr_task_broker")
+        PAYLOAD = None
+        if recover:
+            PAYLOAD = TASK_QUEUE.get_unacked_for(CONSUMER_NAME)
         if not PAYLOAD:
-            PAYLOAD = REDIS_CONN.queue_consumer(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME)
+            PAYLOAD = TASK_QUEUE.consume(CONSUMER_NAME)
         if not PAYLOAD:
             time.sleep(1)
             return pd.DataFrame()
@@ -131,25 +199,26 @@ def collect():
     tasks = pd.DataFrame(tasks)
     if msg.get("type", "") == "raptor":
         tasks["task_type"] = "raptor"
+    if msg.get("incremental"):
+        tasks["incremental"] = msg["incremental"]
     return tasks
 
 
 def get_storage_binary(bucket, name):
-    return STORAGE_IMPL.get(bucket, name)
+    return BLOB_CACHE.get(bucket, name)
 
 
-def build(row):
+def fetch(row):
     if row["size"] > DOC_MAXIMUM_SIZE:
         set_progress(row["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
                                              (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
-        return []
+        return
 
     callback = partial(
         set_progress,
         row["id"],
         row["from_page"],
         row["to_page"])
-    chunker = FACTORY[row["parser_id"].lower()]
     try:
         st = timer()
         bucket, name = File2DocumentService.get_storage_address(doc_id=row["doc_id"])
@@ -168,13 +237,33 @@ def build(row):
             callback(-1, "Get file from minio: %s" % str(e).replace("'", ""))
         traceback.print_exc()
         return
+    if binary is None:
+        callback(-1, "Can not find file <%s> from minio. Could you try it again?" % row["name"])
+        return
+    return binary
 
+
+def build(row, binary=None):
+    if binary is None:
+        binary = fetch(row)
+        if binary is None:
+            return
+
+    callback = partial(
+        set_progress,
+        row["id"],
+        row["from_page"],
+        row["to_page"])
+    chunker = FACTORY[row["parser_id"].lower()]
     try:
+        st = timer()
         cks = chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
                             to_page=row["to_page"], lang=row["language"], callback=callback,
                             kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
         cron_logger.info(
             "Chunking({}) {}/{}".format(timer() - st, row["location"], row["name"]))
+    except TaskCanceledException:
+        raise
     except Exception as e:
         callback(-1, "Internal server error while chunking: %s" %
                      str(e).replace("'", ""))
@@ -232,6 +321,95 @@ def init_kb(row):
         open(os.path.join(get_project_base_directory(), "conf", "mapping.json"), "r")))
 
 
+def diff_chunks(r, cks):
+    """
+    For an incremental re-parse, splits the built chunks into the ones missing from
+    the index and updates of the indexed ones. Every chunk of the run is stamped
+    with its id, so the chunks left unstamped at the end are the stale ones.
+    """
+    init_kb(r)
+    idxnm = search.index_name(r["tenant_id"])
+    run_id = r["incremental"]
+    fields = ["page_num_int", "position_int", "top_int"]
+    ids = list(set([c["_id"] for c in cks]))
+    existing = {}
+    for i in range(0, len(ids), 1000):
+        q = Search().query(Q("ids", values=ids[i:i + 1000]))[0:1000].to_dict()
+        for d in ELASTICSEARCH.getSource(ELASTICSEARCH.search(q, idxnm=idxnm, src=fields, timeout="600s")):
+            existing[d["id"]] = d
+
+    def norm(v):
+        return json.dumps(v, default=str)
+
+    new, updates, moved = [], {}, 0
+    for c in cks:
+        if c["_id"] not in existing:
+            c["incremental_run_kwd"] = run_id
+            new.append(c)
+            continue
+        d = updates.setdefault(c["_id"], {"_id": c["_id"], "incremental_run_kwd": run_id})
+        if len(d) == 2 and any(norm(c.get(f)) != norm(existing[c["_id"]].get(f)) for f in fields):
+            d.update({f: c[f] for f in fields if f in c})
+            moved += 1
+    cron_logger.info("Incremental({}): {} new, {} moved, {} unchanged".format(
+        r["name"], len(new), moved, len(cks) - len(new) - moved))
+    return new, list(updates.values())
+
+
+def finish_incremental(r):
+    """
+    Counts this task done. The last task of the run removes the chunks of the
+    document that no task of the run stamped, and takes their counts off.
+    A run with a failed task never gets there, so its stale chunks are left to
+    the next re-parse, which is a full one (see document_app.run).
+    """
+    run_id = r["incremental"]
+    key = partial(INCREMENTAL_RUN_KEY.format, run_id)
+    if not REDIS_CONN.sadd(key("done"), [r["id"]], INCREMENTAL_RUN_EXP):
+        return
+    total = REDIS_CONN.get(key("tasks"))
+    if not total or REDIS_CONN.scard(key("done")) != int(total):
+        return
+    # Tasks finishing at once may all see the run complete; one of them cleans up.
+    if not REDIS_CONN.setnx(key("finished"), r["id"], INCREMENTAL_RUN_EXP):
+        return
+    doc_key = INCREMENTAL_DOC_KEY.format(r["doc_id"])
+    if REDIS_CONN.get(doc_key) != run_id:
+        cron_logger.info("Incremental({}): run {} superseded, stale chunks kept".format(r["name"], run_id))
+        return
+
+    idxnm = search.index_name(r["tenant_id"])
+    # Stamps written while refresh was off must be visible to the queries below.
+    ELASTICSEARCH.refresh(idxnm)
+    q = Q("bool", must=[Q("match", doc_id=r["doc_id"])], must_not=[Q("term", incremental_run_kwd=run_id)])
+    legacy = Q("bool", must=[q], must_not=[Q("exists", field="token_num_int")])
+    res = ELASTICSEARCH.search({"query": q.to_dict(), "size": 0,
+                                "aggs": {"tokens": {"sum": {"field": "token_num_int"}}}},
+                               idxnm=idxnm, timeout="600s")
+    stale = ELASTICSEARCH.getTotal(res)
+    if stale:
+        tk_count = int(res["aggregations"]["tokens"]["value"] or 0)
+        # Chunks indexed before tokens were stored with them.
+        tk_count += sum([num_tokens_from_string(d.get("content_with_weight") or "")
+                         for d in ELASTICSEARCH.scan(legacy, idxnm=idxnm, src=["content_with_weight"])])
+        if not ELASTICSEARCH.deleteByQuery(q, idxnm=idxnm):
+            return
+        DocumentService.decrement_chunk_num(r["doc_id"], r["kb_id"], tk_count, stale, 0)
+        cron_logger.info("Incremental({}): {} stale chunks removed".format(r["name"], stale))
+    REDIS_CONN.delete(doc_key)
+
+
+def token_shares(cks, tk_count):
+    """Splits the task's token count over its chunks by their length, summing up to it exactly."""
+    weights = [max(1, num_tokens_from_string(c.get("content_with_weight") or "")) for c in cks]
+    total = sum(weights)
+    shares = [tk_count * w // total for w in weights]
+    rest = sorted(range(len(cks)), key=lambda i: (tk_count * weights[i]) % total, reverse=True)
+    for i in rest[:tk_count - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
 def embedding(docs, mdl, parser_config=None, callback=None):
     if parser_config is None:
         parser_config = {}
@@ -314,79 +492,259 @@ def run_raptor(row, chat_mdl, embd_mdl, callback=None):
     return res, tk_count
 
 
+def load_embedding_model(r, callback):
+    try:
+        return LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+    except Exception as e:
+        callback(-1, msg=str(e))
+        cron_logger.error(str(e))
+
+
+def do_raptor(r, embd_mdl, callback):
+    try:
+        chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
+        return run_raptor(r, chat_mdl, embd_mdl, callback)
+    except TaskCanceledException:
+        raise
+    except Exception as e:
+        callback(-1, msg=str(e))
+        cron_logger.error(str(e))
+
+
+def do_embedding(r, cks, embd_mdl, callback):
+    callback(
+        msg="Finished slicing files(%d). Start to embedding the content." %
+            len(cks))
+    st = timer()
+    try:
+        tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
+    except TaskCanceledException:
+        raise
+    except Exception as e:
+        callback(-1, "Embedding error:{}".format(str(e)))
+        cron_logger.error(str(e))
+        tk_count = 0
+    cron_logger.info("Embedding elapsed({}): {:.2f}, cache: {}".format(r["name"], timer() - st, EMBEDDING_CACHE.stats()))
+    callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
+    return tk_count
+
+
+def do_index(r, cks, tk_count, callback, updates=None):
+    init_kb(r)
+    chunk_count = len(set([c["_id"] for c in cks]))
+    # Stored with each chunk, so what removing chunks takes off token_num is what indexing them added.
+    for c, n in zip(cks, token_shares(cks, tk_count) if cks else []):
+        c["token_num_int"] = n
+    st = timer()
+    idxnm = search.index_name(r["tenant_id"])
+    ELASTICSEARCH.restore_ingest_settings(idxnm)
+    ingest = {"refresh_interval": "-1"} if len(cks) >= ES_BULK_NO_REFRESH_CHUNKS else {}
+    try:
+        with ELASTICSEARCH.ingest_settings(idxnm, ingest):
+            docs = cks + (updates or [])
+            es_r = ELASTICSEARCH.bulk_index(docs, idxnm,
+                                            callback=lambda n: callback(prog=0.8 + 0.1 * n / len(docs), msg=""))
+    except TaskCanceledException:
+        ELASTICSEARCH.deleteByQuery(Q("match", doc_id=r["doc_id"]), idxnm=idxnm)
+        raise
+
+    cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
+    if es_r:
+        callback(-1, "Insert chunk error, detail info please check ragflow-logs/api/cron_logger.log. Please also check ES status!")
+        ELASTICSEARCH.deleteByQuery(
+            Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        cron_logger.error(str(es_r))
+    else:
+        if TaskService.do_cancel(r["id"]):
+            ELASTICSEARCH.deleteByQuery(
+                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+            return
+        callback(1., "Done!")
+        DocumentService.increment_chunk_num(
+            r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
+        cron_logger.info(
+            "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
+                r["id"], tk_count, len(cks), timer() - st))
+        if r.get("incremental"):
+            finish_incremental(r)
+
+
 def main():
     rows = collect()
     if len(rows) == 0:
         return
 
     for _, r in rows.iterrows():
-        callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
         try:
-            embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
-        except Exception as e:
-            callback(-1, msg=str(e))
-            cron_logger.error(str(e))
-            continue
+            run_task(r)
+        except TaskCanceledException:
+            cron_logger.info("Task {} has been canceled.".format(r["id"]))
 
-        if r.get("task_type", "") == "raptor":
+
+def run_task(r):
+    callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    embd_mdl = load_embedding_model(r, callback)
+    if embd_mdl is None:
+        return
+
+    updates = []
+    if r.get("task_type", "") == "raptor":
+        res = do_raptor(r, embd_mdl, callback)
+        if res is None:
+            return
+        cks, tk_count = res
+    else:
+        st = timer()
+        cks = build(r)
+        cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
+        if cks is None:
+            return
+        if not cks:
+            callback(1., "No chunk! Done!")
+            if r.get("incremental"):
+                finish_incremental(r)
+            return
+        if r.get("incremental"):
+            cks, updates = diff_chunks(r, cks)
+        tk_count = do_embedding(r, cks, embd_mdl, callback)
+
+    do_index(r, cks, tk_count, callback, updates)
+
+
+class TaskPipeline:
+    """
+    Runs the stages of `main()` concurrently: fetch, chunk, embed and index
+    workers are joined by bounded queues, so while one task is being OCR'd the
+    chunks of the previous one are embedded and indexed. A queue message is
+    acknowledged once every task it carries has left the last stage.
+    """
+    STAGES = ["fetch", "chunk", "embed", "index"]
+
+    def __init__(self):
+        self.queues = {stage: queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for stage in self.STAGES}
+        self.workers = {
+            "fetch": PIPELINE_FETCH_WORKERS,
+            "chunk": PIPELINE_CHUNK_WORKERS,
+            "embed": PIPELINE_EMBED_WORKERS,
+            "index": PIPELINE_INDEX_WORKERS
+        }
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def run(self):
+        for i, stage in enumerate(self.STAGES):
+            next_stage = self.STAGES[i + 1] if i + 1 < len(self.STAGES) else None
+            for _ in range(max(1, self.workers[stage])):
+                threading.Thread(target=self._work, args=(stage, next_stage), daemon=True).start()
+        cron_logger.info("Task pipeline started, workers: {}".format(self.workers))
+        while not STOP.is_set():
+            self.collect()
+        while self.in_flight:
+            time.sleep(1)
+
+    def collect(self):
+        global PAYLOAD
+        # Pending messages of this consumer are only stale when nothing is in flight.
+        with self.lock:
+            recover = self.in_flight == 0
+        rows = collect(recover)
+        payload, PAYLOAD = PAYLOAD, None
+        if len(rows) == 0:
+            if payload:
+                payload.ack()
+            return
+
+        ticket = {"payload": payload, "left": len(rows)}
+        for _, r in rows.iterrows():
+            with self.lock:
+                self.in_flight += 1
+            item = {
+                "row": r,
+                "ticket": ticket,
+                "callback": partial(set_progress, r["id"], r["from_page"], r["to_page"])
+            }
+            stage = "embed" if r.get("task_type", "") == "raptor" else "fetch"
+            self.queues[stage].put(item)
+
+    def _work(self, stage, next_stage):
+        func = getattr(self, "_" + stage)
+        while True:
+            item = self.queues[stage].get()
+            forward = False
             try:
-                chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
-                cks, tk_count = run_raptor(r, chat_mdl, embd_mdl, callback)
+                forward = func(item)
+            except TaskCanceledException:
+                cron_logger.info("Task {} has been canceled.".format(item["row"]["id"]))
             except Exception as e:
-                callback(-1, msg=str(e))
-                cron_logger.error(str(e))
-                continue
-        else:
-            st = timer()
-            cks = build(r)
-            cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
-            if cks is None:
-                continue
-            if not cks:
-                callback(1., "No chunk! Done!")
-                continue
-            # TODO: exception handler
-            ## set_progress(r["did"], -1, "ERROR: ")
-            callback(
-                msg="Finished slicing files(%d). Start to embedding the content." %
-                    len(cks))
-            st = timer()
+                # The task fails with the error, as it would in main(), and its message is acked below.
+                cron_logger.error("Pipeline {} stage of task {}: {}".format(stage, item["row"]["id"], str(e)))
+                traceback.print_exc()
+                self._fail(item, e)
             try:
-                tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
+                if forward and next_stage:
+                    self.queues[next_stage].put(item)
+                else:
+                    self._done(item)
             except Exception as e:
-                callback(-1, "Embedding error:{}".format(str(e)))
-                cron_logger.error(str(e))
-                tk_count = 0
-            cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
-            callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
-
-        init_kb(r)
-        chunk_count = len(set([c["_id"] for c in cks]))
+                cron_logger.error("Pipeline {} stage of task {}: {}".format(stage, item["row"]["id"], str(e)))
+
+    @staticmethod
+    def _fail(item, e):
+        try:
+            item["callback"](-1, msg=str(e))
+        except TaskCanceledException:
+            cron_logger.info("Task {} has been canceled.".format(item["row"]["id"]))
+        except Exception as ce:
+            cron_logger.error("Report the failure of task {}: {}".format(item["row"]["id"], str(ce)))
+
+    def _done(self, item):
+        ticket = item["ticket"]
+        with self.lock:
+            self.in_flight -= 1
+            ticket["left"] -= 1
+            ack = ticket["left"] == 0
+        if ack and ticket["payload"]:
+            ticket["payload"].ack()
+
+    def _fetch(self, item):
+        item["embd_mdl"] = load_embedding_model(item["row"], item["callback"])
+        if item["embd_mdl"] is None:
+            return False
+        item["binary"] = fetch(item["row"])
+        return item["binary"] is not None
+
+    def _chunk(self, item):
+        r = item["row"]
         st = timer()
-        es_r = ""
-        es_bulk_size = 4
-        for b in range(0, len(cks), es_bulk_size):
-            es_r = ELASTICSEARCH.bulk(cks[b:b + es_bulk_size], search.index_name(r["tenant_id"]))
-            if b % 128 == 0:
-                callback(prog=0.8 + 0.1 * (b + 1) / len(cks), msg="")
-
-        cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
-        if es_r:
-            callback(-1, "Insert chunk error, detail info please check ragflow-logs/api/cron_logger.log. Please also check ES status!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-            cron_logger.error(str(es_r))
-        else:
-            if TaskService.do_cancel(r["id"]):
-                ELASTICSEARCH.deleteByQuery(
-                    Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-                continue
-            callback(1., "Done!")
-            DocumentService.increment_chunk_num(
-                r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
-            cron_logger.info(
-                "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
-                    r["id"], tk_count, len(cks), timer() - st))
+        cks = build(r, item.pop("binary"))
+        cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
+        if cks is None:
+            return False
+        if not cks:
+            item["callback"](1., "No chunk! Done!")
+            if r.get("incremental"):
+                finish_incremental(r)
+            return False
+        if r.get("incremental"):
+            cks, item["updates"] = diff_chunks(r, cks)
+        item["chunks"] = cks
+        return True
+
+    def _embed(self, item):
+        r, callback = item["row"], item["callback"]
+        if r.get("task_type", "") == "raptor":
+            embd_mdl = load_embedding_model(r, callback)
+            res = do_raptor(r, embd_mdl, callback) if embd_mdl is not None else None
+            if res is None:
+                return False
+            item["chunks"], item["tk_count"] = res
+            return True
+        item["tk_count"] = do_embedding(r, item["chunks"], item.pop("embd_mdl"), callback)
+        return True
+
+    def _index(self, item):
+        do_index(item["row"], item["chunks"], item["tk_count"], item["callback"], item.get("updates"))
+        return False
 
 
 def report_status():
@@ -400,22 +758,37 @@ def report_status():
             obj[CONSUMER_NAME].append(timer())
             obj[CONSUMER_NAME] = obj[CONSUMER_NAME][-60:]
             REDIS_CONN.set_obj("TASKEXE", obj, 60*2)
+            TASK_QUEUE.heartbeat(CONSUMER_NAME)
         except Exception as e:
             print("[Exception]:", str(e))
         time.sleep(30)
 
 
-if __name__ == "__main__":
+def run():
+    global PAYLOAD
     peewee_logger = logging.getLogger('peewee')
     peewee_logger.propagate = False
     peewee_logger.addHandler(database_logger.handlers[0])
     peewee_logger.setLevel(database_logger.level)
 
-    exe = ThreadPoolExecutor(max_workers=1)
+    # SIGTERM lets the current task finish before the process leaves.
+    signal.signal(signal.SIGTERM, lambda *args: STOP.set())
+
+    exe = ThreadPoolExecutor(max_workers=2)
     exe.submit(report_status)
+    exe.submit(PROGRESS.run)
 
-    while True:
+    if TASK_PIPELINE:
+        TaskPipeline().run()
+
+    while not STOP.is_set():
         main()
         if PAYLOAD:
             PAYLOAD.ack()
             PAYLOAD = None
+    PROGRESS.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,155 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Starts task executors as forked children of one process instead of one
+`task_executor.py` per consumer.
+
+The read-only models (the huqie datrie dictionary and the up/down concatenation
+booster) are loaded once here and shared copy-on-write by every consumer.
+ONNX sessions own thread pools which do not survive fork(), so each consumer
+builds them itself, limited to DEEPDOC_ORT_THREADS threads to keep the box
+from being oversubscribed.
+
+Consumers are added while the task queue has undelivered messages and retired
+(after their current task) once it has been drained for a while.
+"""
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from rag.settings import cron_logger, TASK_EXECUTOR_MIN_WORKERS, TASK_EXECUTOR_MAX_WORKERS, \
+    TASK_EXECUTOR_SCALE_INTERVAL
+
+
+def warmup():
+    st = time.time()
+    from rag.nlp import rag_tokenizer
+    from deepdoc.parser.pdf_parser import load_updown_concat_model
+    rag_tokenizer.tokenize("warm up")
+    load_updown_concat_model()
+    cron_logger.info("Supervisor warmed up models in {:.2f}s".format(time.time() - st))
+
+
+def consume(idx, threads):
+    os.environ["DEEPDOC_ORT_THREADS"] = str(threads)
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.argv = [sys.argv[0], str(idx)]
+
+    # Sockets opened by the supervisor must not be shared with the children.
+    from rag.utils.es_conn import ELASTICSEARCH
+    from rag.utils.redis_conn import REDIS_CONN
+    ELASTICSEARCH.conn()
+    REDIS_CONN.__open__()
+
+    from rag.svr import task_executor
+    task_executor.run()
+
+
+class TaskExecutorSupervisor:
+    def __init__(self, min_workers=TASK_EXECUTOR_MIN_WORKERS, max_workers=TASK_EXECUTOR_MAX_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self.min_workers = min(max(1, min_workers), self.max_workers)
+        self.threads = int(os.environ.get("DEEPDOC_ORT_THREADS",
+                                          max(1, (os.cpu_count() or 1) // self.max_workers)))
+        self.workers = {}
+        # Retired consumers finishing their task keep their index, and so their
+        # consumer name, until they are reaped.
+        self.retiring = {}
+        self.idle_rounds = 0
+        self.stopping = False
+        self.ctx = multiprocessing.get_context("fork")
+
+    def spawn(self, idx):
+        p = self.ctx.Process(target=consume, args=(idx, self.threads), name="task_consumer_%d" % idx)
+        p.start()
+        self.workers[idx] = p
+        cron_logger.info("Spawn task_consumer_{} (pid {}), {} workers.".format(idx, p.pid, len(self.workers)))
+
+    def retire(self, idx):
+        p = self.workers.pop(idx)
+        self.retiring[idx] = p
+        p.terminate()
+        cron_logger.info("Retire task_consumer_{} (pid {}), {} workers.".format(idx, p.pid, len(self.workers)))
+
+    def reap(self):
+        multiprocessing.active_children()
+        for idx, p in list(self.retiring.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            del self.retiring[idx]
+            cron_logger.info("task_consumer_{} retired with {}.".format(idx, p.exitcode))
+        for idx, p in list(self.workers.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            cron_logger.warning("task_consumer_{} exited with {}, restart it.".format(idx, p.exitcode))
+            del self.workers[idx]
+            self.spawn(idx)
+
+    def scale(self):
+        from rag.utils.task_queue import TASK_QUEUE
+        info = TASK_QUEUE.info()
+        if info is None:
+            return
+        lag = info.get("lag") or 0
+        if lag > 0:
+            self.idle_rounds = 0
+            free = set(range(self.max_workers)) - set(self.workers) - set(self.retiring)
+            if len(self.workers) < self.max_workers and free:
+                # Keep consumer names dense so pending messages of a retired one are
+                # recovered when its index comes back.
+                self.spawn(min(free))
+            return
+
+        self.idle_rounds += 1
+        if self.idle_rounds >= 3 and len(self.workers) > self.min_workers \
+                and info.get("pending", 0) < len(self.workers):
+            self.retire(max(self.workers))
+            self.idle_rounds = 0
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        warmup()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for idx in range(self.min_workers):
+            self.spawn(idx)
+
+        while not self.stopping:
+            time.sleep(TASK_EXECUTOR_SCALE_INTERVAL)
+            if self.stopping:
+                break
+            try:
+                self.reap()
+                self.scale()
+            except Exception as e:
+                cron_logger.error("Supervisor: " + str(e))
+
+        for idx in list(self.workers):
+            self.retire(idx)
+        for p in multiprocessing.active_children():
+            p.join()
+
+
+if __name__ == "__main__":
+    TaskExecutorSupervisor().run()
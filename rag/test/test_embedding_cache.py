@@ -0,0 +1,92 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from rag.utils import num_tokens_from_string
+from rag.utils.embedding_cache import EMBEDDING_CACHE
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    # The in-process LRU alone: a TTL of 0 keeps Redis out.
+    monkeypatch.setattr(EMBEDDING_CACHE, "capacity", 100)
+    monkeypatch.setattr(EMBEDDING_CACHE, "ttl", 0)
+    monkeypatch.setattr(EMBEDDING_CACHE, "lru", OrderedDict())
+    monkeypatch.setattr(EMBEDDING_CACHE, "hits", 0)
+    monkeypatch.setattr(EMBEDDING_CACHE, "misses", 0)
+    return EMBEDDING_CACHE
+
+
+class Encoder(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        vects = [[float(len(t)), float(sum(map(ord, t)) % 997), 1.] for t in texts]
+        return np.array(vects), sum([num_tokens_from_string(t) for t in texts])
+
+
+def test_duplicates_are_encoded_once(cache):
+    enc = Encoder()
+    texts = ["alpha beta", "gamma", "alpha  beta ", "gamma", "delta"]
+    vects, used, cached = cache.encode("t1-m1", texts, enc)
+    assert enc.calls == [["alpha beta", "gamma", "delta"]]
+    assert vects.shape == (5, 3)
+    np.testing.assert_array_equal(vects[0], vects[2])
+    np.testing.assert_array_equal(vects[1], vects[3])
+    assert used == sum([num_tokens_from_string(t) for t in ["alpha beta", "gamma", "delta"]])
+    assert used + cached == sum([num_tokens_from_string(t) for t in texts])
+
+
+def test_cached_texts_are_not_encoded_again(cache):
+    enc = Encoder()
+    first, _, _ = cache.encode("t1-m1", ["alpha", "beta"], enc)
+    vects, used, cached = cache.encode("t1-m1", ["beta", "gamma", "alpha"], enc)
+    assert enc.calls == [["alpha", "beta"], ["gamma"]]
+    np.testing.assert_allclose(vects[0], first[1])
+    np.testing.assert_allclose(vects[2], first[0])
+    assert used == num_tokens_from_string("gamma")
+    assert cached == num_tokens_from_string("beta") + num_tokens_from_string("alpha")
+    assert cache.stats() == {"hits": 2, "misses": 3}
+
+
+def test_all_cached(cache):
+    enc = Encoder()
+    cache.encode("t1-m1", ["alpha", "beta"], enc)
+    vects, used, cached = cache.encode("t1-m1", ["alpha", "beta"], enc)
+    assert len(enc.calls) == 1
+    assert vects.shape == (2, 3)
+    assert used == 0
+    assert cached == num_tokens_from_string("alpha") + num_tokens_from_string("beta")
+
+
+def test_namespaces_are_apart(cache):
+    enc = Encoder()
+    cache.encode("t1-m1", ["alpha"], enc)
+    cache.encode("t1-m2", ["alpha"], enc)
+    cache.encode("t2-m1", ["alpha"], enc)
+    assert enc.calls == [["alpha"], ["alpha"], ["alpha"]]
+
+
+def test_lru_evicts_the_least_recently_used(cache, monkeypatch):
+    monkeypatch.setattr(cache, "capacity", 2)
+    enc = Encoder()
+    cache.encode("t1-m1", ["a", "b"], enc)
+    cache.encode("t1-m1", ["a"], enc)
+    cache.encode("t1-m1", ["c"], enc)
+    cache.encode("t1-m1", ["a", "b"], enc)
+    assert enc.calls == [["a", "b"], ["c"], ["b"]]
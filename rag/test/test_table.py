@@ -0,0 +1,123 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import io
+import re
+import zipfile
+
+import pytest
+from openpyxl import Workbook
+
+from deepdoc.parser import ExcelParser
+from rag.app.table import Excel, read_csv
+
+
+class Progress(object):
+    def __init__(self):
+        self.msgs = []
+
+    def __call__(self, prog=None, msg=""):
+        self.msgs.append(msg)
+
+
+def csv_bytes(n, delimiter="\t", newline="\n"):
+    return ("a{0}b{0}c".format(delimiter) + newline +
+            "".join("{1}{0}{2}{0}{3}".format(delimiter, i, i * 2, i * 3) + newline for i in range(n))).encode()
+
+
+@pytest.mark.parametrize("from_page,to_page", [(0, 10), (0, 3), (3, 6), (8, 100), (10, 20)])
+def test_read_csv_window(from_page, to_page):
+    cb = Progress()
+    df = read_csv("t.csv", csv_bytes(10), from_page=from_page, to_page=to_page, callback=cb)
+    assert list(df.columns) == ["a", "b", "c"]
+    assert df.values.tolist() == [[str(i), str(i * 2), str(i * 3)] for i in range(from_page, min(to_page, 10))]
+    assert cb.msgs[-1] == "Extract records: {}~{}".format(from_page, max(from_page, min(to_page, 10)))
+
+
+@pytest.mark.parametrize("delimiter", ["\t", ",", "||"])
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_read_csv_delimiters_and_newlines(delimiter, newline):
+    df = read_csv("t.csv", csv_bytes(5, delimiter, newline), delimiter=delimiter, callback=Progress())
+    assert df.values.tolist() == [[str(i), str(i * 2), str(i * 3)] for i in range(5)]
+
+
+def test_read_csv_failures_and_padding():
+    cb = Progress()
+    data = "a\tb\n1\t2\n3\t4\t5\n6\n7\t8\n9\t10\t11\n".encode()
+    df = read_csv("t.csv", data, callback=cb)
+    # Long lines fail with their row number, short ones are padded.
+    assert df.values.tolist() == [["1", "2"], ["6", ""], ["7", "8"]]
+    assert cb.msgs[-1] == "Extract records: 0~52 failure, line: 1,4..."
+
+    cb = Progress()
+    df = read_csv("t.csv", data, from_page=2, to_page=5, callback=cb)
+    assert df.values.tolist() == [["6", ""], ["7", "8"]]
+    assert cb.msgs[-1] == "Extract records: 2~51 failure, line: 4..."
+
+
+def test_read_csv_long_first_line():
+    cb = Progress()
+    df = read_csv("t.csv", "a\tb\n1\t2\t3\n4\t5\n".encode(), callback=cb)
+    assert df.values.tolist() == [["4", "5"]]
+    assert cb.msgs[-1] == "Extract records: 0~21 failure, line: 0..."
+
+
+def xlsx(sheets, dimension=None):
+    wb = Workbook()
+    wb.remove(wb.active)
+    for name, rows in sheets.items():
+        ws = wb.create_sheet(name)
+        for r in rows:
+            ws.append(r)
+    buf = io.BytesIO()
+    wb.save(buf)
+    if dimension is None:
+        return buf.getvalue()
+    # Rewrites the <dimension> of the sheets, as some writers leave it.
+    out = io.BytesIO()
+    with zipfile.ZipFile(buf) as zin, zipfile.ZipFile(out, "w") as zout:
+        for it in zin.infolist():
+            data = zin.read(it.filename)
+            if it.filename.startswith("xl/worksheets/"):
+                data = re.sub(rb'<dimension ref="[^"]*"/>', b'<dimension ref="%s"/>' % dimension.encode(), data)
+            zout.writestr(it, data)
+    return out.getvalue()
+
+
+SHEETS = {"s1": [["a", "b", "c"]] + [[i, i * 2, i * 3] for i in range(5)],
+          "s2": [["x", "y"]] + [[i, -i] for i in range(5, 9)]}
+
+
+@pytest.mark.parametrize("dimension", [None, "A1"])
+@pytest.mark.parametrize("from_page,to_page", [(0, 100), (0, 3), (3, 7), (6, 8)])
+def test_excel_window(dimension, from_page, to_page):
+    # Data rows are numbered across the sheets, their headers aside.
+    expected = [("s1", [i, i * 2, i * 3]) for i in range(5)] + [("s2", [i, -i]) for i in range(5, 9)]
+    expected = expected[from_page:to_page]
+    dfs = Excel()("t.xlsx", xlsx(SHEETS, dimension), from_page=from_page, to_page=to_page, callback=Progress())
+    got = [(list(df.columns), r) for df in dfs for r in df.values.tolist()]
+    assert got == [(["a", "b", "c"] if s == "s1" else ["x", "y"], r) for s, r in expected]
+
+
+@pytest.mark.parametrize("dimension", [None, "A1"])
+def test_excel_row_number(dimension):
+    assert ExcelParser.row_number("t.xlsx", xlsx(SHEETS, dimension)) == 6 + 5
+
+
+def test_excel_html_chunks():
+    rows = [["a", "b"]] + [[i, None if i % 3 else i] for i in range(7)]
+    chunks = ExcelParser().html(xlsx({"s1": rows, "s2": [["h"]]}), chunk_rows=3)
+    assert len(chunks) == 4
+    assert all(c.startswith("<table><caption>s1</caption><tr><th>a</th><th>b</th></tr>") for c in chunks[:3])
+    assert [c.count("<td>") for c in chunks[:3]] == [6, 6, 2]
+    assert "<tr><td>1</td><td></td></tr>" in chunks[0]
+    assert chunks[3] == "<table><caption>s2</caption><tr><th>h</th></tr></table>\n"
@@ -79,6 +79,13 @@ class RAGFlowAzureSpnBlob(object):
             azure_logger.error(f"Fail put {bucket}/{fnm}: " + str(e))
         return False
 
+    def get_etag(self, bucket, fnm):
+        try:
+            return self.conn.get_file_client(fnm).get_file_properties().etag
+        except Exception as e:
+            azure_logger.error(f"Fail stat {bucket}/{fnm}: " + str(e))
+        return
+
     def get_presigned_url(self, bucket, fnm, expires):
         for _ in range(10):
             try:
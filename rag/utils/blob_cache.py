@@ -0,0 +1,144 @@
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from rag.settings import cron_logger, BLOB_CACHE_DIR, BLOB_CACHE_SIZE
+from rag.utils import singleton
+from rag.utils.storage_factory import STORAGE_IMPL
+
+
+class _FileLock:
+    """Serializes downloads of one blob across the executors of a box."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def __enter__(self):
+        if fcntl:
+            self.f = open(self.path, "a")
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self.f:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+
+
+@singleton
+class RAGFlowBlobCache(object):
+    """
+    Size-bounded LRU cache of storage objects on the local disk.
+
+    Entries are keyed by bucket, name and etag, so an overwritten object is never
+    served stale. Page-range tasks of the same document download it once and
+    read it back from disk; eviction is done by file mtime, which a hit
+    refreshes, so every executor process sharing the directory sees one LRU.
+
+    Each process counts the bytes it adds on top of the size found by the last
+    scan of the directory, and only scans again once that count is over the
+    capacity. Eviction then goes down to LOW_WATERMARK of it.
+    """
+    LOCK_STRIPES = 256
+    LOW_WATERMARK = 0.9
+
+    def __init__(self):
+        self.dir = BLOB_CACHE_DIR
+        self.capacity = BLOB_CACHE_SIZE
+        self.locks = [threading.Lock() for _ in range(64)]
+        self.size_lock = threading.Lock()
+        self.size = None
+        if self.capacity > 0:
+            os.makedirs(os.path.join(self.dir, "locks"), exist_ok=True)
+
+    def get(self, bucket, fnm):
+        if self.capacity <= 0 or not hasattr(STORAGE_IMPL, "get_etag"):
+            return STORAGE_IMPL.get(bucket, fnm)
+        etag = STORAGE_IMPL.get_etag(bucket, fnm)
+        if not etag:
+            return STORAGE_IMPL.get(bucket, fnm)
+
+        key = hashlib.sha1("{}/{}@{}".format(bucket, fnm, etag).encode("utf-8")).hexdigest()
+        path = os.path.join(self.dir, key)
+        binary = self._read(path)
+        if binary is not None:
+            return binary
+
+        # Single flight: concurrent tasks for the same blob wait for one download.
+        # Lock files are striped and never removed, so all processes lock the same inode.
+        lock = os.path.join(self.dir, "locks", "{:02x}.lock".format(int(key[:8], 16) % self.LOCK_STRIPES))
+        with self.locks[int(key[:8], 16) % len(self.locks)], _FileLock(lock):
+            binary = self._read(path)
+            if binary is not None:
+                return binary
+            binary = STORAGE_IMPL.get(bucket, fnm)
+            if binary is None or len(binary) > self.capacity:
+                return binary
+            try:
+                self._write(path, binary)
+                self._added(len(binary))
+            except Exception as e:
+                cron_logger.warning("Blob cache write {}/{}: {}".format(bucket, fnm, str(e)))
+            return binary
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as f:
+                binary = f.read()
+            os.utime(path)
+            return binary
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            cron_logger.warning("Blob cache read {}: {}".format(path, str(e)))
+
+    def _write(self, path, binary):
+        tmp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as f:
+            f.write(binary)
+        os.replace(tmp, path)
+
+    def _added(self, size):
+        with self.size_lock:
+            if self.size is not None:
+                self.size += size
+                if self.size <= self.capacity:
+                    return
+            self.size = self._evict()
+
+    def _evict(self):
+        """Scans the directory, evicts the least recently used entries and returns the size left."""
+        entries, total = [], 0
+        for e in os.scandir(self.dir):
+            if not e.is_file():
+                continue
+            st = e.stat()
+            if e.name.endswith(".tmp"):
+                # Left behind by a killed executor.
+                if st.st_mtime < time.time() - 3600:
+                    os.remove(e.path)
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+            total += st.st_size
+
+        if total <= self.capacity:
+            return total
+        for _, size, path in sorted(entries):
+            if total <= self.capacity * self.LOW_WATERMARK:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+BLOB_CACHE = RAGFlowBlobCache()
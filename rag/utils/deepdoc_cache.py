@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from api.utils.file_utils import get_project_base_directory
+from rag.settings import cron_logger, DEEPDOC_CACHE_BUCKET
+from rag.utils import singleton
+
+# Settings which change what the deepdoc stages output for the same file.
+DEEPDOC_ENV = ["DEEPDOC_INT8_MODELS", "DEEPDOC_TEXT_LAYER", "DEEPDOC_RENDERER", "DEEPDOC_RENDER_GRAYSCALE",
+               "DEEPDOC_RENDER_MAX_PIXELS"]
+
+
+def _jsonable(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, (set, tuple)):
+        return list(o)
+    raise TypeError("{} is not serializable".format(type(o).__name__))
+
+
+@singleton
+class DeepdocCache(object):
+    """
+    The results of the deepdoc stages of a PDF (OCR boxes, layouts, table
+    structure) in object storage, so that chunking a document again with other
+    settings starts from them instead of running the models again.
+
+    Each stage's entry is keyed by the hash of the file, the chain of stages
+    run before it with their arguments (page range, zoom, ...), and the version
+    of the models; it is stored as zlib'ed JSON under `<file hash>/`.
+    """
+    FORMAT = 1
+
+    def __init__(self):
+        self.bucket = DEEPDOC_CACHE_BUCKET
+        self.lock = threading.Lock()
+        self.version = None
+
+    def enabled(self):
+        return bool(self.bucket)
+
+    def model_version(self):
+        """Names, sizes and leading bytes of the model files, plus the settings in DEEPDOC_ENV."""
+        with self.lock:
+            if self.version is None:
+                h = hashlib.sha1(str(self.FORMAT).encode("utf-8"))
+                model_dir = os.path.join(get_project_base_directory(), "rag/res/deepdoc")
+                names = sorted(os.listdir(model_dir)) if os.path.isdir(model_dir) else []
+                # INT8 files are derived from the FP32 ones, which DEEPDOC_INT8_MODELS selects.
+                for nm in [n for n in names if n.endswith((".onnx", ".model")) and not n.endswith(".int8.onnx")]:
+                    path = os.path.join(model_dir, nm)
+                    with open(path, "rb") as f:
+                        h.update("{}:{}:".format(nm, os.path.getsize(path)).encode("utf-8"))
+                        h.update(f.read(1024 * 1024))
+                for k in DEEPDOC_ENV:
+                    h.update("{}={};".format(k, os.environ.get(k, "")).encode("utf-8"))
+                self.version = h.hexdigest()
+        return self.version
+
+    def doc_key(self, fnm, *args):
+        """The key of the first stage run on `fnm`, a path or the file's bytes."""
+        h = hashlib.sha1()
+        if isinstance(fnm, str):
+            with open(fnm, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(block)
+        else:
+            h.update(fnm)
+        return self.chain(h.hexdigest(), *args)
+
+    def chain(self, key, stage, *args):
+        """The key of `stage`, run with `args` after the stage of `key`."""
+        digest = hashlib.sha1(json.dumps([key, self.model_version(), stage, args], default=_jsonable).encode("utf-8"))
+        return "{}/{}".format(key.split("/")[0], digest.hexdigest())
+
+    def get(self, key):
+        from rag.utils.storage_factory import STORAGE_IMPL
+        try:
+            if not STORAGE_IMPL.obj_exist(self.bucket, key):
+                return
+            binary = STORAGE_IMPL.get(self.bucket, key)
+            return json.loads(zlib.decompress(binary).decode("utf-8")) if binary else None
+        except Exception as e:
+            cron_logger.warning("Deepdoc cache get {}: {}".format(key, str(e)))
+
+    def put(self, key, state):
+        from rag.utils.storage_factory import STORAGE_IMPL
+        try:
+            binary = zlib.compress(json.dumps(state, default=_jsonable, ensure_ascii=False).encode("utf-8"))
+            STORAGE_IMPL.put(self.bucket, key, binary)
+        except Exception as e:
+            cron_logger.warning("Deepdoc cache put {}: {}".format(key, str(e)))
+
+
+DEEPDOC_CACHE = DeepdocCache()
@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from rag.settings import EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL
+from rag.utils import singleton, num_tokens_from_string
+from rag.utils.redis_conn import REDIS_CONN
+
+
+@singleton
+class EmbeddingCache(object):
+    """
+    Vectors keyed by (namespace, normalized text hash), where the namespace names
+    the tenant and the embedding model. Lookups go to an in-process LRU first and
+    then to Redis, which shares vectors between executors and across re-parses.
+    """
+
+    def __init__(self):
+        self.capacity = EMBEDDING_CACHE_SIZE
+        self.ttl = EMBEDDING_CACHE_TTL
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.capacity > 0 or (self.ttl > 0 and REDIS_CONN.is_alive())
+
+    def key(self, namespace, text):
+        text = re.sub(r"\s+", " ", text).strip()
+        return "embd:{}:{}".format(namespace, hashlib.md5(text.encode("utf-8")).hexdigest())
+
+    def encode(self, namespace, texts, encoder):
+        """
+        Returns (vectors, used_tokens, cached_tokens), calling `encoder(texts)`
+        only once for the distinct texts which are not cached. `used_tokens` is
+        what the encoder reported; `cached_tokens` counts the texts it was not
+        called with, so their sum is the token count of all the texts.
+        """
+        keys = [self.key(namespace, t) for t in texts]
+        vects = self._get(keys)
+
+        miss = OrderedDict()
+        for i, k in enumerate(keys):
+            if vects[i] is None and k not in miss:
+                miss[k] = i
+        with self.lock:
+            self.misses += len([v for v in vects if v is None])
+            self.hits += len([v for v in vects if v is not None])
+
+        used_tokens = 0
+        sent = set(miss.values())
+        cached_tokens = sum([num_tokens_from_string(t) for i, t in enumerate(texts) if i not in sent])
+        if miss:
+            emd, used_tokens = encoder([texts[i] for i in miss.values()])
+            fresh = dict(zip(miss.keys(), emd))
+            self._put(fresh)
+            vects = [fresh[k] if v is None else v for k, v in zip(keys, vects)]
+        return np.array(vects), used_tokens, cached_tokens
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _get(self, keys):
+        vects = [None] * len(keys)
+        with self.lock:
+            for i, k in enumerate(keys):
+                if k in self.lru:
+                    self.lru.move_to_end(k)
+                    vects[i] = self.lru[k]
+
+        remote = [i for i, v in enumerate(vects) if v is None]
+        if not remote or self.ttl <= 0 or not REDIS_CONN.is_alive():
+            return vects
+        values = REDIS_CONN.mget([keys[i] for i in remote]) or []
+        found = {}
+        for i, v in zip(remote, values):
+            if v:
+                vects[i] = np.frombuffer(base64.b64decode(v), dtype=np.float32)
+                found[keys[i]] = vects[i]
+        self._remember(found)
+        return vects
+
+    def _put(self, vects):
+        vects = {k: np.asarray(v, dtype=np.float32) for k, v in vects.items()}
+        self._remember(vects)
+        if self.ttl > 0 and REDIS_CONN.is_alive():
+            REDIS_CONN.set_many({k: base64.b64encode(v.tobytes()).decode("ascii") for k, v in vects.items()}, self.ttl)
+
+    def _remember(self, vects):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            for k, v in vects.items():
+                self.lru[k] = v
+                self.lru.move_to_end(k)
+            while len(self.lru) > self.capacity:
+                self.lru.popitem(last=False)
+
+
+EMBEDDING_CACHE = EmbeddingCache()
@@ -1,15 +1,21 @@
 import re
 import json
+import threading
 import time
 import copy
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 import elasticsearch
 from elastic_transport import ConnectionTimeout
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import UpdateByQuery, Search, Index
-from rag.settings import es_logger
+from rag.settings import es_logger, ES_BULK_BYTES, ES_BULK_CONCURRENCY, ES_INGEST_KEY, ES_INGEST_LEASE
 from rag import settings
 from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN
 
 es_logger.info("Elasticsearch version: "+str(elasticsearch.__version__))
 
@@ -18,6 +24,10 @@ es_logger.info("Elasticsearch version: "+str(elasticsearch.__version__))
 class ESConnection:
     def __init__(self):
         self.info = {}
+        self.backoff = 0
+        self.backoff_lock = threading.Lock()
+        self.conn_lock = threading.Lock()
+        self.ingest_checks = {}
         self.conn()
         self.idxnm = settings.ES.get("index_name", "")
         if not self.es.ping():
@@ -149,6 +159,207 @@ class ESConnection:
 
         return res
 
+    def bulk_index(self, df, idx_nm=None, max_bytes=ES_BULK_BYTES, concurrency=ES_BULK_CONCURRENCY, callback=None):
+        """
+        Upserts `df` like `bulk()`, but batches by serialized payload size and keeps up
+        to `concurrency` requests in flight. Requests or items rejected with 429 are
+        retried after a back-off shared by all batches. `callback(n)` is called from
+        the calling thread with the number of documents done so far.
+        Returns the list of errors.
+        """
+        idx_nm = idx_nm if idx_nm else self.idxnm
+        ser = JSONSerializer()
+        batches, batch, size = [], [], 0
+        for d in df:
+            id = d["id"] if "id" in d else d["_id"]
+            action = ser.dumps({"update": {"_id": id, "_index": idx_nm, "retry_on_conflict": 100}})
+            doc = ser.dumps({"doc": {k: v for k, v in d.items() if k not in ["id", "_id"]}, "doc_as_upsert": "true"})
+            if batch and size + len(action) + len(doc) > max_bytes:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append((id, action, doc))
+            size += len(action) + len(doc)
+        if batch:
+            batches.append(batch)
+
+        res, done = [], 0
+        for _ in range(10):
+            retry = []
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as exe:
+                futures = {exe.submit(self._bulk_batch, idx_nm, b): b for b in batches}
+                for f in as_completed(futures):
+                    errs, rest = f.result()
+                    res.extend(errs)
+                    if rest:
+                        retry.append(rest)
+                    done += len(futures[f]) - len(rest)
+                    if callback:
+                        callback(done)
+            if not retry:
+                return res
+            # The workers share the connection, so it is only replaced once they are all done.
+            with self.conn_lock:
+                self.conn()
+            batches = retry
+
+        es_logger.error("Fail to bulk {} batches after reconnecting.".format(len(batches)))
+        return res + [str(id) + ":bulk retries exhausted" for b in batches for id, _, _ in b]
+
+    def _bulk_batch(self, idx_nm, batch):
+        """
+        Sends `batch`, retrying rejections and timeouts. Returns the errors, and the
+        part of the batch left to send once the caller has reconnected.
+        """
+        res = []
+        for _ in range(30):
+            if self.backoff:
+                time.sleep(self.backoff)
+            try:
+                lines = [line for _, action, doc in batch for line in (action, doc)]
+                if elasticsearch.__version__[0] < 8:
+                    r = self.es.bulk(index=idx_nm, body=lines, refresh=False, timeout="600s")
+                else:
+                    r = self.es.bulk(index=idx_nm, operations=lines, refresh=False, timeout="600s")
+            except Exception as e:
+                if getattr(e, "status_code", None) == 429 or re.search(r"es_rejected_execution", str(e)):
+                    self._throttle()
+                    continue
+                es_logger.warning("Fail to bulk: " + str(e))
+                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
+                    time.sleep(3)
+                    continue
+                return res, batch
+
+            self._relax()
+            if not r["errors"]:
+                return res, []
+            rejected = []
+            for it, b in zip(r["items"], batch):
+                it = it["update"]
+                if "error" not in it:
+                    continue
+                if it.get("status") == 429:
+                    rejected.append(b)
+                else:
+                    res.append(str(it["_id"]) + ":" + str(it["error"]))
+            if not rejected:
+                return res, []
+            self._throttle()
+            batch = rejected
+
+        es_logger.error("Fail to bulk {} docs after retries.".format(len(batch)))
+        return res + [str(id) + ":bulk retries exhausted" for id, _, _ in batch], []
+
+    def _throttle(self):
+        with self.backoff_lock:
+            self.backoff = min(max(self.backoff * 2, 0.5), 60)
+        es_logger.warning("ES rejected bulk request, back off {}s.".format(self.backoff))
+
+    def _relax(self):
+        with self.backoff_lock:
+            self.backoff = self.backoff / 2 if self.backoff > 0.1 else 0
+
+    @contextmanager
+    def ingest_settings(self, idxnm, index_settings):
+        """
+        Applies `index_settings` (e.g. {"refresh_interval": "-1"}) to the index while a
+        large load runs, and restores the previous values once no load needs them.
+
+        Every load holds a lease in Redis (`ES_INGEST_KEY`), renewed while it runs.
+        The settings are applied by the first holder and restored by the last one,
+        and when a holder dies its lease runs out, so `restore_ingest_settings`
+        puts them back once the last lease has expired. Without Redis the
+        settings are left untouched.
+        """
+        holder = self._acquire_ingest(idxnm, index_settings) if index_settings else None
+        if not holder:
+            yield
+            return
+        key = ES_INGEST_KEY.format(idxnm)
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(ES_INGEST_LEASE / 3):
+                try:
+                    REDIS_CONN.REDIS.zadd(key, {holder: time.time() + ES_INGEST_LEASE})
+                except Exception as e:
+                    es_logger.warning("ES ingest lease of {}: {}".format(idxnm, str(e)))
+
+        threading.Thread(target=renew, daemon=True).start()
+        try:
+            yield
+        finally:
+            stop.set()
+            try:
+                with REDIS_CONN.REDIS.lock(key + ":lock", timeout=60, blocking_timeout=60):
+                    REDIS_CONN.REDIS.zrem(key, holder)
+                    self._restore_if_idle(idxnm, key)
+            except Exception as e:
+                es_logger.error("ES restore settings of {}: {}".format(idxnm, str(e)))
+
+    def restore_ingest_settings(self, idxnm):
+        """
+        Restores the settings saved by loads whose leases all ran out, i.e. whose
+        executors died. Redis is only asked again once the last lease seen would expire.
+        """
+        now = time.time()
+        if now < self.ingest_checks.get(idxnm, 0):
+            return
+        key = ES_INGEST_KEY.format(idxnm)
+        try:
+            if not REDIS_CONN.REDIS.exists(key + ":orig"):
+                # A load starting from now on holds its lease for at least this long.
+                self.ingest_checks[idxnm] = now + ES_INGEST_LEASE
+                return
+            last = REDIS_CONN.REDIS.zrange(key, -1, -1, withscores=True)
+            if last and last[0][1] > now:
+                self.ingest_checks[idxnm] = last[0][1]
+                return
+            with REDIS_CONN.REDIS.lock(key + ":lock", timeout=60, blocking_timeout=60):
+                self._restore_if_idle(idxnm, key)
+        except Exception as e:
+            es_logger.warning("ES check ingest settings of {}: {}".format(idxnm, str(e)))
+
+    def _acquire_ingest(self, idxnm, index_settings):
+        key = ES_INGEST_KEY.format(idxnm)
+        holder = uuid.uuid4().hex
+        try:
+            with REDIS_CONN.REDIS.lock(key + ":lock", timeout=60, blocking_timeout=60):
+                now = time.time()
+                REDIS_CONN.REDIS.zremrangebyscore(key, "-inf", now)
+                if not REDIS_CONN.REDIS.zcard(key):
+                    # Values saved by a dead holder are still the ones to go back to.
+                    if REDIS_CONN.REDIS.get(key + ":orig") is None:
+                        cur = self._get_settings(idxnm)
+                        REDIS_CONN.REDIS.set(key + ":orig", json.dumps({k: cur.get("index." + k) for k in index_settings}))
+                    self._put_settings(idxnm, index_settings)
+                REDIS_CONN.REDIS.zadd(key, {holder: now + ES_INGEST_LEASE})
+            return holder
+        except Exception as e:
+            es_logger.warning("ES ingest settings of {}: {}".format(idxnm, str(e)))
+
+    def _restore_if_idle(self, idxnm, key):
+        """With the lock of `key` held: restores the saved settings if no lease is left."""
+        REDIS_CONN.REDIS.zremrangebyscore(key, "-inf", time.time())
+        if REDIS_CONN.REDIS.zcard(key):
+            return
+        orig = REDIS_CONN.REDIS.get(key + ":orig")
+        if orig is None:
+            return
+        self._put_settings(idxnm, json.loads(orig))
+        REDIS_CONN.REDIS.delete(key + ":orig")
+        es_logger.info("ES settings of {} restored to {}.".format(idxnm, orig))
+
+    def _get_settings(self, idxnm):
+        r = self.es.indices.get_settings(index=idxnm, flat_settings=True)
+        return r.get(idxnm, {}).get("settings", {})
+
+    def _put_settings(self, idxnm, index_settings):
+        index_settings = {"index": index_settings}
+        if elasticsearch.__version__[0] < 8:
+            return self.es.indices.put_settings(index=idxnm, body=index_settings)
+        return self.es.indices.put_settings(index=idxnm, settings=index_settings)
+
     def bulk4script(self, df):
         ids, acts = {}, []
         for d in df:
@@ -341,6 +552,21 @@ class ESConnection:
 
         return False
 
+    def refresh(self, idxnm=""):
+        try:
+            self.es.indices.refresh(index=idxnm if idxnm else self.idxnm)
+            return True
+        except Exception as e:
+            es_logger.error("ES refresh {}: {}".format(idxnm, str(e)))
+        return False
+
+    def scan(self, query, idxnm="", src=False):
+        """Iterates the sources of all the documents matching `query`, past the 10000 hits of a search."""
+        for d in helpers.scan(self.es, query=Search().query(query).to_dict(),
+                              index=idxnm if idxnm else self.idxnm, _source=src):
+            d["_source"]["id"] = d["_id"]
+            yield d["_source"]
+
     def update(self, id, script, routing=None):
         for i in range(3):
             try:
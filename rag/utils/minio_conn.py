@@ -86,6 +86,13 @@ class RAGFlowMinio(object):
         return False
 
 
+    def get_etag(self, bucket, fnm):
+        try:
+            return self.conn.stat_object(bucket, fnm).etag
+        except Exception as e:
+            minio_logger.error(f"Fail stat {bucket}/{fnm}: " + str(e))
+        return
+
     def get_presigned_url(self, bucket, fnm, expires):
         for _ in range(10):
             try:
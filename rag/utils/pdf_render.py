@@ -0,0 +1,128 @@
+import math
+import threading
+
+import numpy as np
+import pypdfium2 as pdfium
+from PIL import Image
+
+# pdfium is not thread-safe, not even across documents.
+_PDFIUM_LOCK = threading.Lock()
+
+
+class PdfRenderer(object):
+    """
+    Rasterizes the pages of one PDF with pdfium straight into numpy arrays.
+
+    The document stays open between pages, unlike pdfplumber's `to_image`
+    which opens it again for every page and goes through PIL, and the bitmap
+    buffer pdfium draws into becomes the array without a copy. The smoothing
+    flags match pdfplumber's defaults, so pages look the same to the models.
+    """
+
+    def __init__(self, fnm, antialias=False):
+        with _PDFIUM_LOCK:
+            self.doc = pdfium.PdfDocument(fnm)
+        self.antialias = antialias
+
+    def __len__(self):
+        return len(self.doc)
+
+    def page_size(self, i):
+        """(width, height) of page `i` in points."""
+        with _PDFIUM_LOCK:
+            page = self.doc[i]
+            try:
+                return page.get_size()
+            finally:
+                page.close()
+
+    def scale(self, i, resolution, max_pixels=0):
+        """Pixels per point for `resolution` DPI, lowered so the page has at most `max_pixels`."""
+        scale = resolution / 72.
+        if max_pixels > 0:
+            w, h = self.page_size(i)
+            if w * h * scale * scale > max_pixels:
+                scale = math.sqrt(max_pixels / (w * h))
+        return scale
+
+    def render(self, i, resolution=72, grayscale=False, max_pixels=0):
+        """Page `i` as an HxWx3 uint8 RGB array, or an HxW one when `grayscale`."""
+        scale = self.scale(i, resolution, max_pixels)
+        no_smooth = not self.antialias
+        with _PDFIUM_LOCK:
+            page = self.doc[i]
+            try:
+                # The native bitmap's buffer is owned by Python, so the array keeps it alive.
+                bitmap = page.render(scale=scale, grayscale=grayscale, rev_byteorder=True,
+                                     no_smoothtext=no_smooth, no_smoothimage=no_smooth, no_smoothpath=no_smooth,
+                                     bitmap_maker=pdfium.PdfBitmap.new_native)
+                arr = bitmap.to_numpy()
+            finally:
+                page.close()
+        if arr.ndim == 3 and arr.shape[2] == 1:
+            arr = arr[:, :, 0]
+        elif arr.ndim == 3 and arr.shape[2] == 4:
+            arr = arr[:, :, :3]
+        return np.ascontiguousarray(arr)
+
+    def image(self, i, resolution=72, grayscale=False, max_pixels=0):
+        return PageImage(self.render(i, resolution, grayscale, max_pixels))
+
+    def close(self):
+        with _PDFIUM_LOCK:
+            self.doc.close()
+
+
+class PageImage(object):
+    """
+    A rendered page, backed by its array. OCR and the recognizers take the array
+    as it is (`np.asarray`); crops and anything else PIL offers are made from
+    it on demand, so it can stand in for the PIL image the parsers used to get.
+    The array is shared: treat it as read-only.
+    """
+
+    def __init__(self, arr):
+        self.array = arr
+
+    @staticmethod
+    def rgb(arr):
+        """`arr` with 3 channels; a gray one is only viewed as such, it is not copied."""
+        if arr.ndim == 2:
+            return np.broadcast_to(arr[:, :, np.newaxis], arr.shape + (3,))
+        return arr
+
+    @property
+    def size(self):
+        return self.array.shape[1], self.array.shape[0]
+
+    def view(self, box):
+        """
+        The pixels of `box` as an array, a view of the page when the box lies
+        inside it. Like PIL's crop, the box is rounded and what falls outside
+        the page is black.
+        """
+        x0, y0, x1, y1 = [int(round(v)) for v in box]
+        h, w = self.array.shape[:2]
+        if 0 <= x0 <= x1 <= w and 0 <= y0 <= y1 <= h:
+            return self.rgb(self.array[y0:y1, x0:x1])
+        out = np.zeros((max(0, y1 - y0), max(0, x1 - x0), 3), dtype=np.uint8)
+        l, t, r, b = max(0, x0), max(0, y0), min(w, x1), min(h, y1)
+        if r > l and b > t:
+            out[t - y0:b - y0, l - x0:r - x0] = self.rgb(self.array[t:b, l:r])
+        return out
+
+    def crop(self, box):
+        arr = self.view(box)
+        if not arr.size:
+            return Image.new("RGB", (arr.shape[1], arr.shape[0]))
+        return Image.fromarray(np.ascontiguousarray(arr))
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is not None or copy:
+            return np.array(self.rgb(self.array), dtype=dtype)
+        return self.rgb(self.array)
+
+    def __getattr__(self, name):
+        if name == "array":
+            raise AttributeError(name)
+        return getattr(Image.fromarray(np.ascontiguousarray(self.rgb(self.array))), name)
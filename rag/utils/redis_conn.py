@@ -25,6 +25,14 @@ class Payload:
     def get_message(self):
         return self.__message
 
+    @property
+    def queue_name(self):
+        return self.__queue_name
+
+    @property
+    def msg_id(self):
+        return self.__msg_id
+
 
 @singleton
 class RedisDB:
@@ -72,6 +80,26 @@ class RedisDB:
             logging.warning("[EXCEPTION]get" + str(k) + "||" + str(e))
             self.__open__()
 
+    def mget(self, keys):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("[EXCEPTION]mget" + str(keys[:1]) + "||" + str(e))
+            self.__open__()
+
+    def set_many(self, mapping, exp=3600):
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]set_many" + str(list(mapping)[:1]) + "||" + str(e))
+            self.__open__()
+        return False
+
     def set_obj(self, k, obj, exp=3600):
         try:
             self.REDIS.set(k, json.dumps(obj, ensure_ascii=False), exp)
@@ -90,6 +118,43 @@ class RedisDB:
             self.__open__()
         return False
 
+    def sadd(self, key, members, exp=3600):
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            if members:
+                pipeline.sadd(key, *members)
+            pipeline.expire(key, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]sadd" + str(key) + "||" + str(e))
+            self.__open__()
+        return False
+
+    def smembers(self, key):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.smembers(key)
+        except Exception as e:
+            logging.warning("[EXCEPTION]smembers" + str(key) + "||" + str(e))
+            self.__open__()
+
+    def spop(self, key, count=1):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.spop(key, count)
+        except Exception as e:
+            logging.warning("[EXCEPTION]spop" + str(key) + "||" + str(e))
+            self.__open__()
+
+    def scard(self, key):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.scard(key)
+        except Exception as e:
+            logging.warning("[EXCEPTION]scard" + str(key) + "||" + str(e))
+            self.__open__()
+
     def transaction(self, key, value, exp=3600):
         try:
             pipeline = self.REDIS.pipeline(transaction=True)
@@ -101,6 +166,24 @@ class RedisDB:
             self.__open__()
         return False
 
+    def setnx(self, key, value, exp=3600):
+        """Sets the key only if it does not exist; True if this call set it."""
+        try:
+            return bool(self.REDIS.set(key, value, exp, nx=True))
+        except Exception as e:
+            logging.warning("[EXCEPTION]setnx" + str(key) + "||" + str(e))
+            self.__open__()
+        return False
+
+    def delete(self, key):
+        try:
+            self.REDIS.delete(key)
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]delete" + str(key) + "||" + str(e))
+            self.__open__()
+        return False
+
     def queue_product(self, queue, message, exp=settings.SVR_QUEUE_RETENTION) -> bool:
         for _ in range(3):
             try:
@@ -146,6 +229,50 @@ class RedisDB:
                 logging.warning("[EXCEPTION]consumer: " + str(queue_name) + "||" + str(e))
         return None
 
+    def queue_consume_batch(self, queue_name, group_name, consumer_name, count, msg_id=">") -> list[Payload]:
+        """Reads up to `count` messages without blocking; msg_id "0" re-reads the consumer's pending ones."""
+        try:
+            messages = self.REDIS.xreadgroup(groupname=group_name, consumername=consumer_name,
+                                             streams={queue_name: msg_id}, count=count)
+            if not messages:
+                return []
+            return [Payload(self.REDIS, queue_name, group_name, i, p) for i, p in messages[0][1] if p]
+        except Exception as e:
+            logging.warning("[EXCEPTION]consumer: " + str(queue_name) + "||" + str(e))
+        return []
+
+    def queue_autoclaim(self, queue_name, group_name, consumer_name, min_idle_ms, count) -> list[Payload]:
+        """Takes over messages of any consumer which have been pending for longer than `min_idle_ms`."""
+        try:
+            res = self.REDIS.xautoclaim(queue_name, group_name, consumer_name, min_idle_ms, start_id="0-0", count=count)
+            return [Payload(self.REDIS, queue_name, group_name, i, p) for i, p in res[1] if p]
+        except Exception as e:
+            logging.warning("[EXCEPTION]xautoclaim: " + str(queue_name) + "||" + str(e))
+        return []
+
+    def queue_touch(self, queue_name, group_name, consumer_name, msg_ids) -> list | None:
+        """Resets the idle time of messages still pending for the consumer, and returns their ids."""
+        try:
+            # XCLAIM would also take back messages another consumer has claimed meanwhile.
+            pendings = self.REDIS.xpending_range(queue_name, group_name, min="-", max="+", count=10000,
+                                                 consumername=consumer_name)
+            owned = [p["message_id"] for p in pendings if p["message_id"] in msg_ids]
+            if not owned:
+                return []
+            return self.REDIS.xclaim(queue_name, group_name, consumer_name, 0, owned, justid=True)
+        except Exception as e:
+            logging.warning("[EXCEPTION]xclaim: " + str(queue_name) + "||" + str(e))
+
+    def queue_info(self, queue_name, group_name) -> dict | None:
+        try:
+            groups = self.REDIS.xinfo_groups(queue_name)
+            for group in groups:
+                if group["name"] == group_name:
+                    return group
+        except Exception as e:
+            logging.warning("[EXCEPTION]queue_info: " + str(queue_name) + "||" + str(e))
+        return None
+
     def get_unacked_for(self, consumer_name, queue_name, group_name):
         try:
             group_info = self.REDIS.xinfo_groups(queue_name)
@@ -119,6 +119,13 @@ class RAGFlowS3(object):
             else:
                 raise
 
+    def get_etag(self, bucket, fnm):
+        try:
+            return self.conn.head_object(Bucket=bucket, Key=fnm)["ETag"]
+        except Exception as e:
+            s3_logger.error(f"Fail head {bucket}/{fnm}: " + str(e))
+        return
+
     def get_presigned_url(self, bucket, fnm, expires):
         for _ in range(10):
             try:
@@ -0,0 +1,274 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from rag.settings import SVR_QUEUE_NAME, SVR_TASK_BROKER_GROUP_NAME, SVR_QUEUE_PREFETCH, SVR_QUEUE_CLAIM_IDLE
+from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN, Payload
+
+
+@singleton
+class RAGFlowTaskQueue(object):
+    """
+    Parsing tasks in one Redis stream per tenant, plus a priority lane per tenant
+    for small documents.
+
+    A consumer takes its next task from the tenant with the fewest tasks in
+    progress (over both of its lanes) relative to its weight (`<queue>:weights`,
+    default 1), so a tenant with a huge backlog gets the same share of executors
+    as one uploading a single file. Priority lanes go first, but a waiting normal
+    lane is served at least once every PRIORITY_SHARE + 1 picks.
+
+    Producers add their stream to `<queue>:ready`, and consumers only look at
+    those streams and the other lane of their tenants, dropping the ones found
+    drained. `<queue>:streams` holds the streams with undelivered or pending
+    messages; it is swept when stale messages are looked for.
+
+    Messages are read SVR_QUEUE_PREFETCH at a time into a local buffer. The ones
+    this process has started are touched by `heartbeat`, so those pending longer
+    than SVR_QUEUE_CLAIM_IDLE seconds belong to a dead consumer and are taken
+    over by any live one. Buffered ones are not touched: behind a long task they
+    go idle and other consumers can take them over, so a message that waited
+    in the buffer is only started if this consumer still owns it.
+    """
+    PRIORITY_SHARE = 3
+
+    def __init__(self, queue_name=SVR_QUEUE_NAME, group_name=SVR_TASK_BROKER_GROUP_NAME):
+        self.queue_name = queue_name
+        self.group_name = group_name
+        self.registry = queue_name + ":streams"
+        self.ready = queue_name + ":ready"
+        self.weights = queue_name + ":weights"
+        self.rr = 0
+        self.priority_picks = 0
+        self.prefetch = max(1, SVR_QUEUE_PREFETCH)
+        self.claim_idle = SVR_QUEUE_CLAIM_IDLE
+        self.buffer = deque()
+        self.held = {}
+        self.lock = threading.Lock()
+        self.last_claim = 0
+
+    def stream(self, tenant_id, priority=False):
+        return "{}:{}{}".format(self.queue_name, tenant_id, ":priority" if priority else "")
+
+    def tenant_of(self, stream):
+        return stream[len(self.queue_name) + 1:].split(":")[0]
+
+    def product(self, tenant_id, messages, priority=False) -> bool:
+        stream = self.stream(tenant_id, priority)
+        for _ in range(3):
+            try:
+                pipeline = REDIS_CONN.REDIS.pipeline()
+                for m in messages:
+                    pipeline.xadd(stream, {"message": json.dumps(m)})
+                # After the messages, see `_drop`.
+                pipeline.sadd(self.registry, stream)
+                pipeline.sadd(self.ready, stream)
+                pipeline.execute()
+                return True
+            except Exception as e:
+                logging.warning("[EXCEPTION]producer" + str(stream) + "||" + str(e))
+                REDIS_CONN.__open__()
+        return False
+
+    def streams(self):
+        """Returns {stream: group info} of every registered stream."""
+        return self._groups(sorted(REDIS_CONN.REDIS.smembers(self.registry) or []) + [self.queue_name])
+
+    def _groups(self, names):
+        """Returns {stream: group info} of the existing streams in `names`, creating missing groups."""
+        pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+        for s in names:
+            pipeline.xinfo_groups(s)
+            pipeline.xinfo_stream(s)
+        r = pipeline.execute(raise_on_error=False)
+        res = {}
+        for s, groups, stream in zip(names, r[0::2], r[1::2]):
+            if isinstance(groups, Exception) or isinstance(stream, Exception):
+                continue
+            group = [g for g in groups if g["name"] == self.group_name]
+            if not group:
+                try:
+                    REDIS_CONN.REDIS.xgroup_create(s, self.group_name, id="0", mkstream=True)
+                except Exception as e:
+                    if "BUSYGROUP" not in str(e):
+                        raise
+                group = [{"pending": 0, "lag": None, "last-delivered-id": "0-0"}]
+            g = dict(group[0])
+            g["last-generated-id"] = stream.get("last-generated-id")
+            # Redis before 7.0 does not report lag.
+            if g.get("lag") is None and g.get("last-delivered-id") == g["last-generated-id"]:
+                g["lag"] = 0
+            res[s] = g
+        return res
+
+    def _drop(self, stream, last_id, keys):
+        """
+        Removes a drained stream from the sets `keys`. Producers add a stream to
+        them after their messages, so a message which came in since `last_id` is
+        either followed by their SADD or seen here, and the stream is put back.
+        """
+        if stream == self.queue_name:
+            return
+        try:
+            pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+            for k in keys:
+                pipeline.srem(k, stream)
+            pipeline.execute()
+            try:
+                now = REDIS_CONN.REDIS.xinfo_stream(stream).get("last-generated-id")
+            except Exception:
+                return
+            if now != last_id:
+                pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+                for k in keys:
+                    pipeline.sadd(k, stream)
+                pipeline.execute()
+        except Exception as e:
+            logging.warning("[EXCEPTION]drop stream: " + str(stream) + "||" + str(e))
+
+    def _hold(self, consumer_name, payloads):
+        now = time.time()
+        with self.lock:
+            for p in payloads:
+                self.buffer.append((p, now))
+        return self._next(consumer_name)
+
+    def _next(self, consumer_name):
+        while True:
+            with self.lock:
+                if not self.buffer:
+                    return None
+                payload, since = self.buffer.popleft()
+            # Idle for less than half the claim time, it cannot have been claimed.
+            if self.claim_idle > 0 and time.time() - since >= self.claim_idle / 2 and \
+                    not REDIS_CONN.queue_touch(payload.queue_name, self.group_name, consumer_name, [payload.msg_id]):
+                logging.warning("Buffered task {} of {} was taken over.".format(payload.msg_id, payload.queue_name))
+                continue
+            with self.lock:
+                self.held.setdefault(payload.queue_name, set()).add(payload.msg_id)
+            return payload
+
+    def _claim(self, consumer_name):
+        """Now and then, sweeps the registry and takes over the stale messages of dead consumers."""
+        if time.time() - self.last_claim < max(self.claim_idle, 60) / 4:
+            return
+        self.last_claim = time.time()
+        streams = self.streams()
+        for s, g in streams.items():
+            if g.get("lag") != 0:
+                # Catches streams whose SADD to the ready set got lost.
+                REDIS_CONN.REDIS.sadd(self.ready, s)
+            elif not g.get("pending"):
+                self._drop(s, g["last-generated-id"], [self.registry, self.ready])
+        for s, g in streams.items():
+            if self.claim_idle <= 0 or not g.get("pending"):
+                continue
+            payloads = REDIS_CONN.queue_autoclaim(s, self.group_name, consumer_name, self.claim_idle * 1000, self.prefetch)
+            if payloads:
+                logging.warning("Claimed {} stale task(s) of {}".format(len(payloads), s))
+                return self._hold(consumer_name, payloads)
+
+    def consume(self, consumer_name) -> Payload:
+        payload = self._next(consumer_name)
+        if payload:
+            return payload
+        try:
+            payload = self._claim(consumer_name)
+            if payload:
+                return payload
+            ready = sorted(REDIS_CONN.REDIS.smembers(self.ready) or []) + [self.queue_name]
+            # The other lane of a tenant counts in its share too.
+            tenants = set([self.tenant_of(s) for s in ready if s != self.queue_name])
+            lanes = set(ready) | set([self.stream(t, p) for t in tenants for p in [False, True]])
+            streams = self._groups(sorted(lanes))
+            weights = REDIS_CONN.REDIS.hgetall(self.weights) or {}
+        except Exception as e:
+            logging.warning("[EXCEPTION]consumer: " + str(self.queue_name) + "||" + str(e))
+            REDIS_CONN.__open__()
+            return None
+
+        running = {}
+        for s, g in streams.items():
+            running[self.tenant_of(s)] = running.get(self.tenant_of(s), 0) + (g.get("pending") or 0)
+        ready = [s for s in ready if s in streams]
+        for s in ready:
+            if streams[s].get("lag") == 0:
+                self._drop(s, streams[s]["last-generated-id"],
+                           [self.ready] + ([] if streams[s].get("pending") else [self.registry]))
+        ready = [s for s in ready if streams[s].get("lag") != 0]
+        if not ready:
+            return None
+        idx = {s: i for i, s in enumerate(ready)}
+
+        def share(s):
+            w = float(weights.get(self.tenant_of(s), 1)) or 1
+            return running.get(self.tenant_of(s), 0) / w, (idx[s] - self.rr) % len(idx)
+
+        ready = sorted(ready, key=share)
+        priority = [s for s in ready if s.endswith(":priority")]
+        normal = [s for s in ready if not s.endswith(":priority")]
+        if priority and (not normal or self.priority_picks < self.PRIORITY_SHARE):
+            order = priority + normal
+        else:
+            order = normal + priority
+        self.rr += 1
+
+        for s in order:
+            payloads = REDIS_CONN.queue_consume_batch(s, self.group_name, consumer_name, self.prefetch)
+            if not payloads:
+                # Drained while its lag was unknown.
+                self._drop(s, streams[s]["last-generated-id"], [self.ready])
+                continue
+            self.priority_picks = self.priority_picks + 1 if s in priority else 0
+            return self._hold(consumer_name, payloads)
+        return None
+
+    def get_unacked_for(self, consumer_name) -> Payload:
+        """Messages left pending by a former process of the consumer; call it with nothing in flight."""
+        payload = self._next(consumer_name)
+        if payload:
+            return payload
+        try:
+            streams = [s for s, g in self.streams().items() if g.get("pending")]
+        except Exception as e:
+            logging.warning("[EXCEPTION]get_unacked_for: " + str(self.queue_name) + "||" + str(e))
+            return None
+        for s in streams:
+            payloads = REDIS_CONN.queue_consume_batch(s, self.group_name, consumer_name, self.prefetch, msg_id="0")
+            if payloads:
+                return self._hold(consumer_name, payloads)
+        return None
+
+    def heartbeat(self, consumer_name):
+        """Keeps the messages held by this process from being claimed, and forgets the acked ones."""
+        with self.lock:
+            held = {s: set(ids) for s, ids in self.held.items()}
+        for s, ids in held.items():
+            alive = REDIS_CONN.queue_touch(s, self.group_name, consumer_name, ids)
+            if alive is None:
+                continue
+            with self.lock:
+                self.held[s] = (self.held.get(s, set()) - ids) | set(alive)
+                if not self.held[s]:
+                    del self.held[s]
+
+    def info(self) -> dict | None:
+        """Undelivered (lag) and in progress (pending) tasks, in total and per stream."""
+        try:
+            streams = self.streams()
+        except Exception as e:
+            logging.warning("[EXCEPTION]queue_info: " + str(self.queue_name) + "||" + str(e))
+            return None
+        streams = {s: {"lag": g.get("lag") or 0, "pending": g.get("pending") or 0, "consumers": g.get("consumers", 0)}
+                   for s, g in streams.items()}
+        return {
+            "lag": sum(g["lag"] for g in streams.values()),
+            "pending": sum(g["pending"] for g in streams.values()),
+            "streams": streams,
+        }
+
+
+TASK_QUEUE = RAGFlowTaskQueue()